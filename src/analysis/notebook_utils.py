@@ -18,6 +18,7 @@ import json
 from typing import Any, Mapping, Optional, Sequence, Tuple
 from . import parsers
 from . import residue_constants
+from components import prediction_io
 
 from matplotlib import pyplot as plt
 import numpy as np
@@ -168,6 +169,14 @@ def empty_placeholder_template_features(
   }
 
 
+def load_raw_prediction(raw_prediction_path: str) -> Mapping[str, Any]:
+  """Loads a raw prediction saved as a pickle (.pkl) or slim columnar (.npz).
+
+  See prediction_io.load_prediction_result, shared with the components.
+  """
+  return prediction_io.load_prediction_result(raw_prediction_path)
+
+
 def get_pae_json(pae: np.ndarray, max_pae: float) -> str:
   """Returns the PAE in the same format as is used in the AFDB."""
   rounded_errors = np.round(pae.astype(np.float64), decimals=1)
@@ -15,10 +15,9 @@
 # ======================== Loading basic libraries ===========================
 
 import json
-from time import sleep
-from datetime import datetime, timezone
+from time import sleep, time
+from datetime import datetime
 import os
-import re
 import uuid
 import requests
 from flask import Flask, request, render_template, flash, redirect, send_file, url_for, jsonify, session, Response
@@ -29,9 +28,10 @@ from google.cloud import aiplatform_v1 as vertex_ai2
 from google.cloud import storage
 from flask_cors import CORS
 import jwt
-from kfp.v2 import compiler
 
+import status_service
 from utils import compile_utils
+from utils import estimate_utils
 from utils import fasta_utils
 
 
@@ -47,6 +47,12 @@ AR_REPO_NAME = os.environ.get("AR_REPO_NAME")
 FILESTORE_MOUNT_PATH = os.environ.get("FILESTORE_MOUNT_PATH") 
 MODEL_PARAMS = f'gs://{BUCKET_NAME}'
 IS_GCR_IO_REPO = os.environ.get("IS_GCR_IO_REPO")
+TIMINGS_PATH = os.environ.get("TIMINGS_PATH") # Optional JSONL log of task timings
+TIMINGS_MAX_AGE = 3600 # Seconds before timings collected from Vertex are refreshed
+PIPELINE_NAME = 'alphafold-inference-pipeline'
+PIPELINE_BUILDER = 'pipelines.alphafold_inference_pipeline.build_pipeline'
+TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR", "/tmp/pipeline_templates") # Compiled pipeline templates
+PARALLELISM = 5
 IMAGE_URI = f'gcr.io/{PROJECT_ID}/alphafold-components' if IS_GCR_IO_REPO == "true" else f'{REGION}-docker.pkg.dev/{PROJECT_ID}/{AR_REPO_NAME}/alphafold-components'
 
 
@@ -57,6 +63,14 @@ except:
     print("WARNING - Filestore instance is not present. This will fail to run folding job.")
 
 storage_client = storage.Client(project=PROJECT_ID)
+job_status = status_service.StatusService(
+    vertex_ai2.PipelineServiceClient(
+        client_options={"api_endpoint": f"{REGION}-aiplatform.googleapis.com"}),
+    project_id=PROJECT_ID,
+    region=REGION,
+    bucket_name=BUCKET_NAME,
+    project_number=PROJECT_NUMBER,
+    list_ttl=float(os.environ.get("STATUS_LIST_TTL", 30)))
 vertex_ai.init(
     project=PROJECT_ID,
     location=REGION,
@@ -142,6 +156,41 @@ def check_fasta():
         })
     return "no result"
 
+timings_cache = {"timings": None, "collected": 0.}
+
+def get_timings():
+    """ Task timings of past runs, from TIMINGS_PATH or the recent pipeline jobs"""
+    if TIMINGS_PATH:
+        return estimate_utils.read_timings(TIMINGS_PATH)
+    if (timings_cache["timings"] is None
+            or time() - timings_cache["collected"] > TIMINGS_MAX_AGE):
+        timings_cache["timings"] = estimate_utils.collect_timings(PROJECT_ID, REGION)
+        timings_cache["collected"] = time()
+    return timings_cache["timings"]
+
+@app.route("/estimate", methods=['POST'])
+def estimate():
+    user_info = valid_user()
+    if user_info is not None:
+        if 'file' not in request.files:
+            return Response('{"status":"uploaded file missing."}',status=400, mimetype='application/json')
+        f = request.files['file']
+        filename = secure_filename(f.filename )
+        save_file_locally(f, filename)
+        form = dict(request.form)
+
+        # The same pipeline parameters as /fold
+        params = {
+        'model_preset': str(form["proteinType"]).lower(),
+        'num_multimer_predictions_per_model': int(form["predictionCount"]),
+        'is_run_relax': 'relax' if str(form["relaxation"]).lower() == "yes" else '',
+        }
+        estimator = estimate_utils.RuntimeEstimator(
+            get_timings(), PIPELINE_NAME, PARALLELISM)
+        return jsonify(estimator.estimate(filename, params))
+    else:
+        return Response("{'status':'Unauthorized'}", status=401, mimetype='application/json')
+
 def get_user_data(url, parameters):
         response = requests.get(url, params=parameters)
         if response.status_code == 200:
@@ -151,137 +200,23 @@ def get_user_data(url, parameters):
                 f"ERROR, here's a {response.status_code} error with your request")
             return None
 
-def formatUrlLink(name, region, project_id):
-    pipeline_run_name = name.split('/')[-1:][0]
-    return f'https://console.cloud.google.com/vertex-ai/locations/{region}/pipelines/runs/{pipeline_run_name}?project={project_id}'
-
-def formatUrlAllStructures(pipeline_name, bucket_name, exp_id, project_number):
-    pipeline_run_name = pipeline_name.split('/')[-1:][0]
-    return f'https://console.cloud.google.com/storage/browser/{bucket_name}/pipeline_runs/universal-pipeline-{exp_id}/{project_number}/{pipeline_run_name}'
-
-
 @app.route("/clientid", methods=['GET'])
 def get_clientid():
     return f'{os.environ.get("OAUTH2_CLIENT_ID")}'
 
-def reformatBucketUri(gcs_uri):
-    if gcs_uri is None or gcs_uri == "NA":
-        return "NA"
-    folder = gcs_uri.replace("gs://","")
-    folder = re.sub('[\w-]+\.[a-z]*', '', folder)
-    return f'https://console.cloud.google.com/storage/browser/{folder}'
-
-def extract_prediction_relaxation_tasks(_pipe, _client_pipeline):
-    get_request = vertex_ai2.GetPipelineJobRequest(name=_pipe.name) # pipe.name = pipeline ID
-    pipeline_job = _client_pipeline.get_pipeline_job(get_request)
-    # predict_tasks = [i for i in pipeline_job.job_detail.task_details]
-    predict_tasks = [i for i in pipeline_job.job_detail.task_details if i.task_name == 'predict']
-    potential_relax_tasks = [i for i in pipeline_job.job_detail.task_details if 'condition' in i.task_name]
-
-    formatted_predict_relax_tasks = []
-
-    for predictTask in predict_tasks:
-        task_id = predictTask.task_id
-        parent_task_id = predictTask.parent_task_id
-        print(f'Predict parent_task_id: {parent_task_id}')
-        model_name = predictTask.execution.metadata['input:model_name']
-        ranking_confidence = 0 if predictTask.outputs["raw_prediction"].artifacts[0].metadata.get("ranking_confidence") == None \
-            else predictTask.outputs['raw_prediction'].artifacts[0].metadata['ranking_confidence']
-        predict_uri = predictTask.outputs['raw_prediction'].artifacts[0].uri
-
-        # Get relaxation
-        relax_task_id = None
-        relax_uri = None
-        for relaxTask in potential_relax_tasks:
-            if relaxTask.parent_task_id == parent_task_id:
-                relax_task_id = relaxTask.task_id
-                break
-
-        for t2 in pipeline_job.job_detail.task_details:
-            if t2.parent_task_id == relax_task_id:
-                relax_uri = t2.outputs['relaxed_protein'].artifacts[0].uri \
-                    if 'relaxed_protein' in t2.outputs else None
-                print(f'Relax uri: {relax_uri}')
-                break
-
-        formatted_predict_relax_tasks.append(
-            {
-                'task_id': task_id,
-                'task_name': predictTask.task_name,
-                'parent_task_id': parent_task_id,
-                'model_name': model_name,
-                'ranking_confidence': ranking_confidence,
-                'predict_uri': reformatBucketUri(predict_uri),
-                'relax_uri': reformatBucketUri(relax_uri)
-            }
-        )
-    return formatted_predict_relax_tasks
-
 @app.route("/status", methods=['GET'])
 def get_dashboarddata():
     user_info = valid_user()
 
     if user_info is not None:
-        API_ENDPOINT = "{}-aiplatform.googleapis.com".format(REGION)
-        # Create Pipelines and Metadata service clients
-        client_pipeline = vertex_ai2.PipelineServiceClient(client_options={"api_endpoint": API_ENDPOINT})
-        client_metadata = vertex_ai2.MetadataServiceClient(client_options={"api_endpoint": API_ENDPOINT})
-        list_pipelines_request = vertex_ai2.ListPipelineJobsRequest(parent=f'projects/{PROJECT_ID}/locations/{REGION}')
-        list_pipelines = list(client_pipeline.list_pipeline_jobs(list_pipelines_request))
-        running_pp = []
-        
-        for pipe in list_pipelines:
-            labels = pipe.labels
-            status = pipe.state.name.split("_")[-1]
-            url_link = formatUrlLink(pipe.name, REGION, PROJECT_ID)
-            url_all_structures = formatUrlAllStructures(pipe.name, BUCKET_NAME, labels['experiment_id'], PROJECT_NUMBER)
-
-            if pipe.end_time:
-                duration = pipe.end_time - ( pipe.end_time if pipe.start_time is None else pipe.start_time)
-            else:
-                duration = datetime.now(timezone.utc) - pipe.start_time
-
-            seconds = duration.total_seconds()
-            hours = int(seconds // 3600)
-            minutes = int((seconds % 3600) // 60)
-            seconds = seconds % 60
-            ti = f'{hours}h{minutes}m'
-
-            # Extract each prediction and its associated relaxation tasks
-            if status != "RUNNING":
-                predict_relax_tasks = extract_prediction_relaxation_tasks(pipe, client_pipeline)
-                for task in predict_relax_tasks:
-                    p_data ={
-                        "run_tag": labels['run_tag'],
-                        "experiment_id":labels['experiment_id'],
-                        "sequence":labels['sequence_id'],
-                        "status":status,
-                        "duration":ti,
-                        "url_link": url_link,
-                        "url_all_structures": url_all_structures,
-                        "predict_uri": task["predict_uri"],
-                        "relax_uri": task["relax_uri"],
-                        "ranking_confidence": task["ranking_confidence"],
-                        "user": labels['user'],
-                        "create_time": 0 if pipe.create_time is None else pipe.create_time,
-                    }
-                    running_pp.append(p_data)
-            else:
-                p_data ={
-                        "run_tag": labels['run_tag'],
-                        "experiment_id":labels['experiment_id'],
-                        "sequence":labels['sequence_id'],
-                        "status":status,
-                        "duration":ti,
-                        "url_link": url_link,
-                        "url_all_structures": url_all_structures,
-                        "predict_uri": "NA",
-                        "relax_uri": "NA",
-                        "ranking_confidence": "NA",
-                        "user": labels['user']
-                    }
-                running_pp.append(p_data)
-        return jsonify(running_pp)
+        # Optional filters on the row fields, and offset and limit of the page
+        filters = {k: request.args.get(k) for k in status_service.FILTERS}
+        offset = request.args.get('offset', default=0, type=int)
+        limit = request.args.get('limit', default=None, type=int)
+        running_pp, total = job_status.page(filters, offset, limit)
+        response = jsonify(running_pp)
+        response.headers['X-Total-Count'] = str(total)
+        return response
     else:
         return Response("{'status':'Unauthorized'}", status=401, mimetype='application/json')
 
@@ -356,29 +291,27 @@ def fold():
         'region': REGION
         }
 
-        os.environ['PREDICT_MACHINE_TYPE'] = str(form["predictMachineType"]).lower()
-        os.environ['PREDICT_ACCELERATOR_COUNT'] = str(form["acceleratorCount"]).lower()
-        os.environ['PREDICT_ACCELERATOR_TYPE'] = decide_accelerator_type(str(form["predictMachineType"]))
-        
-        os.environ['RELAX_MACHINE_TYPE'] = str(form["relaxMachineType"]).lower()
-        os.environ['RELAX_ACCELERATOR_COUNT'] = str(form["relaxAcceleratorCount"]).lower()
-        os.environ['RELAX_ACCELERATOR_TYPE'] = decide_accelerator_type(str(form["relaxMachineType"]))
-
-        os.environ['ALPHAFOLD_COMPONENTS_IMAGE'] = IMAGE_URI
-        os.environ['NFS_SERVER'] = FILESTORE_IP
-        os.environ['NFS_PATH'] = FILESTORE_SHARE
-        os.environ['NETWORK'] = FILESTORE_NETWORK
-        os.environ['MODEL_PARAMS_GCS_LOCATION'] = MODEL_PARAMS
-        os.environ['PARALLELISM'] = '5'
-        
-        # Compile the pipeline
-        from pipelines.alphafold_inference_pipeline import alphafold_inference_pipeline as pipeline
+        config_values = {
+            'PREDICT_MACHINE_TYPE': str(form["predictMachineType"]).lower(),
+            'PREDICT_ACCELERATOR_COUNT': str(form["acceleratorCount"]).lower(),
+            'PREDICT_ACCELERATOR_TYPE': decide_accelerator_type(str(form["predictMachineType"])),
+            'RELAX_MACHINE_TYPE': str(form["relaxMachineType"]).lower(),
+            'RELAX_ACCELERATOR_COUNT': str(form["relaxAcceleratorCount"]).lower(),
+            'RELAX_ACCELERATOR_TYPE': decide_accelerator_type(str(form["relaxMachineType"])),
+            'ALPHAFOLD_COMPONENTS_IMAGE': IMAGE_URI,
+            'NFS_SERVER': FILESTORE_IP,
+            'NFS_PATH': FILESTORE_SHARE,
+            'NETWORK': FILESTORE_NETWORK,
+            'MODEL_PARAMS_GCS_LOCATION': MODEL_PARAMS,
+            'PARALLELISM': str(PARALLELISM),
+        }
+
+        # Compile the pipeline, once for every config
+        template_path = compile_utils.pipeline_template(
+            PIPELINE_BUILDER, config_values, TEMPLATE_CACHE_DIR)
         run_tag = str(form["runTag"]).lower()
         experiment_id = str(form["experimentId"]).lower()
         pipeline_name = f'universal-pipeline-{experiment_id}'
-        compiler.Compiler().compile(
-            pipeline_func=pipeline,
-            package_path=f'{pipeline_name}.json')
 
         # Run FOLD
         # Running the existing pipeline
@@ -390,7 +323,7 @@ def fold():
 
         pipeline_job = vertex_ai.PipelineJob(
             display_name=pipeline_name,
-            template_path=f'{pipeline_name}.json', # pipeline name need to be unique, and subfolders in GCS
+            template_path=template_path,
             pipeline_root=f'gs://{BUCKET_NAME}/pipeline_runs/{pipeline_name}',
             parameter_values=params,
             enable_caching=True,
@@ -0,0 +1,251 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Status of the folding jobs shown on the dashboard of the portal.
+
+The pipeline jobs of the project are listed at most once every list_ttl
+seconds. The prediction and relaxation tasks of a job are fetched once per
+job and state, concurrently for the jobs of a listing. Those of finished
+jobs never change and stay cached, those of other jobs are fetched again
+after list_ttl seconds.
+
+The service only calls list_pipeline_jobs(request=...) and
+get_pipeline_job(name=...) on its pipeline client, so a stub client can
+stand in for the Vertex AI one.
+"""
+
+import collections
+import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import time
+
+
+FINISHED_STATES = ('SUCCEEDED', 'FAILED', 'CANCELLED')
+
+# Row fields that /status can be filtered on
+FILTERS = ('status', 'experiment_id', 'run_tag', 'sequence', 'user')
+
+
+def formatUrlLink(name, region, project_id):
+    pipeline_run_name = name.split('/')[-1:][0]
+    return f'https://console.cloud.google.com/vertex-ai/locations/{region}/pipelines/runs/{pipeline_run_name}?project={project_id}'
+
+def formatUrlAllStructures(pipeline_name, bucket_name, exp_id, project_number):
+    pipeline_run_name = pipeline_name.split('/')[-1:][0]
+    return f'https://console.cloud.google.com/storage/browser/{bucket_name}/pipeline_runs/universal-pipeline-{exp_id}/{project_number}/{pipeline_run_name}'
+
+def reformatBucketUri(gcs_uri):
+    if gcs_uri is None or gcs_uri == "NA":
+        return "NA"
+    folder = gcs_uri.replace("gs://","")
+    folder = re.sub(r'[\w-]+\.[a-z]*', '', folder)
+    return f'https://console.cloud.google.com/storage/browser/{folder}'
+
+def extract_relaxed_protein_uris(pipeline_job):
+    """ URIs of the relaxed proteins of a pipeline job, by unrelaxed protein URI
+
+    Relax tasks sit in conditions and loops nested differently in each
+    pipeline, so they are matched to predictions by the unrelaxed protein
+    they relax: the predict task output, its import for selected
+    predictions, or one of the targets of a batch relax task.
+
+    task_details is a flat list, each task pointing at its parent by
+    parent_task_id. The relax tasks of the inference pipeline, for instance,
+    are laid out as:
+
+        for-loop-1 > for-loop-1-iteration-0 > predict
+                                            > condition-2 > relax
+        condition-3 > select-relax-targets
+                    > for-loop-4 > for-loop-4-iteration-0 > importer-3
+                                                          > relax-2
+
+    and the batch relax task of the multimer pipelines sits in a condition
+    next to select-relax-targets, with the relaxed protein URIs of its
+    targets in the relaxed_protein_uris metadata of relaxed_proteins.
+    """
+    relaxed_protein_uris = {}
+    for task in pipeline_job.job_detail.task_details:
+        if 'relaxed_protein' in task.outputs and 'unrelaxed_protein' in task.inputs:
+            unrelaxed_protein_uri = task.inputs['unrelaxed_protein'].artifacts[0].uri
+            relaxed_protein_uris[unrelaxed_protein_uri] = task.outputs['relaxed_protein'].artifacts[0].uri
+        elif 'relaxed_proteins' in task.outputs:
+            metadata = task.outputs['relaxed_proteins'].artifacts[0].metadata
+            relaxed_protein_uris.update(json.loads(metadata.get('relaxed_protein_uris', '{}')))
+    return relaxed_protein_uris
+
+def extract_prediction_relaxation_tasks(pipeline_job):
+    """ Predict tasks of a pipeline job, with the relaxation of their prediction"""
+    predict_tasks = [i for i in pipeline_job.job_detail.task_details
+                     if 'raw_prediction' in i.outputs and 'unrelaxed_protein' in i.outputs]
+    relaxed_protein_uris = extract_relaxed_protein_uris(pipeline_job)
+
+    formatted_predict_relax_tasks = []
+
+    for predictTask in predict_tasks:
+        task_id = predictTask.task_id
+        parent_task_id = predictTask.parent_task_id
+        model_name = predictTask.execution.metadata['input:model_name']
+        ranking_confidence = 0 if predictTask.outputs["raw_prediction"].artifacts[0].metadata.get("ranking_confidence") == None \
+            else predictTask.outputs['raw_prediction'].artifacts[0].metadata['ranking_confidence']
+        predict_uri = predictTask.outputs['raw_prediction'].artifacts[0].uri
+
+        # Get relaxation
+        unrelaxed_protein_uri = predictTask.outputs['unrelaxed_protein'].artifacts[0].uri
+        relax_uri = relaxed_protein_uris.get(unrelaxed_protein_uri)
+
+        formatted_predict_relax_tasks.append(
+            {
+                'task_id': task_id,
+                'task_name': predictTask.task_name,
+                'parent_task_id': parent_task_id,
+                'model_name': model_name,
+                'ranking_confidence': ranking_confidence,
+                'predict_uri': reformatBucketUri(predict_uri),
+                'relax_uri': reformatBucketUri(relax_uri)
+            }
+        )
+    return formatted_predict_relax_tasks
+
+def format_duration(pipe):
+    if pipe.end_time:
+        duration = pipe.end_time - ( pipe.end_time if pipe.start_time is None else pipe.start_time)
+    elif pipe.start_time:
+        duration = datetime.now(timezone.utc) - pipe.start_time
+    else:
+        return '0h0m'
+    seconds = duration.total_seconds()
+    hours = int(seconds // 3600)
+    minutes = int((seconds % 3600) // 60)
+    return f'{hours}h{minutes}m'
+
+
+class StatusService:
+    """ Dashboard rows of the pipeline jobs of a project"""
+
+    def __init__(self, pipeline_client, project_id, region, bucket_name,
+                 project_number, list_ttl=30., max_workers=8,
+                 max_cached_jobs=2000):
+        self.pipeline_client = pipeline_client
+        self.project_id = project_id
+        self.region = region
+        self.bucket_name = bucket_name
+        self.project_number = project_number
+        self.list_ttl = list_ttl
+        self.max_workers = max_workers
+        self.max_cached_jobs = max_cached_jobs
+
+        self._lock = threading.Lock()
+        self._listing = None
+        self._listed = 0.
+        # (job name, state) -> (prediction and relaxation tasks, fetch time)
+        self._tasks = collections.OrderedDict()
+
+    def list_jobs(self):
+        """ Pipeline jobs of the project, listed at most every list_ttl seconds"""
+        with self._lock:
+            if self._listing is not None and time() - self._listed < self.list_ttl:
+                return self._listing
+        listing = list(self.pipeline_client.list_pipeline_jobs(request={
+            'parent': f'projects/{self.project_id}/locations/{self.region}'}))
+        with self._lock:
+            self._listing, self._listed = listing, time()
+        return listing
+
+    def _cached_tasks(self, key):
+        with self._lock:
+            entry = self._tasks.get(key)
+            if entry is None:
+                return None
+            tasks, fetched = entry
+            finished = key[1].split('_')[-1] in FINISHED_STATES
+            if not finished and time() - fetched >= self.list_ttl:
+                return None
+            self._tasks.move_to_end(key)
+            return tasks
+
+    def _fetch_tasks(self, key):
+        pipeline_job = self.pipeline_client.get_pipeline_job(name=key[0])
+        tasks = extract_prediction_relaxation_tasks(pipeline_job)
+        with self._lock:
+            self._tasks[key] = (tasks, time())
+            self._tasks.move_to_end(key)
+            while len(self._tasks) > self.max_cached_jobs:
+                self._tasks.popitem(last=False)
+        return tasks
+
+    def job_tasks(self, pipes):
+        """ Prediction and relaxation tasks of jobs, fetched concurrently when not cached"""
+        keys = [(pipe.name, pipe.state.name) for pipe in pipes]
+        tasks = {key: self._cached_tasks(key) for key in keys}
+        missing = [key for key in keys if tasks[key] is None]
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for key, job_tasks in zip(missing, executor.map(self._fetch_tasks, missing)):
+                    tasks[key] = job_tasks
+        return tasks
+
+    def rows(self, filters=None):
+        """ Dashboard rows of the jobs, one per prediction of jobs that are not running"""
+        filters = {k: v for k, v in (filters or {}).items() if k in FILTERS and v}
+
+        def matches(p_data):
+            return all(str(p_data[k]).lower() == str(v).lower() for k, v in filters.items())
+
+        pipes = []
+        for pipe in self.list_jobs():
+            labels = pipe.labels
+            job_data = {
+                "run_tag": labels.get('run_tag', 'NA'),
+                "experiment_id": labels.get('experiment_id', 'NA'),
+                "sequence": labels.get('sequence_id', 'NA'),
+                "status": pipe.state.name.split("_")[-1],
+                "user": labels.get('user', 'NA'),
+            }
+            if matches(job_data):
+                pipes.append((pipe, job_data))
+        tasks = self.job_tasks(
+            [pipe for pipe, job_data in pipes if job_data["status"] != "RUNNING"])
+
+        running_pp = []
+        for pipe, job_data in pipes:
+            p_data = dict(
+                job_data,
+                duration=format_duration(pipe),
+                url_link=formatUrlLink(pipe.name, self.region, self.project_id),
+                url_all_structures=formatUrlAllStructures(
+                    pipe.name, self.bucket_name, job_data["experiment_id"], self.project_number),
+            )
+            # Extract each prediction and its associated relaxation tasks
+            if job_data["status"] != "RUNNING":
+                for task in tasks[(pipe.name, pipe.state.name)]:
+                    running_pp.append(dict(
+                        p_data,
+                        predict_uri=task["predict_uri"],
+                        relax_uri=task["relax_uri"],
+                        ranking_confidence=task["ranking_confidence"],
+                        create_time=0 if pipe.create_time is None else pipe.create_time,
+                    ))
+            else:
+                running_pp.append(dict(
+                    p_data, predict_uri="NA", relax_uri="NA", ranking_confidence="NA"))
+        return running_pp
+
+    def page(self, filters=None, offset=0, limit=None):
+        """ A page of the filtered dashboard rows, with the number of filtered rows"""
+        rows = self.rows(filters)
+        end = None if limit is None else offset + limit
+        return rows[offset:end], len(rows)
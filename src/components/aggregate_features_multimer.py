@@ -20,9 +20,21 @@ def aggregate_features_multimer(
     is_homomer: str,
     maxseq: int,
     skip_msa: str = 'false',
-    n_cpu: int = 8,
-):
-    """Conditionally aggregates MSAs and template features based on homomer status."""
+    n_cpu: int = 0,
+    uniprot_num_shards: int = 0,
+    uniprot_prefilter_max_candidates: int = 0,
+    defer_templates: str = 'false',
+) -> dict:
+    """Conditionally aggregates MSAs and template features based on homomer status.
+
+    With defer_templates, template_features is ignored and the templates are
+    left to batch_hmmsearch, which searches them for all the chains at once:
+    the features are written to features_without_templates.pkl instead of
+    features.pkl, and the uniref90 MSA (msa1) is recorded in their metadata.
+
+    Returns the chain ID, the features URI and the template MSA of deferred
+    features, for batch_hmmsearch to collect.
+    """
     import logging
     import time
     import os
@@ -35,6 +47,7 @@ def aggregate_features_multimer(
     from alphafold.data import msa_pairing
     from alphafold_utils import aggregate
     from alphafold_utils import run_jackhmmer
+    from alphafold_utils import available_cpus
 
     from alphafold.data.pipeline import make_sequence_features, make_msa_features
     from alphafold.data.parsers import Msa
@@ -148,7 +161,8 @@ def aggregate_features_multimer(
             model_features = aggregate(
                 sequence_path=sequence.path,
                 msa_paths=msa_paths,
-                template_features_path=template_features.path,
+                template_features_path=(
+                    '' if defer_templates == 'true' else template_features.path),
                 output_features_path=local_features_path
             )
 
@@ -162,8 +176,10 @@ def aggregate_features_multimer(
                         input_path=sequence.path,
                         database_path=database_path,
                         msa_path=uniprot_msa.path,
-                        n_cpu=n_cpu,
-                        maxseq=maxseq
+                        n_cpu=n_cpu or available_cpus(),
+                        maxseq=maxseq,
+                        num_shards=uniprot_num_shards,
+                        prefilter_max_candidates=uniprot_prefilter_max_candidates
                     )
 
                     all_seq_features = pipeline.make_msa_features([msa])
@@ -187,7 +203,12 @@ def aggregate_features_multimer(
 
         # Parse bucket name and blob path from features path
         bucket_name = chain_path.replace('gs://', '').split('/')[0]
-        blob_path = '/'.join(chain_path.replace('gs://', '').split('/')[1:]) + '/features.pkl'
+        # Deferred features are completed by batch_hmmsearch, so that the
+        # feature cache only ever holds features with templates
+        features_name = (
+            'features_without_templates.pkl' if defer_templates == 'true'
+            else 'features.pkl')
+        blob_path = '/'.join(chain_path.replace('gs://', '').split('/')[1:]) + '/' + features_name
         
         # Upload to GCS
         storage_client = storage.Client()
@@ -222,9 +243,20 @@ def aggregate_features_multimer(
         features.metadata['final_dedup_msa_size'] = int(
             model_features['num_alignments'][0]
         )
-        features.metadata['total_num_templates'] = int(
-            model_features['template_domain_names'].shape[0]
-        )
+        if 'template_domain_names' in model_features:
+            features.metadata['total_num_templates'] = int(
+                model_features['template_domain_names'].shape[0]
+            )
+        else:
+            features.metadata['template_msa_uri'] = msa1.uri
+            features.metadata['template_msa_format'] = msa1.metadata['data_format']
 
     t1 = time.time()
     logging.info(f'Feature aggregation completed for chain {chain_id}. Elapsed time: {t1-t0}')
+
+    return {
+        'chain_id': chain_id,
+        'features_uri': features.uri,
+        'template_msa_uri': features.metadata.get('template_msa_uri', ''),
+        'template_msa_format': features.metadata.get('template_msa_format', ''),
+    }
@@ -14,14 +14,25 @@
 
 """Utility functions that encapsulate AlphaFold inference components."""
 
+import collections
+import concurrent.futures
+import contextlib
+import fcntl
+import functools
 import glob
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
 import pickle
+import resource
 import shutil
+import tempfile
 import time
-from typing import Dict, List, Mapping, Sequence, Tuple
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
 
+from alphafold.common import confidence
 from alphafold.common import protein
 from alphafold.common import residue_constants
 from alphafold.data import parsers
@@ -37,10 +48,17 @@ from alphafold.data.tools import jackhmmer
 from alphafold.model import config
 from alphafold.model import data
 from alphafold.model import model
+from alphafold.model.tf import shape_placeholders
 from alphafold.relax import relax
 
 
+import jax
 import numpy as np
+from scipy import spatial
+
+import kmer_prefilter
+import prediction_io
+import search_daemon
 
 
 JACKHMMER_BINARY_PATH = shutil.which('jackhmmer')
@@ -52,6 +70,74 @@ HMMBUILD_BINARY_PATH = shutil.which('hmmbuild')
 
 MAX_TEMPLATE_HITS = 20
 
+NUM_RES = shape_placeholders.NUM_RES
+NUM_MSA_SEQ = shape_placeholders.NUM_MSA_SEQ
+
+# Shapes of the multimer model inputs. The monomer shapes come from
+# `config.data.eval.feat` of the model config instead. Templates are not
+# padded, as the multimer template embedding averages over them.
+MULTIMER_FEATURE_SHAPES = {
+    'aatype': [NUM_RES],
+    'all_atom_mask': [NUM_RES, None],
+    'all_atom_positions': [NUM_RES, None, None],
+    'asym_id': [NUM_RES],
+    'bert_mask': [NUM_MSA_SEQ, NUM_RES],
+    'cluster_bias_mask': [NUM_MSA_SEQ],
+    'deletion_matrix': [NUM_MSA_SEQ, NUM_RES],
+    'deletion_mean': [NUM_RES],
+    'entity_id': [NUM_RES],
+    'entity_mask': [NUM_RES],
+    'msa': [NUM_MSA_SEQ, NUM_RES],
+    'msa_mask': [NUM_MSA_SEQ, NUM_RES],
+    'residue_index': [NUM_RES],
+    'seq_mask': [NUM_RES],
+    'sym_id': [NUM_RES],
+    'template_aatype': [None, NUM_RES],
+    'template_all_atom_mask': [None, NUM_RES, None],
+    'template_all_atom_positions': [None, NUM_RES, None, None],
+}
+
+# Residue axes of the model outputs, used to trim bucket padding. A '*'
+# matches any output of a head.
+PREDICTION_RESIDUE_AXES = {
+    ('distogram', 'logits'): (0, 1),
+    ('experimentally_resolved', 'logits'): (0,),
+    ('masked_msa', 'logits'): (1,),
+    ('predicted_lddt', 'logits'): (0,),
+    ('predicted_aligned_error', 'logits'): (0, 1),
+    ('predicted_aligned_error', 'asym_id'): (0,),
+    ('structure_module', 'final_atom_mask'): (0,),
+    ('structure_module', 'final_atom_positions'): (0,),
+    ('structure_module', 'sidechains', '*'): (1,),
+    ('structure_module', 'traj'): (1,),
+    ('representations', 'msa'): (1,),
+    ('representations', 'msa_first_row'): (0,),
+    ('representations', 'pair'): (0, 1),
+    ('representations', 'single'): (0,),
+    ('representations', 'structure_module'): (0,),
+    ('plddt',): (0,),
+    ('predicted_aligned_error',): (0, 1),
+    ('aligned_confidence_probs',): (0, 1),
+}
+
+# Raw prediction output policies. 'full' pickles the whole prediction
+# result, 'slim' keeps only the selected outputs in a columnar .npz file
+# with one array per output.
+OUTPUT_POLICIES = ('full', 'slim')
+
+# Outputs kept by the 'slim' policy, nested outputs are joined with '/'.
+SLIM_PREDICTION_OUTPUTS = (
+    'plddt',
+    'predicted_aligned_error',
+    'max_predicted_aligned_error',
+    'ptm',
+    'iptm',
+    'ranking_confidence',
+    'num_recycles',
+    'structure_module/final_atom_positions',
+    'structure_module/final_atom_mask',
+)
+
 
 def _load_features(features_path: str) -> Dict[str, str]:
     """Loads pickeled features."""
@@ -60,6 +146,55 @@ def _load_features(features_path: str) -> Dict[str, str]:
     return features
 
 
+def slim_prediction_result(
+    prediction_result: Mapping[str, Any],
+    output_names: Sequence[str] = SLIM_PREDICTION_OUTPUTS,
+    half_precision: bool = False,
+) -> Dict[str, np.ndarray]:
+    """Keeps the selected outputs of a prediction result.
+
+    Returns the outputs keyed by their '/'-joined path. Outputs the model
+    does not produce, such as ipTM for monomers, are skipped. With
+    half_precision, floating point arrays are stored as float16, while
+    scalar confidences keep their precision.
+    """
+    outputs = {}
+    for name in output_names or SLIM_PREDICTION_OUTPUTS:
+        value = prediction_result
+        for key in name.split('/'):
+            if not isinstance(value, Mapping) or key not in value:
+                value = None
+                break
+            value = value[key]
+        if value is None:
+            continue
+        value = np.asarray(value)
+        if half_precision and value.ndim and np.issubdtype(
+                value.dtype, np.floating):
+            value = value.astype(np.float16)
+        outputs[name] = value
+    return outputs
+
+
+def save_prediction_result(
+    prediction_result: Mapping[str, Any],
+    prediction_result_path: str,
+    output_policy: str = 'full',
+    output_names: Sequence[str] = SLIM_PREDICTION_OUTPUTS,
+    half_precision: bool = False,
+):
+    """Saves a prediction result according to the output policy."""
+    if output_policy not in OUTPUT_POLICIES:
+        raise ValueError(f'Unsupported output policy: {output_policy}')
+
+    with open(prediction_result_path, 'wb') as f:
+        if output_policy == 'slim':
+            np.savez(f, **slim_prediction_result(
+                prediction_result, output_names, half_precision))
+        else:
+            pickle.dump(prediction_result, f, protocol=4)
+
+
 def _read_msa(msa_path: str, msa_format: str) -> str:
     """Reads and parses an MSA file."""
     if os.path.exists(msa_path):
@@ -92,6 +227,532 @@ def _read_template_features(template_features_path) -> Dict[str, str]:
     return template_features
 
 
+def _bucket_size(size: int, buckets: Sequence[int]) -> int:
+    """Returns the smallest bucket that fits size, or size if none does."""
+    for bucket in sorted(int(bucket) for bucket in buckets):
+        if size <= bucket:
+            return bucket
+    if buckets:
+        logging.warning(
+            f'Size {size} exceeds the largest bucket, it will not be padded.')
+    return size
+
+
+def _pad_to_buckets(
+    processed_feature_dict: Mapping[str, np.ndarray],
+    model_runner: model.RunModel,
+    residue_buckets: Sequence[int],
+    msa_buckets: Sequence[int],
+) -> Tuple[Dict[str, np.ndarray], int]:
+    """Zero-pads processed features up to the configured bucket sizes.
+
+    Padded residues and MSA rows get a zero mask, so the model ignores them.
+    Templates are not padded: the multimer template embedding averages over
+    the templates, so padded ones would change the predictions. The monomer
+    input pipeline already pads MSA rows and templates to the fixed sizes of
+    the model config, so only residues are padded for monomers.
+    """
+    if model_runner.multimer_mode:
+        feature_shapes = MULTIMER_FEATURE_SHAPES
+        leading_dims = 0
+        sizes = {
+            NUM_RES: processed_feature_dict['aatype'].shape[0],
+            NUM_MSA_SEQ: processed_feature_dict['msa'].shape[0],
+        }
+    else:
+        feature_shapes = model_runner.config.data.eval.feat
+        leading_dims = 1  # Ensemble dimension.
+        sizes = {NUM_RES: processed_feature_dict['aatype'].shape[1]}
+
+    buckets = {
+        NUM_RES: residue_buckets,
+        NUM_MSA_SEQ: msa_buckets,
+    }
+    padded_sizes = {
+        placeholder: _bucket_size(size, buckets[placeholder])
+        for placeholder, size in sizes.items()}
+    logging.info('Padding features from %s to %s', sizes, padded_sizes)
+
+    padded_feature_dict = {}
+    for name, value in processed_feature_dict.items():
+        shape = feature_shapes.get(name)
+        if shape is None or not hasattr(value, 'shape'):
+            padded_feature_dict[name] = value
+            continue
+        pad_width = [(0, 0)] * len(value.shape)
+        for axis, placeholder in enumerate(shape, start=leading_dims):
+            if placeholder in padded_sizes and axis < len(value.shape):
+                pad_width[axis] = (
+                    0, padded_sizes[placeholder] - value.shape[axis])
+        padded_feature_dict[name] = np.pad(value, pad_width)
+
+    return padded_feature_dict, sizes[NUM_RES]
+
+
+def _trim_prediction_result(
+    prediction_result: Mapping[str, np.ndarray],
+    processed_feature_dict: Mapping[str, np.ndarray],
+    model_runner: model.RunModel,
+    num_res: int,
+) -> Dict[str, np.ndarray]:
+    """Removes padded residues from the outputs and recomputes confidences.
+
+    pTM, ipTM and the ranking confidence average over all residues, so they
+    are recomputed on the trimmed outputs to match an unpadded prediction.
+    """
+    def trim(value, path):
+        if isinstance(value, Mapping):
+            return {key: trim(item, path + (key,))
+                    for key, item in value.items()}
+        axes = PREDICTION_RESIDUE_AXES.get(
+            path, PREDICTION_RESIDUE_AXES.get(path[:-1] + ('*',)))
+        if not axes:
+            return value
+        index = [slice(None)] * np.ndim(value)
+        for axis in axes:
+            index[axis] = slice(0, num_res)
+        return np.asarray(value)[tuple(index)]
+
+    result = trim(prediction_result, ())
+
+    if 'aligned_confidence_probs' in result:
+        pae_config = model_runner.config.model.heads.predicted_aligned_error
+        breaks = np.linspace(
+            0., pae_config.max_error_bin, pae_config.num_bins - 1)
+        # The logits are not returned, the log-probabilities are equivalent.
+        logits = np.log(np.maximum(result['aligned_confidence_probs'], 1e-30))
+        result['ptm'] = confidence.predicted_tm_score(
+            logits=logits, breaks=breaks)
+        if model_runner.multimer_mode:
+            result['iptm'] = confidence.predicted_tm_score(
+                logits=logits,
+                breaks=breaks,
+                asym_id=np.asarray(
+                    processed_feature_dict['asym_id'])[:num_res],
+                interface=True)
+            result['ranking_confidence'] = (
+                0.8 * result['iptm'] + 0.2 * result['ptm'])
+    if not model_runner.multimer_mode:
+        result['ranking_confidence'] = np.mean(result['plddt'])
+
+    return result
+
+
+def _compile_model(
+    model_runner: model.RunModel,
+    processed_feature_dict: Mapping[str, np.ndarray],
+    random_seed: int,
+) -> Any:
+    """Returns the model compiled ahead of time for the shapes of the features.
+
+    The executables are kept on the model runner by input shapes, so a
+    runner reused across predictions (see ModelRunnerCache) compiles each
+    shape once.
+    """
+    model_runner.init_params(processed_feature_dict)
+    shapes = tuple(sorted(
+        (name, np.shape(value), np.asarray(value).dtype.str)
+        for name, value in processed_feature_dict.items()))
+    executables = model_runner.__dict__.setdefault('_compiled_apply', {})
+    if shapes not in executables:
+        executables[shapes] = model_runner.apply.lower(
+            model_runner.params,
+            jax.random.PRNGKey(random_seed),
+            processed_feature_dict).compile()
+    return executables[shapes]
+
+
+def _run_model(
+    model_runner: model.RunModel,
+    processed_feature_dict: Mapping[str, np.ndarray],
+    random_seed: int,
+    residue_buckets: Sequence[int] = (),
+    msa_buckets: Sequence[int] = (),
+) -> Tuple[Mapping[str, np.ndarray], float]:
+    """Runs the model, optionally padding the inputs to bucket sizes.
+
+    Inputs padded to the same buckets share one compiled executable. Returns
+    the prediction result and the predict time, which leaves out compiling
+    the model.
+    """
+    padded = bool(residue_buckets or msa_buckets)
+    if padded:
+        feature_dict, num_res = _pad_to_buckets(
+            processed_feature_dict=processed_feature_dict,
+            model_runner=model_runner,
+            residue_buckets=residue_buckets,
+            msa_buckets=msa_buckets)
+    else:
+        feature_dict = processed_feature_dict
+
+    # predict runs the executable compiled ahead of time in place of the
+    # jitted apply, so that compilation is not timed.
+    compiled_apply = _compile_model(model_runner, feature_dict, random_seed)
+    jitted_apply = model_runner.apply
+    model_runner.apply = compiled_apply
+    try:
+        t_0 = time.time()
+        prediction_result = model_runner.predict(
+            feature_dict, random_seed=random_seed)
+        predict_time = time.time() - t_0
+    finally:
+        model_runner.apply = jitted_apply
+
+    if padded:
+        prediction_result = _trim_prediction_result(
+            prediction_result=prediction_result,
+            processed_feature_dict=processed_feature_dict,
+            model_runner=model_runner,
+            num_res=num_res)
+    return prediction_result, predict_time
+
+
+def _configure_recycling(
+    model_config: Any,
+    run_multimer_system: bool,
+    max_recycles: int = -1,
+    recycle_early_stop_tolerance: Optional[float] = None,
+):
+    """Overrides the recycling settings of a model config.
+
+    A negative max_recycles or a None tolerance keeps the model config
+    value. Only the multimer model stops recycling early, once the pairwise
+    distances change by less than the tolerance between recycles.
+    """
+    if max_recycles is not None and int(max_recycles) >= 0:
+        model_config.model.num_recycle = int(max_recycles)
+        if not run_multimer_system:
+            model_config.data.common.num_recycle = int(max_recycles)
+    if recycle_early_stop_tolerance is not None:
+        if run_multimer_system:
+            model_config.model.recycle_early_stop_tolerance = float(
+                recycle_early_stop_tolerance)
+        else:
+            logging.info('Recycling early stop is only supported by '
+                         'multimer models, ignoring the tolerance.')
+
+
+def _recycling_metadata(
+    prediction_result: Mapping[str, Any],
+    model_config: Any,
+    predict_time: Optional[float] = None,
+) -> Dict[str, Any]:
+    """Returns the executed and maximum recycles of a prediction.
+
+    The time saved by stopping early is estimated from the predict time,
+    without compilation, assuming all iterations (the initial one and each
+    recycle) cost the same.
+    """
+    max_recycles = int(model_config.model.num_recycle)
+    num_recycles = int(prediction_result.get('num_recycles', max_recycles))
+    metadata = {
+        'num_recycles': num_recycles,
+        'max_recycles': max_recycles,
+    }
+    if predict_time is not None:
+        metadata['recycle_time_saved'] = (
+            predict_time * (max_recycles - num_recycles) / (num_recycles + 1))
+    return metadata
+
+
+# Activation sizes used to estimate the peak memory of a prediction.
+PAIR_CHANNELS = 128
+MSA_CHANNELS = 256
+EXTRA_MSA_CHANNELS = 64
+TEMPLATE_PAIR_CHANNELS = 64
+MSA_ROW_ATTENTION_HEADS = 8
+TRIANGLE_ATTENTION_HEADS = 4
+# Live copies of the MSA and pair activations at the peak (residual,
+# normalized input, projections).
+ACTIVATION_COPIES = 4
+# Parameters, XLA workspace and allocator overhead.
+BASE_MEMORY_BYTES = 3 << 30
+
+# Subbatch sizes to choose from, largest (fastest) first.
+SUBBATCH_SIZES = (64, 32, 16, 8, 4)
+# Share of the accelerator memory the planned peak may use.
+MEMORY_HEADROOM = 0.85
+
+
+def estimate_peak_memory(
+    num_res: int,
+    num_msa: int,
+    num_extra_msa: int,
+    num_templates: int,
+    subbatch_size: int,
+) -> int:
+    """Estimates the peak accelerator memory of a prediction in bytes.
+
+    The estimate covers the live MSA, extra MSA and pair activations, the
+    template pair stack and the attention logits of one subbatch, the
+    largest transient buffers of the Evoformer. It is a heuristic meant for
+    planning, not an exact bound.
+    """
+    bytes_per_value = 4
+    pair = num_res * num_res * PAIR_CHANNELS
+    msa = num_msa * num_res * MSA_CHANNELS
+    extra_msa = num_extra_msa * num_res * EXTRA_MSA_CHANNELS
+    templates = num_templates * num_res * num_res * TEMPLATE_PAIR_CHANNELS
+    attention = subbatch_size * num_res * num_res * max(
+        MSA_ROW_ATTENTION_HEADS, TRIANGLE_ATTENTION_HEADS)
+    activations = ACTIVATION_COPIES * (pair + msa + extra_msa)
+    return BASE_MEMORY_BYTES + bytes_per_value * (
+        activations + templates + 2 * attention)
+
+
+def _feature_shapes(
+    features: Mapping[str, np.ndarray],
+    model_config: Any,
+    run_multimer_system: bool,
+) -> Dict[str, int]:
+    """Returns the input sizes the model runs on for raw features."""
+    num_res = int(np.shape(features['aatype'])[0])
+    msa_rows = int(np.shape(features['msa'])[0]) if 'msa' in features else 1
+    num_templates = int(np.shape(features['template_aatype'])[0]) if (
+        'template_aatype' in features) else 0
+    if run_multimer_system:
+        evoformer_config = model_config.model.embeddings_and_evoformer
+        max_msa = evoformer_config.num_msa
+        max_extra_msa = evoformer_config.num_extra_msa
+    else:
+        max_msa = model_config.data.eval.max_msa_clusters
+        max_extra_msa = model_config.data.common.max_extra_msa
+    num_msa = min(msa_rows, max_msa)
+    return {
+        'num_res': num_res,
+        'num_msa_rows': msa_rows,
+        'num_msa': num_msa,
+        'num_extra_msa': min(msa_rows - num_msa, max_extra_msa),
+        'num_templates': min(num_templates, 4),
+        'num_chains': len(np.unique(features['asym_id'])) if (
+            'asym_id' in features) else 1,
+    }
+
+
+def plan_memory(
+    features: Mapping[str, np.ndarray],
+    model_config: Any,
+    run_multimer_system: bool,
+    accelerator_memory_gb: float,
+    machine_tiers: Sequence[Mapping[str, Any]] = (),
+) -> Dict[str, Any]:
+    """Plans the accelerator memory of a prediction from its feature shapes.
+
+    Chooses the largest attention subbatch size whose estimated peak fits
+    the accelerator. If even the smallest does not fit, the plan relies on
+    unified memory with a memory fraction above 1, which spills to host
+    memory. machine_tiers, each with a machine_type, accelerator_type and
+    accelerator_memory_gb, are searched for the smallest accelerator that
+    fits the prediction without spilling.
+    """
+    shapes = _feature_shapes(features, model_config, run_multimer_system)
+    usable_bytes = accelerator_memory_gb * (1 << 30) * MEMORY_HEADROOM
+
+    def peak(subbatch_size):
+        return estimate_peak_memory(
+            num_res=shapes['num_res'],
+            num_msa=shapes['num_msa'],
+            num_extra_msa=shapes['num_extra_msa'],
+            num_templates=shapes['num_templates'],
+            subbatch_size=subbatch_size)
+
+    subbatch_size = next(
+        (size for size in SUBBATCH_SIZES if peak(size) <= usable_bytes),
+        SUBBATCH_SIZES[-1])
+    peak_bytes = peak(subbatch_size)
+    fits = peak_bytes <= usable_bytes
+    if fits:
+        mem_fraction = MEMORY_HEADROOM
+    else:
+        mem_fraction = np.ceil(
+            10 * peak_bytes / (accelerator_memory_gb * (1 << 30) *
+                               MEMORY_HEADROOM)) / 10
+
+    min_peak_gb = peak(SUBBATCH_SIZES[-1]) / (1 << 30)
+    tiers = sorted(machine_tiers,
+                   key=lambda tier: float(tier['accelerator_memory_gb']))
+    recommended_tier = next(
+        (tier for tier in tiers if min_peak_gb <= float(
+            tier['accelerator_memory_gb']) * MEMORY_HEADROOM),
+        tiers[-1] if tiers else {})
+
+    return {
+        **shapes,
+        'estimated_peak_memory_gb': round(peak_bytes / (1 << 30), 2),
+        'accelerator_memory_gb': accelerator_memory_gb,
+        'fits_accelerator': bool(fits),
+        'subbatch_size': int(subbatch_size),
+        'xla_python_client_mem_fraction': str(float(mem_fraction)),
+        'tf_force_unified_memory': '1',
+        'recommended_machine_type': recommended_tier.get('machine_type', ''),
+        'recommended_accelerator_type': recommended_tier.get(
+            'accelerator_type', ''),
+    }
+
+
+def _output_cache_options(
+    output_policy: str,
+    output_names: Sequence[str],
+    half_precision: bool,
+) -> Dict[str, Any]:
+    """Returns the output options that belong in the prediction cache key."""
+    if output_policy == 'full':
+        return {}
+    return {
+        'output_policy': output_policy,
+        'output_names': list(output_names or SLIM_PREDICTION_OUTPUTS),
+        'half_precision': bool(half_precision),
+    }
+
+
+def _file_digest(path: str) -> str:
+    """Returns the SHA-256 digest of a file."""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def prediction_cache_key(
+    features_digest: str,
+    model_name: str,
+    random_seed: int,
+    num_ensemble: int,
+    model_config: Any,
+    **options: Any,
+) -> str:
+    """Computes the content address of a prediction.
+
+    Any option that changes the prediction outputs, such as bucket padding,
+    must be passed in `options` so that it is part of the key.
+    """
+    config_hash = hashlib.sha256(
+        model_config.to_json_best_effort(sort_keys=True).encode()).hexdigest()
+    key = {
+        'features': features_digest,
+        'model_name': model_name,
+        'random_seed': int(random_seed),
+        'num_ensemble': int(num_ensemble),
+        'model_config': config_hash,
+        'options': options,
+    }
+    return hashlib.sha256(
+        json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+class PredictionCache:
+    """Content-addressed store of raw predictions and unrelaxed proteins.
+
+    Entries live under `<cache_dir>/<key>/`, where cache_dir is either a
+    gs:// prefix or a local (e.g. NFS) directory.
+    """
+
+    RAW_PREDICTION = 'raw_prediction.pkl'
+    UNRELAXED_PROTEIN = 'unrelaxed_protein.pdb'
+
+    def __init__(self, cache_dir: str):
+        self._cache_dir = cache_dir.rstrip('/')
+        self._bucket = None
+        if self._cache_dir.startswith('gs://'):
+            from google.cloud import storage
+            bucket_name, _, self._prefix = self._cache_dir[
+                len('gs://'):].partition('/')
+            self._bucket = storage.Client().bucket(bucket_name)
+
+    def _entry_path(self, key: str, name: str) -> str:
+        if self._bucket is not None:
+            return '/'.join(part for part in (self._prefix, key, name) if part)
+        return os.path.join(self._cache_dir, key, name)
+
+    def fetch(
+        self,
+        key: str,
+        raw_prediction_path: str,
+        unrelaxed_protein_path: str,
+    ) -> bool:
+        """Copies a cached prediction to the output paths if present."""
+        # The unrelaxed protein is stored last and marks a complete entry.
+        if self._bucket is not None:
+            marker_blob = self._bucket.blob(
+                self._entry_path(key, self.UNRELAXED_PROTEIN))
+            if not marker_blob.exists():
+                return False
+            self._bucket.blob(
+                self._entry_path(key, self.RAW_PREDICTION)
+            ).download_to_filename(raw_prediction_path)
+            marker_blob.download_to_filename(unrelaxed_protein_path)
+        else:
+            if not os.path.exists(
+                    self._entry_path(key, self.UNRELAXED_PROTEIN)):
+                return False
+            shutil.copyfile(self._entry_path(key, self.RAW_PREDICTION),
+                            raw_prediction_path)
+            shutil.copyfile(self._entry_path(key, self.UNRELAXED_PROTEIN),
+                            unrelaxed_protein_path)
+        logging.info(f'Prediction cache hit for {key}')
+        return True
+
+    def store(
+        self,
+        key: str,
+        raw_prediction_path: str,
+        unrelaxed_protein_path: str,
+    ):
+        """Adds a prediction to the cache."""
+        try:
+            if self._bucket is not None:
+                self._bucket.blob(
+                    self._entry_path(key, self.RAW_PREDICTION)
+                ).upload_from_filename(raw_prediction_path)
+                self._bucket.blob(
+                    self._entry_path(key, self.UNRELAXED_PROTEIN)
+                ).upload_from_filename(unrelaxed_protein_path)
+            else:
+                os.makedirs(os.path.join(self._cache_dir, key), exist_ok=True)
+                shutil.copyfile(raw_prediction_path,
+                                self._entry_path(key, self.RAW_PREDICTION))
+                shutil.copyfile(unrelaxed_protein_path,
+                                self._entry_path(key, self.UNRELAXED_PROTEIN))
+        except Exception as e:
+            logging.warning(f'Failed to store prediction {key} in cache: {e}')
+
+
+class ModelRunnerCache:
+    """Keeps model runners and their parameters warm across predictions.
+
+    Runners are keyed by model name, model config and parameters path. A
+    reused runner skips loading the parameters and keeps the executables
+    compiled for the input shapes it has seen.
+    """
+
+    def __init__(self):
+        self._params = {}
+        self._runners = {}
+
+    def get(
+        self,
+        model_name: str,
+        model_config: Any,
+        model_params_path: str,
+    ) -> Tuple[model.RunModel, bool]:
+        """Returns a model runner and whether it was already warm."""
+        config_hash = hashlib.sha256(
+            model_config.to_json_best_effort(sort_keys=True).encode()
+        ).hexdigest()
+        key = (model_name, config_hash, model_params_path)
+        if key in self._runners:
+            return self._runners[key], True
+
+        params_key = (model_name, model_params_path)
+        if params_key not in self._params:
+            self._params[params_key] = data.get_model_haiku_params(
+                model_name=model_name, data_dir=model_params_path)
+        self._runners[key] = model.RunModel(
+            model_config, self._params[params_key])
+        return self._runners[key], False
+
+
 def run_data_pipeline(
     fasta_path: str,
     run_multimer_system: bool,
@@ -109,8 +770,13 @@ def run_data_pipeline(
     msa_output_path: str,
     features_output_path: str,
     use_small_bfd: bool,
+    featurization_workers: int = 0,
 ) -> Dict[str, str]:
-    """Runs AlphaFold data pipeline."""
+    """Runs AlphaFold data pipeline.
+
+    Template hits are featurized by featurization_workers threads (see
+    ParallelHitFeaturizer).
+    """
     if run_multimer_system:
         template_searcher = hmmsearch.Hmmsearch(
             binary_path=HMMSEARCH_BINARY_PATH,
@@ -134,6 +800,8 @@ def run_data_pipeline(
             kalign_binary_path=KALIGN_BINARY_PATH,
             release_dates_path=None,
             obsolete_pdbs_path=obsolete_pdbs_path)
+    template_featurizer = ParallelHitFeaturizer(
+        template_featurizer, featurization_workers)
 
     monomer_data_pipeline = pipeline.DataPipeline(
         jackhmmer_binary_path=JACKHMMER_BINARY_PATH,
@@ -205,8 +873,31 @@ def predict(
     random_seed: int,
     raw_prediction_path: str,
     unrelaxed_protein_path: str,
-) -> Mapping[str, str]:
-    """Runs inference on an AlphaFold model."""
+    residue_buckets: Sequence[int] = (),
+    msa_buckets: Sequence[int] = (),
+    prediction_cache_dir: Optional[str] = None,
+    max_recycles: int = -1,
+    recycle_early_stop_tolerance: Optional[float] = None,
+    output_policy: str = 'full',
+    output_names: Sequence[str] = SLIM_PREDICTION_OUTPUTS,
+    half_precision: bool = False,
+    runner_cache: Optional['ModelRunnerCache'] = None,
+    subbatch_size: int = 0,
+) -> Tuple[Mapping[str, Any], Dict[str, Any]]:
+    """Runs inference on an AlphaFold model.
+
+    If prediction_cache_dir is set, a prediction with the same features,
+    model, seed and model config is restored from the cache without running
+    the model.
+
+    max_recycles and recycle_early_stop_tolerance override the recycling
+    settings of the model config (see _configure_recycling).
+    output_policy selects how the raw prediction is saved (see
+    save_prediction_result). With a runner_cache, model runners are reused
+    across calls by long-lived processes such as the prediction worker.
+    A positive subbatch_size overrides the attention subbatch size of the
+    model config (see plan_memory).
+    """
 
     random_seed = int(random_seed)
     
@@ -215,22 +906,61 @@ def predict(
         model_config.model.num_ensemble_eval = num_ensemble
     else:
         model_config.data.eval.num_ensemble_eval = num_ensemble
-
-    model_params = data.get_model_haiku_params(
-        model_name=model_name, data_dir=model_params_path)
-    model_runner = model.RunModel(model_config, model_params)
+    _configure_recycling(model_config, run_multimer_system,
+                         max_recycles, recycle_early_stop_tolerance)
+    if subbatch_size and int(subbatch_size) > 0:
+        model_config.model.global_config.subbatch_size = int(subbatch_size)
+
+    prediction_metadata = {}
+    if prediction_cache_dir:
+        prediction_cache = PredictionCache(prediction_cache_dir)
+        cache_key = prediction_cache_key(
+            features_digest=_file_digest(model_features_path),
+            model_name=model_name,
+            random_seed=random_seed,
+            num_ensemble=num_ensemble,
+            model_config=model_config,
+            residue_buckets=list(residue_buckets),
+            msa_buckets=list(msa_buckets),
+            **_output_cache_options(
+                output_policy, output_names, half_precision))
+        cache_hit = prediction_cache.fetch(
+            cache_key, raw_prediction_path, unrelaxed_protein_path)
+        prediction_metadata['cache_key'] = cache_key
+        prediction_metadata['cache_hit'] = cache_hit
+        if cache_hit:
+            prediction_result = prediction_io.load_prediction_result(
+                raw_prediction_path)
+            prediction_metadata.update(
+                _recycling_metadata(prediction_result, model_config))
+            return prediction_result, prediction_metadata
+
+    if runner_cache is not None:
+        model_runner, warm_runner = runner_cache.get(
+            model_name, model_config, model_params_path)
+        prediction_metadata['warm_runner'] = warm_runner
+    else:
+        model_params = data.get_model_haiku_params(
+            model_name=model_name, data_dir=model_params_path)
+        model_runner = model.RunModel(model_config, model_params)
 
     features = _load_features(model_features_path)
     processed_feature_dict = model_runner.process_features(
         raw_features=features,
         random_seed=random_seed)
 
-    prediction_result = model_runner.predict(
-        feat=processed_feature_dict,
-        random_seed=random_seed)
+    prediction_result, predict_time = _run_model(
+        model_runner=model_runner,
+        processed_feature_dict=processed_feature_dict,
+        random_seed=random_seed,
+        residue_buckets=residue_buckets,
+        msa_buckets=msa_buckets)
+    prediction_metadata.update(_recycling_metadata(
+        prediction_result, model_config, predict_time))
 
-    with open(raw_prediction_path, 'wb') as f:
-        pickle.dump(prediction_result, f, protocol=4)
+    save_prediction_result(
+        prediction_result, raw_prediction_path,
+        output_policy, output_names, half_precision)
 
     plddt = prediction_result['plddt']
     plddt_b_factors = np.repeat(
@@ -244,7 +974,169 @@ def predict(
     with open(unrelaxed_protein_path, 'w') as f:
         f.write(unrelaxed_pdbs)
 
-    return prediction_result
+    if prediction_cache_dir:
+        prediction_cache.store(
+            cache_key, raw_prediction_path, unrelaxed_protein_path)
+
+    return prediction_result, prediction_metadata
+
+
+# Tolerances of the structural violation pre-check, as in the violation
+# losses of the AlphaFold model.
+VIOLATION_OVERLAP_TOLERANCE = 1.5
+VIOLATION_BOND_LENGTH_TOLERANCE_FACTOR = 12.0
+
+
+@functools.lru_cache(maxsize=None)
+def _restype_atom14_to_atom37() -> np.ndarray:
+    """Returns the atom37 index of each atom14 atom per residue type.
+
+    Atoms that a residue type does not have are -1.
+    """
+    mapping = np.full([residue_constants.restype_num + 1, 14], -1, np.int32)
+    for restype, restype_letter in enumerate(residue_constants.restypes):
+        atom_names = residue_constants.restype_name_to_atom14_names[
+            residue_constants.restype_1to3[restype_letter]]
+        for atom14_index, atom_name in enumerate(atom_names):
+            if atom_name:
+                mapping[restype, atom14_index] = residue_constants.atom_order[
+                    atom_name]
+    return mapping
+
+
+@functools.lru_cache(maxsize=None)
+def _atom14_dists_bounds(
+    overlap_tolerance: float,
+    bond_length_tolerance_factor: float,
+) -> Dict[str, np.ndarray]:
+    return residue_constants.make_atom14_dists_bounds(
+        overlap_tolerance=overlap_tolerance,
+        bond_length_tolerance_factor=bond_length_tolerance_factor)
+
+
+def structure_violations(
+    prot: protein.Protein,
+    overlap_tolerance: float = VIOLATION_OVERLAP_TOLERANCE,
+    bond_length_tolerance_factor: float = VIOLATION_BOND_LENGTH_TOLERANCE_FACTOR,
+) -> Dict[str, int]:
+    """Counts the structural violations of a structure.
+
+    Checks the bonds and clashes within residues against the bounds of
+    residue_constants.make_atom14_dists_bounds, the lengths of the peptide
+    bonds and the clashes between residues, with the tolerances of the
+    violation losses of the model. Returns the number of violating atom
+    pairs of each check and their total as num_violations.
+    """
+    aatype = prot.aatype
+    atom_positions = prot.atom_positions
+    atom_mask = prot.atom_mask > 0.5
+    residue_index = prot.residue_index
+    chain_index = getattr(prot, 'chain_index', None)
+    if chain_index is None:
+        chain_index = np.zeros_like(residue_index)
+
+    # Bonds and clashes within residues, in the atom14 representation of the
+    # distance bounds.
+    atom14_to_atom37 = _restype_atom14_to_atom37()[aatype]
+    atom37_index = np.maximum(atom14_to_atom37, 0)
+    atom14_positions = np.take_along_axis(
+        atom_positions, atom37_index[..., None], axis=1)
+    atom14_mask = np.take_along_axis(atom_mask, atom37_index, axis=1) & (
+        atom14_to_atom37 >= 0)
+    bounds = _atom14_dists_bounds(
+        overlap_tolerance, bond_length_tolerance_factor)
+    lower_bound = bounds['lower_bound'][aatype]
+    upper_bound = bounds['upper_bound'][aatype]
+    dists = np.linalg.norm(
+        atom14_positions[:, :, None] - atom14_positions[:, None, :], axis=-1)
+    pair_mask = (atom14_mask[:, :, None] & atom14_mask[:, None, :] &
+                 (upper_bound > 0))
+    within_residue = pair_mask & ((dists < lower_bound) | (dists > upper_bound))
+    within_residue_violations = int(np.triu(within_residue, 1).sum())
+
+    # Peptide bonds between consecutive residues of a chain.
+    c_index = residue_constants.atom_order['C']
+    n_index = residue_constants.atom_order['N']
+    bonded = ((residue_index[1:] - residue_index[:-1] == 1) &
+              (chain_index[1:] == chain_index[:-1]) &
+              atom_mask[:-1, c_index] & atom_mask[1:, n_index])
+    bond_lengths = np.linalg.norm(
+        atom_positions[:-1, c_index] - atom_positions[1:, n_index], axis=-1)
+    is_proline = aatype[1:] == residue_constants.restype_order['P']
+    ideal_lengths = np.where(
+        is_proline, residue_constants.between_res_bond_length_c_n[1],
+        residue_constants.between_res_bond_length_c_n[0])
+    stddevs = np.where(
+        is_proline, residue_constants.between_res_bond_length_stddev_c_n[1],
+        residue_constants.between_res_bond_length_stddev_c_n[0])
+    peptide_bond_violations = int(np.sum(
+        bonded & (np.abs(bond_lengths - ideal_lengths) >
+                  bond_length_tolerance_factor * stddevs)))
+
+    # Clashes between residues, among the atom pairs within the largest
+    # clash distance.
+    atom_radii = np.array([
+        residue_constants.van_der_waals_radius[atom_name[0]]
+        for atom_name in residue_constants.atom_types])
+    residues, atoms = np.nonzero(atom_mask)
+    coords = atom_positions[residues, atoms]
+    radii = atom_radii[atoms]
+    pairs = spatial.cKDTree(coords).query_pairs(
+        2 * atom_radii.max() - overlap_tolerance, output_type='ndarray')
+    first, second = pairs[:, 0], pairs[:, 1]
+    clashes = (residues[first] != residues[second]) & (
+        np.linalg.norm(coords[first] - coords[second], axis=-1) <
+        radii[first] + radii[second] - overlap_tolerance)
+    # Peptide bonds and disulfide bridges are not clashes.
+    lower = np.minimum(residues[first], residues[second])
+    upper = np.maximum(residues[first], residues[second])
+    lower_atom = np.where(residues[first] < residues[second],
+                          atoms[first], atoms[second])
+    upper_atom = np.where(residues[first] < residues[second],
+                          atoms[second], atoms[first])
+    if len(bonded):
+        peptide_bond = (upper - lower == 1) & (lower_atom == c_index) & (
+            upper_atom == n_index) & bonded[np.minimum(lower, len(bonded) - 1)]
+    else:
+        # A single residue has no peptide bonds.
+        peptide_bond = np.zeros(len(pairs), dtype=bool)
+    sg_index = residue_constants.atom_order['SG']
+    disulfide = (atoms[first] == sg_index) & (atoms[second] == sg_index)
+    between_residue_clashes = int(np.sum(clashes & ~peptide_bond & ~disulfide))
+
+    return {
+        'within_residue_violations': within_residue_violations,
+        'peptide_bond_violations': peptide_bond_violations,
+        'between_residue_clashes': between_residue_clashes,
+        'num_violations': (within_residue_violations + peptide_bond_violations
+                           + between_residue_clashes),
+    }
+
+
+def _relax_structure(
+    amber_relaxer: relax.AmberRelaxation,
+    unrelaxed_protein_pdb: str,
+    max_violations: int = -1,
+) -> Tuple[str, Dict[str, Any]]:
+    """Relaxes a structure unless it has at most max_violations violations.
+
+    A negative max_violations always relaxes. Skipped structures are
+    returned unchanged. Returns the PDB and the violation counts and relax
+    decision.
+    """
+    unrelaxed_structure = protein.from_pdb_string(unrelaxed_protein_pdb)
+    relax_metadata = {}
+    if max_violations >= 0:
+        relax_metadata.update(structure_violations(unrelaxed_structure))
+        if relax_metadata['num_violations'] <= max_violations:
+            logging.info('Skipping relaxation of a structure with %d violations',
+                         relax_metadata['num_violations'])
+            relax_metadata['relax_skipped'] = True
+            return unrelaxed_protein_pdb, relax_metadata
+
+    relaxed_protein_pdb, _, _ = amber_relaxer.process(prot=unrelaxed_structure)
+    relax_metadata['relax_skipped'] = False
+    return relaxed_protein_pdb, relax_metadata
 
 
 def relax_protein(
@@ -255,14 +1147,20 @@ def relax_protein(
     stiffness: float = 10.0,
     exclude_residues: List[str] = [],
     max_outer_iterations: int = 3,
-    use_gpu=False
-) -> Mapping[str, str]:
-    """Runs AMBER relaxation."""
+    use_gpu=False,
+    max_violations: int = -1,
+) -> Tuple[str, Dict[str, Any]]:
+    """Runs AMBER relaxation.
+
+    With max_violations >= 0, structures with at most max_violations
+    structural violations (see structure_violations) are copied through
+    instead of relaxed. Returns the relaxed PDB and the violation counts and
+    relax decision.
+    """
 
     with open(unrelaxed_protein_path, 'r') as f:
         unrelaxed_protein_pdb = f.read()
 
-    unrelaxed_structure = protein.from_pdb_string(unrelaxed_protein_pdb)
     amber_relaxer = relax.AmberRelaxation(
         max_iterations=max_iterations,
         tolerance=tolerance,
@@ -270,13 +1168,286 @@ def relax_protein(
         exclude_residues=exclude_residues,
         max_outer_iterations=max_outer_iterations,
         use_gpu=use_gpu)
-    relaxed_protein_pdb, _, _ = amber_relaxer.process(prot=unrelaxed_structure)
+    relaxed_protein_pdb, relax_metadata = _relax_structure(
+        amber_relaxer, unrelaxed_protein_pdb, max_violations)
 
     logging.info(f'Saving relaxed protein to {relaxed_protein_path}')
     with open(relaxed_protein_path, 'w') as f:
         f.write(relaxed_protein_pdb)
 
-    return relaxed_protein_pdb
+    return relaxed_protein_pdb, relax_metadata
+
+
+@functools.lru_cache(maxsize=None)
+def amber_force_field():
+    """Returns the amber99sb force field, parsed once per process.
+
+    The force field is not modified when systems are created from it, so the
+    relaxations of a process share it (see SharedForceFieldRelaxation).
+    """
+    from openmm import app as openmm_app
+
+    return openmm_app.ForceField('amber99sb.xml')
+
+
+class _SharedForceFieldApp:
+    """openmm.app, with the amber99sb force field loaded from a given one."""
+
+    def __init__(self, openmm_app, force_field):
+        self._openmm_app = openmm_app
+        self._force_field = force_field
+
+    def __getattr__(self, name: str):
+        return getattr(self._openmm_app, name)
+
+    def ForceField(self, *files):  # pylint: disable=invalid-name
+        if files == ('amber99sb.xml',):
+            return self._force_field
+        return self._openmm_app.ForceField(*files)
+
+
+class SharedForceFieldRelaxation(relax.AmberRelaxation):
+    """Amber relaxation with systems created from a given force field.
+
+    amber_minimize parses the amber99sb force field files for every
+    minimization attempt. This relaxer runs AmberRelaxation.process with
+    amber_minimize loading force_field, amber_force_field() for example,
+    instead; the relaxation itself is upstream's.
+    """
+
+    def __init__(self, *, force_field, **relax_options):
+        super().__init__(**relax_options)
+        self._force_field = force_field
+
+    def process(
+        self, *,
+        prot: protein.Protein
+    ) -> Tuple[str, Dict[str, Any], Sequence[float]]:
+        """Runs Amber relax on a prediction with the shared force field."""
+        from alphafold.relax import amber_minimize
+
+        openmm_app = getattr(amber_minimize, 'openmm_app', None)
+        if openmm_app is None:
+            # No force field to inject; relax with the one upstream loads.
+            return super().process(prot=prot)
+        amber_minimize.openmm_app = _SharedForceFieldApp(
+            openmm_app, self._force_field)
+        try:
+            return super().process(prot=prot)
+        finally:
+            amber_minimize.openmm_app = openmm_app
+
+
+# Accelerator memory settings that CPU relax workers must not inherit.
+ACCELERATOR_MEMORY_VARIABLES = (
+    'TF_FORCE_UNIFIED_MEMORY',
+    'XLA_PYTHON_CLIENT_MEM_FRACTION',
+    'XLA_PYTHON_CLIENT_PREALLOCATE',
+)
+
+
+def _init_cpu_relax_worker(openmm_cpu_threads: int):
+    """Keeps a CPU relax worker process off the accelerator.
+
+    Workers inherit the environment of their parent, including its
+    accelerator memory settings, and the violation metrics of a relaxation
+    run on the default jax backend. The worker is pinned to the jax CPU
+    backend before any backend is initialized, and OpenMM runs on its share
+    of the CPU cores.
+    """
+    os.environ['JAX_PLATFORMS'] = 'cpu'
+    for name in ACCELERATOR_MEMORY_VARIABLES:
+        os.environ.pop(name, None)
+    jax.config.update('jax_platforms', 'cpu')
+    os.environ['OPENMM_CPU_THREADS'] = str(openmm_cpu_threads)
+
+
+# Amber relaxer of a batch relaxation worker process, created once by
+# _init_batch_relax_worker.
+_batch_relaxer = None
+
+
+def _init_batch_relax_worker(
+    relax_options: Mapping[str, Any],
+    openmm_cpu_threads: int,
+):
+    """Creates the Amber relaxer of a batch relaxation worker process."""
+    global _batch_relaxer
+    _init_cpu_relax_worker(openmm_cpu_threads)
+    _batch_relaxer = SharedForceFieldRelaxation(
+        force_field=amber_force_field(), use_gpu=False, **relax_options)
+
+
+def _batch_relax_worker(
+    unrelaxed_protein_path: str,
+    relaxed_protein_path: str,
+    max_violations: int = -1,
+) -> Tuple[float, float, Dict[str, Any]]:
+    """Relaxes a structure with the relaxer of the worker process.
+
+    Returns the start and end times and the metadata of the relaxation.
+    """
+    t_0 = time.time()
+    with open(unrelaxed_protein_path, 'r') as f:
+        unrelaxed_protein_pdb = f.read()
+    relaxed_protein_pdb, relax_metadata = _relax_structure(
+        _batch_relaxer, unrelaxed_protein_pdb, max_violations)
+    with open(relaxed_protein_path, 'w') as f:
+        f.write(relaxed_protein_pdb)
+    return t_0, time.time(), relax_metadata
+
+
+def relax_proteins(
+    unrelaxed_protein_paths: Sequence[str],
+    relaxed_protein_paths: Sequence[str],
+    max_iterations: int = 0,
+    tolerance: float = 2.39,
+    stiffness: float = 10.0,
+    exclude_residues: List[str] = [],
+    max_outer_iterations: int = 3,
+    use_gpu: bool = False,
+    num_workers: int = 0,
+    max_violations: int = -1,
+) -> Tuple[Dict[str, float], Dict[str, Dict[str, Any]]]:
+    """Runs AMBER relaxation of a batch of structures.
+
+    On the CPU, the structures are relaxed in a pool of num_workers worker
+    processes (0 for one per CPU core), each sharing the CPU cores equally.
+    On the GPU, they are relaxed one after another in this process. The force
+    field is parsed once per process (see amber_force_field). Structures
+    with at most max_violations violations are copied through (see
+    relax_protein).
+
+    Returns the relaxation time and the relax metadata of each structure,
+    keyed by its unrelaxed protein path.
+    """
+    if len(unrelaxed_protein_paths) != len(relaxed_protein_paths):
+        raise ValueError('Expected one relaxed protein path per unrelaxed '
+                         'protein path')
+
+    relax_options = dict(
+        max_iterations=max_iterations,
+        tolerance=tolerance,
+        stiffness=stiffness,
+        exclude_residues=exclude_residues,
+        max_outer_iterations=max_outer_iterations)
+    timings = {}
+    relax_metadata = {}
+
+    if use_gpu:
+        amber_relaxer = SharedForceFieldRelaxation(
+            force_field=amber_force_field(), use_gpu=True, **relax_options)
+        for unrelaxed_protein_path, relaxed_protein_path in zip(
+                unrelaxed_protein_paths, relaxed_protein_paths):
+            t_0 = time.time()
+            with open(unrelaxed_protein_path, 'r') as f:
+                unrelaxed_protein_pdb = f.read()
+            relaxed_protein_pdb, relax_metadata[unrelaxed_protein_path] = (
+                _relax_structure(
+                    amber_relaxer, unrelaxed_protein_pdb, max_violations))
+            with open(relaxed_protein_path, 'w') as f:
+                f.write(relaxed_protein_pdb)
+            timings[unrelaxed_protein_path] = time.time() - t_0
+        return timings, relax_metadata
+
+    num_workers = min(num_workers or os.cpu_count(),
+                      max(1, len(unrelaxed_protein_paths)))
+    openmm_cpu_threads = max(1, os.cpu_count() // num_workers)
+    logging.info('Relaxing %d structures on %d workers',
+                 len(unrelaxed_protein_paths), num_workers)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_batch_relax_worker,
+            initargs=(relax_options, openmm_cpu_threads)) as relax_executor:
+        relax_futures = {
+            unrelaxed_protein_path: relax_executor.submit(
+                _batch_relax_worker, unrelaxed_protein_path,
+                relaxed_protein_path, max_violations)
+            for unrelaxed_protein_path, relaxed_protein_path in zip(
+                unrelaxed_protein_paths, relaxed_protein_paths)
+        }
+        for unrelaxed_protein_path, relax_future in relax_futures.items():
+            relax_start, relax_end, relax_metadata[unrelaxed_protein_path] = (
+                relax_future.result())
+            timings[unrelaxed_protein_path] = relax_end - relax_start
+
+    return timings, relax_metadata
+
+
+RELAX_POLICIES = ('all', 'best', 'top_k', 'none')
+
+
+def select_relax_targets(
+    ranking_confidences: Mapping[str, float],
+    relax_policy: str,
+    relax_top_k: int = 1,
+) -> List[str]:
+    """Selects the predictions to relax, best ranking confidence first."""
+    if relax_policy not in RELAX_POLICIES:
+        raise ValueError(f'Unsupported relax policy: {relax_policy}')
+
+    ranked = sorted(ranking_confidences,
+                    key=lambda name: float(ranking_confidences[name]),
+                    reverse=True)
+    if relax_policy == 'all':
+        return ranked
+    elif relax_policy == 'best':
+        return ranked[:1]
+    elif relax_policy == 'top_k':
+        return ranked[:relax_top_k]
+    return []
+
+
+def sampling_waves(prediction_runners: Sequence[Mapping[str, Any]]) -> List[List[Dict]]:
+    """Groups prediction runners into waves of one seed per model.
+
+    Wave i holds the runners with prediction index i, in the input order.
+    """
+    waves = {}
+    for runner in prediction_runners:
+        waves.setdefault(int(runner['prediction_index']), []).append(dict(runner))
+    return [waves[index] for index in sorted(waves)]
+
+
+def sampling_has_converged(
+    wave_confidences: Sequence[Sequence[float]],
+    plateau_tolerance: float,
+    min_waves: int = 2,
+) -> bool:
+    """Checks whether the top ranking confidence has plateaued.
+
+    Sampling has converged once at least min_waves waves completed and the
+    last wave improved the best ranking confidence so far by less than
+    plateau_tolerance (in units of ranking_confidence).
+    """
+    completed = [wave for wave in wave_confidences if len(wave)]
+    if len(completed) < max(min_waves, 2):
+        return False
+    best_before = max(float(c) for wave in completed[:-1] for c in wave)
+    best_after = max(best_before, max(float(c) for c in completed[-1]))
+    return best_after - best_before < plateau_tolerance
+
+
+def _relax_worker(
+    unrelaxed_pdb: str,
+    relaxed_protein_path: str,
+    relax_options: Mapping[str, Any],
+    max_violations: int = -1,
+) -> Tuple[float, float, Dict[str, Any]]:
+    """Relaxes a structure on the OpenMM CPU platform in a worker process.
+
+    Structures with at most max_violations violations are copied through
+    (see _relax_structure). Returns the start and end times and the metadata
+    of the relaxation.
+    """
+    t_0 = time.time()
+    amber_relaxer = relax.AmberRelaxation(use_gpu=False, **relax_options)
+    relaxed_pdb_str, relax_metadata = _relax_structure(
+        amber_relaxer, unrelaxed_pdb, max_violations)
+    with open(relaxed_protein_path, 'w') as f:
+        f.write(relaxed_pdb_str)
+    return t_0, time.time(), relax_metadata
 
 
 def predict_relax(
@@ -294,33 +1465,114 @@ def predict_relax(
     stiffness: float = 10.0,
     exclude_residues: List[str] = [],
     max_outer_iterations: int = 3,
-    use_gpu=True
-) -> Mapping[str, str]:
-    """Runs predictions and relaxations sequentially on all specified models."""
+    use_gpu=True,
+    residue_buckets: Sequence[int] = (),
+    msa_buckets: Sequence[int] = (),
+    prediction_cache_dir: Optional[str] = None,
+    relax_workers: int = 0,
+    relax_policy: str = 'all',
+    relax_top_k: int = 1,
+    adaptive_sampling: bool = False,
+    plateau_tolerance: float = 0.01,
+    max_predictions: int = 0,
+    max_recycles: int = -1,
+    recycle_early_stop_tolerance: Optional[float] = None,
+    output_policy: str = 'full',
+    output_names: Sequence[str] = SLIM_PREDICTION_OUTPUTS,
+    half_precision: bool = False,
+    subbatch_size: int = 0,
+    max_violations: int = -1,
+) -> Tuple[Mapping[str, float], Dict[str, float], Dict[str, Dict[str, Any]]]:
+    """Runs predictions and relaxations on all specified models.
+
+    Predictions found in the prediction cache are restored instead of rerun.
+    With relax_workers > 0, relaxations run on the CPU in a pool of worker
+    processes while the following predictions run on the accelerator.
+    Otherwise each prediction is relaxed before the next one starts.
+
+    relax_policy selects the predictions to relax (see select_relax_targets).
+    Apart from 'all', the selection needs every ranking confidence, so the
+    selected predictions are relaxed after the last prediction.
+
+    With adaptive_sampling, the predictions run in waves of one seed per
+    model and stop once the top ranking confidence has plateaued (see
+    sampling_has_converged) or max_predictions predictions ran (0 for no
+    budget).
+
+    max_recycles and recycle_early_stop_tolerance override the recycling
+    settings of the model config (see _configure_recycling). output_policy
+    selects how the raw predictions are saved (see save_prediction_result).
+    A positive subbatch_size overrides the attention subbatch size of the
+    model config (see plan_memory). Predictions with at most max_violations
+    structural violations are copied through instead of relaxed (see
+    relax_protein). Returns the ranking confidences, the timings and the
+    recycling and relax metadata of each prediction.
+    """
 
     model_names = set([runner['model_name'] for runner in prediction_runners])
-    runners = {}
+    model_configs = {}
     for model_name in model_names:
         model_config = config.model_config(model_name)
         if run_multimer_system:
             model_config.model.num_ensemble_eval = num_ensemble
         else:
             model_config.data.eval.num_ensemble = num_ensemble
-        model_params = data.get_model_haiku_params(
-            model_name=model_name, data_dir=model_params_path)
-        model_runner = model.RunModel(model_config, model_params)
-        runners[model_name] = model_runner
+        _configure_recycling(model_config, run_multimer_system,
+                             max_recycles, recycle_early_stop_tolerance)
+        if subbatch_size and int(subbatch_size) > 0:
+            model_config.model.global_config.subbatch_size = int(
+                subbatch_size)
+        model_configs[model_name] = model_config
+
+    # Model runners are created on first use, so that predictions restored
+    # from the cache do not load model parameters.
+    runners = {}
+
+    def get_model_runner(model_name):
+        if model_name not in runners:
+            model_params = data.get_model_haiku_params(
+                model_name=model_name, data_dir=model_params_path)
+            runners[model_name] = model.RunModel(
+                model_configs[model_name], model_params)
+        return runners[model_name]
+
+    if adaptive_sampling:
+        prediction_runners = [
+            runner for wave in sampling_waves(prediction_runners)
+            for runner in wave]
 
     model_runners = {}
     for runner in prediction_runners:
         prediction_name = f'{runner["model_name"]}_pred_{runner["prediction_index"]}'
         model_runners[prediction_name] = (
-            runners[runner['model_name']], runner['random_seed'])
+            runner['model_name'], runner['random_seed'],
+            runner['prediction_index'])
 
     logging.info('Have %d models: %s', len(model_runners),
                  list(model_runners.keys()))
 
-    if run_relax:
+    if relax_policy not in RELAX_POLICIES:
+        raise ValueError(f'Unsupported relax policy: {relax_policy}')
+    run_relax = run_relax and relax_policy != 'none'
+
+    amber_relaxer = None
+    relax_executor = None
+    if run_relax and relax_workers > 0:
+        # Workers are spawned rather than forked, as the parent holds the
+        # accelerator, and kept off it (see _init_cpu_relax_worker). Each
+        # worker gets an equal share of the CPU cores.
+        relax_executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=relax_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_cpu_relax_worker,
+            initargs=(max(1, os.cpu_count() // relax_workers),))
+        relax_options = dict(
+            max_iterations=max_iterations,
+            tolerance=tolerance,
+            stiffness=stiffness,
+            exclude_residues=exclude_residues,
+            max_outer_iterations=max_outer_iterations)
+    elif run_relax:
         amber_relaxer = relax.AmberRelaxation(
             max_iterations=max_iterations,
             tolerance=tolerance,
@@ -328,76 +1580,190 @@ def predict_relax(
             exclude_residues=exclude_residues,
             max_outer_iterations=max_outer_iterations,
             use_gpu=use_gpu)
-    else:
-        amber_relaxer = None
-
-    # Run the predictions
-    feature_dict = _load_features(model_features_path)
-    timings = {}
-    unrelaxed_pdbs = {}
-    relaxed_pdbs = {}
-    ranking_confidences = {}
-    for model_name, prediction_runner in model_runners.items():
-        logging.info('Running prediction %s', model_name)
-        t_0 = time.time()
-        model_random_seed = prediction_runner[1]
-        model_runner = prediction_runner[0]
-        processed_feature_dict = model_runner.process_features(
-            feature_dict, random_seed=model_random_seed)
-        timings[f'process_features_{model_name}'] = time.time() - t_0
 
-        t_0 = time.time()
-        prediction_result = model_runner.predict(processed_feature_dict,
-                                                 random_seed=model_random_seed)
-        t_diff = time.time() - t_0
-        timings[f'predict_and_compile_{model_name}'] = t_diff
-        logging.info(
-            'Total JAX model %s predict time (includes compilation time, see --benchmark): %.1fs',
-            model_name, t_diff)
-
-        plddt = prediction_result['plddt']
-        ranking_confidences[model_name] = prediction_result['ranking_confidence']
-
-        # Save the model outputs.
-        result_output_path = os.path.join(
-            raw_prediction_path, f'result_{model_name}.pkl')
-        with open(result_output_path, 'wb') as f:
-            pickle.dump(prediction_result, f, protocol=4)
-
-        # Add the predicted LDDT in the b-factor column.
-        # Note that higher predicted LDDT value means higher model confidence.
-        plddt_b_factors = np.repeat(
-            plddt[:, None], residue_constants.atom_type_num, axis=-1)
-        unrelaxed_protein = protein.from_prediction(
-            features=processed_feature_dict,
-            result=prediction_result,
-            b_factors=plddt_b_factors,
-            remove_leading_feature_dimension=not model_runner.multimer_mode)
-
-        unrelaxed_pdbs[model_name] = protein.to_pdb(unrelaxed_protein)
-        unrelaxed_pdb_path = os.path.join(
-            unrelaxed_protein_path, f'unrelaxed_{model_name}.pdb')
-        with open(unrelaxed_pdb_path, 'w') as f:
-            f.write(unrelaxed_pdbs[model_name])
-
-        if amber_relaxer:
-            # Relax the prediction.
-            t_0 = time.time()
-            relaxed_pdb_str, _, _ = amber_relaxer.process(
-                prot=unrelaxed_protein)
-            timings[f'relax_{model_name}'] = time.time() - t_0
-
-            relaxed_pdbs[model_name] = relaxed_pdb_str
-
-            # Save the relaxed PDB.
+    # The relax workers are shut down, and pending relaxations cancelled, if
+    # a prediction or relaxation fails.
+    try:
+        if prediction_cache_dir:
+            prediction_cache = PredictionCache(prediction_cache_dir)
+            features_digest = _file_digest(model_features_path)
+
+        result_format = 'npz' if output_policy == 'slim' else 'pkl'
+
+        # Run the predictions
+        feature_dict = _load_features(model_features_path)
+        timings = {}
+        unrelaxed_pdbs = {}
+        relaxed_pdbs = {}
+        relax_futures = {}
+        ranking_confidences = {}
+        prediction_metadata = {}
+
+        def relax_prediction(model_name):
             relaxed_output_path = os.path.join(
                 relaxed_protein_path, f'relaxed_{model_name}.pdb')
-            with open(relaxed_output_path, 'w') as f:
-                f.write(relaxed_pdb_str)
-
+            if relax_executor:
+                # Relax the prediction in the background.
+                relax_futures[model_name] = relax_executor.submit(
+                    _relax_worker, unrelaxed_pdbs[model_name],
+                    relaxed_output_path, relax_options, max_violations)
+            elif amber_relaxer:
+                # Relax the prediction.
+                t_0 = time.time()
+                relaxed_pdb_str, prediction_metadata[model_name]['relax'] = (
+                    _relax_structure(amber_relaxer, unrelaxed_pdbs[model_name],
+                                     max_violations))
+                timings[f'relax_{model_name}'] = time.time() - t_0
+
+                relaxed_pdbs[model_name] = relaxed_pdb_str
+
+                # Save the relaxed PDB.
+                with open(relaxed_output_path, 'w') as f:
+                    f.write(relaxed_pdb_str)
+
+        wave_confidences = []
+        current_wave = None
+
+        predict_start = time.time()
+        for model_name, prediction_runner in model_runners.items():
+            if adaptive_sampling:
+                if (max_predictions and
+                        len(ranking_confidences) >= max_predictions):
+                    logging.info('Prediction budget of %d reached',
+                                 max_predictions)
+                    break
+                if prediction_runner[2] != current_wave:
+                    if sampling_has_converged(
+                            wave_confidences, plateau_tolerance):
+                        logging.info(
+                            'Ranking confidence plateaued after %d waves',
+                            len(wave_confidences))
+                        break
+                    current_wave = prediction_runner[2]
+                    wave_confidences.append([])
+
+            result_output_path = os.path.join(
+                raw_prediction_path, f'result_{model_name}.{result_format}')
+            unrelaxed_pdb_path = os.path.join(
+                unrelaxed_protein_path, f'unrelaxed_{model_name}.pdb')
+            model_random_seed = prediction_runner[1]
+
+            cache_hit = False
+            if prediction_cache_dir:
+                cache_key = prediction_cache_key(
+                    features_digest=features_digest,
+                    model_name=prediction_runner[0],
+                    random_seed=model_random_seed,
+                    num_ensemble=num_ensemble,
+                    model_config=model_configs[prediction_runner[0]],
+                    residue_buckets=list(residue_buckets),
+                    msa_buckets=list(msa_buckets),
+                    **_output_cache_options(
+                        output_policy, output_names, half_precision))
+                cache_hit = prediction_cache.fetch(
+                    cache_key, result_output_path, unrelaxed_pdb_path)
+
+            if cache_hit:
+                prediction_result = prediction_io.load_prediction_result(
+                    result_output_path)
+                ranking_confidences[model_name] = prediction_result[
+                    'ranking_confidence']
+                prediction_metadata[model_name] = _recycling_metadata(
+                    prediction_result, model_configs[prediction_runner[0]])
+                with open(unrelaxed_pdb_path) as f:
+                    unrelaxed_pdbs[model_name] = f.read()
+            else:
+                logging.info('Running prediction %s', model_name)
+                t_0 = time.time()
+                model_runner = get_model_runner(prediction_runner[0])
+                processed_feature_dict = model_runner.process_features(
+                    feature_dict, random_seed=model_random_seed)
+                timings[f'process_features_{model_name}'] = time.time() - t_0
+
+                t_0 = time.time()
+                prediction_result, predict_time = _run_model(
+                    model_runner=model_runner,
+                    processed_feature_dict=processed_feature_dict,
+                    random_seed=model_random_seed,
+                    residue_buckets=residue_buckets,
+                    msa_buckets=msa_buckets)
+                t_diff = time.time() - t_0
+                timings[f'predict_and_compile_{model_name}'] = t_diff
+                timings[f'predict_{model_name}'] = predict_time
+                prediction_metadata[model_name] = _recycling_metadata(
+                    prediction_result, model_configs[prediction_runner[0]],
+                    predict_time)
+                logging.info(
+                    'Total JAX model %s predict time: %.1fs, %.1fs without compilation',
+                    model_name, t_diff, predict_time)
+
+                plddt = prediction_result['plddt']
+                ranking_confidences[model_name] = prediction_result[
+                    'ranking_confidence']
+
+                # Save the model outputs.
+                save_prediction_result(
+                    prediction_result, result_output_path,
+                    output_policy, output_names, half_precision)
+
+                # Add the predicted LDDT in the b-factor column.
+                # Note that higher predicted LDDT value means higher model
+                # confidence.
+                plddt_b_factors = np.repeat(
+                    plddt[:, None], residue_constants.atom_type_num, axis=-1)
+                unrelaxed_protein = protein.from_prediction(
+                    features=processed_feature_dict,
+                    result=prediction_result,
+                    b_factors=plddt_b_factors,
+                    remove_leading_feature_dimension=(
+                        not model_runner.multimer_mode))
+
+                unrelaxed_pdbs[model_name] = protein.to_pdb(unrelaxed_protein)
+                with open(unrelaxed_pdb_path, 'w') as f:
+                    f.write(unrelaxed_pdbs[model_name])
+
+                if prediction_cache_dir:
+                    prediction_cache.store(
+                        cache_key, result_output_path, unrelaxed_pdb_path)
+
+            if adaptive_sampling:
+                wave_confidences[-1].append(ranking_confidences[model_name])
+            if run_relax and relax_policy == 'all':
+                relax_prediction(model_name)
+
+        predict_end = time.time()
+        timings['predict_total'] = predict_end - predict_start
+
+        if run_relax and relax_policy != 'all':
+            relax_targets = select_relax_targets(
+                ranking_confidences, relax_policy, relax_top_k)
+            logging.info('Relaxing %s', relax_targets)
+            for model_name in relax_targets:
+                relax_prediction(model_name)
+
+        if relax_executor:
+            # Join the relaxations and measure how much of them overlapped with
+            # the predictions.
+            relax_overlap = 0.
+            for model_name, relax_future in relax_futures.items():
+                relax_start, relax_end, prediction_metadata[model_name][
+                    'relax'] = relax_future.result()
+                timings[f'relax_{model_name}'] = relax_end - relax_start
+                relax_overlap += max(
+                    0., min(relax_end, predict_end) -
+                    max(relax_start, predict_start))
+            timings['relax_total'] = sum(
+                timings[f'relax_{model_name}'] for model_name in relax_futures)
+            timings['relax_overlap_with_predict'] = relax_overlap
+            timings['relax_wait_after_predict'] = time.time() - predict_end
+    finally:
+        if relax_executor:
+            relax_executor.shutdown(cancel_futures=True)
+
+    timings['wall_time'] = time.time() - predict_start
     logging.info('Final timings  %s ',  timings)
 
-    return ranking_confidences
+    return ranking_confidences, timings, prediction_metadata
 
 
 def aggregate(
@@ -422,8 +1788,11 @@ def aggregate(
     if not msas:
         raise RuntimeError('No MSAs passed to the component')
     msa_features = make_msa_features(msas=msas)
-    # Create template features
-    template_features = _read_template_features(template_features_path)
+    # Create template features, left to a batched template search if there
+    # is no template features path
+    template_features = (
+        _read_template_features(template_features_path)
+        if template_features_path else {})
 
     model_features = {
         **sequence_features,
@@ -436,14 +1805,563 @@ def aggregate(
     return model_features
 
 
+def _read_cgroup_file(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_cpu_limit() -> Optional[float]:
+    """Returns the CPU quota of the container's cgroup, None if unlimited."""
+    cpu_max = _read_cgroup_file('/sys/fs/cgroup/cpu.max')  # cgroup v2
+    if cpu_max is not None:
+        quota, period = cpu_max.split()
+        return None if quota == 'max' else int(quota) / int(period)
+    quota = _read_cgroup_file('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = _read_cgroup_file('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota is not None and period is not None and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def available_cpus() -> int:
+    """Returns the number of CPUs the task may use.
+
+    The CPUs the process is pinned to, capped by the CPU quota of the
+    container, which os.cpu_count() does not account for.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        n_cpu = len(os.sched_getaffinity(0))
+    else:
+        n_cpu = os.cpu_count()
+    cpu_limit = _cgroup_cpu_limit()
+    if cpu_limit:
+        n_cpu = min(n_cpu, max(1, int(cpu_limit)))
+    return n_cpu
+
+
+def available_memory_bytes() -> Optional[int]:
+    """Returns the memory the task may use, capped by the cgroup limit."""
+    limits = []
+    for path in ('/sys/fs/cgroup/memory.max',  # cgroup v2
+                 '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        limit = _read_cgroup_file(path)
+        if limit is not None and limit.isdigit():
+            limits.append(int(limit))
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    limits.append(int(line.split()[1]) * 1024)
+                    break
+    except OSError:
+        pass
+    return min(limits) if limits else None
+
+
+@contextlib.contextmanager
+def measure_cpu_usage(n_cpu: int):
+    """Measures the CPU utilization of the subprocesses run in the block.
+
+    Yields a dict that is filled on exit with the wall and CPU time of the
+    subprocesses waited for in the block and their utilization of n_cpu
+    CPUs.
+    """
+    usage = {'n_cpu': n_cpu}
+    t0 = time.time()
+    r0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    try:
+        yield usage
+    finally:
+        r1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+        wall_time = time.time() - t0
+        cpu_time = (r1.ru_utime - r0.ru_utime) + (r1.ru_stime - r0.ru_stime)
+        usage['wall_time'] = round(wall_time, 3)
+        usage['cpu_time'] = round(cpu_time, 3)
+        usage['cpu_utilization'] = round(
+            cpu_time / (wall_time * n_cpu), 3) if wall_time else 0.
+
+
+def record_cpu_usage(artifact, usage: Mapping[str, Any]):
+    """Records the CPUs of a search and their utilization in its metadata."""
+    artifact.metadata['n_cpu'] = usage['n_cpu']
+    artifact.metadata['cpu_utilization'] = usage['cpu_utilization']
+    memory_bytes = available_memory_bytes()
+    if memory_bytes:
+        artifact.metadata['memory_gb'] = round(memory_bytes / (1 << 30), 1)
+
+
+def split_cpu_budget(
+    weights: Mapping[str, float],
+    n_cpu: int = 0,
+) -> Dict[str, int]:
+    """Splits n_cpu CPUs among tools in proportion to weights.
+
+    n_cpu defaults to the CPUs available to the task (see available_cpus).
+    Every tool gets at least one CPU. The CPUs left after rounding down go to
+    the tools with the largest remainders.
+    """
+    n_cpu = n_cpu or available_cpus()
+    total_weight = float(sum(weights.values()))
+    shares = {
+        tool: n_cpu * weight / total_weight for tool, weight in weights.items()}
+    budget = {tool: max(1, int(share)) for tool, share in shares.items()}
+    by_remainder = sorted(
+        shares, key=lambda tool: shares[tool] - budget[tool], reverse=True)
+    for tool in by_remainder[:max(0, n_cpu - sum(budget.values()))]:
+        budget[tool] += 1
+    return budget
+
+
+_STAGING_READ_SIZE = 16 << 20
+
+# Free space left on the staging disk for the tools' own files
+_STAGING_HEADROOM_BYTES = 10 << 30
+
+
+def database_files(database_path: str, num_shards: int = 0) -> List[str]:
+    """Returns the files of a database.
+
+    These are the files starting with database_path, as the hhblits databases
+    are sets of files sharing a prefix, or the shards of the database and
+    their manifest.
+    """
+    if num_shards:
+        shard_paths = database_shard_paths(database_path, num_shards)
+        manifest_path = os.path.join(f'{database_path}_shards', 'manifest.json')
+        if os.path.exists(manifest_path):
+            shard_paths.append(manifest_path)
+        return shard_paths
+    paths = sorted(
+        path for path in glob.glob(glob.escape(database_path) + '*')
+        if os.path.isfile(path))
+    if not paths:
+        raise FileNotFoundError(f'Database not found at {database_path}')
+    return paths
+
+
+def warm_page_cache(paths: Sequence[str]):
+    """Reads files sequentially to load them into the page cache."""
+    t0 = time.time()
+    num_bytes = 0
+    for path in paths:
+        with open(path, 'rb', buffering=0) as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            for chunk in iter(lambda: f.read(_STAGING_READ_SIZE), b''):
+                num_bytes += len(chunk)
+    elapsed = time.time() - t0
+    logging.info(f'Warmed the page cache with {num_bytes / (1 << 30):.1f} GB '
+                 f'in {elapsed:.1f} s')
+
+
+def _staged_databases(staging_dir: str) -> List[Dict[str, Any]]:
+    """Returns the staged databases, least recently used first."""
+    marker_dir = os.path.join(staging_dir, '.staged')
+    staged = []
+    for name in os.listdir(marker_dir):
+        marker_path = os.path.join(marker_dir, name)
+        try:
+            with open(marker_path) as f:
+                marker = json.load(f)
+            marker['last_used'] = os.path.getmtime(marker_path)
+        except (OSError, ValueError):
+            continue
+        marker['marker_path'] = marker_path
+        staged.append(marker)
+    return sorted(staged, key=lambda marker: marker['last_used'])
+
+
+def _remove_staged_database(marker: Mapping[str, Any]):
+    for path in marker['local_files']:
+        if os.path.exists(path):
+            os.remove(path)
+    if os.path.exists(marker['marker_path']):
+        os.remove(marker['marker_path'])
+
+
+@contextlib.contextmanager
+def _eviction_lock(staging_dir: str):
+    """Holds the lock that evictions of a staging directory run under."""
+    with open(os.path.join(staging_dir, '.evict.lock'), 'a') as evict_lock:
+        fcntl.flock(evict_lock, fcntl.LOCK_EX)
+        yield
+
+
+def _make_staging_room(
+    staging_dir: str,
+    num_bytes: int,
+    max_staging_bytes: int,
+    key: str
+) -> bool:
+    """Evicts least recently used databases not in use to fit num_bytes."""
+    with _eviction_lock(staging_dir):
+        staged = [
+            marker for marker in _staged_databases(staging_dir)
+            if marker['key'] != key]
+
+        def fits():
+            free = shutil.disk_usage(staging_dir).free - _STAGING_HEADROOM_BYTES
+            staged_bytes = sum(marker['size'] for marker in staged)
+            return num_bytes <= free and (
+                not max_staging_bytes or
+                staged_bytes + num_bytes <= max_staging_bytes)
+
+        for marker in list(staged):
+            if fits():
+                break
+            lock_path = os.path.join(
+                staging_dir, '.locks', f'{marker["key"]}.lock')
+            with open(lock_path, 'a') as lock:
+                # Databases used by other tasks hold a shared lock
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                logging.info(f'Evicting {marker["database_path"]} from '
+                             f'{staging_dir}')
+                _remove_staged_database(marker)
+                staged.remove(marker)
+        return fits()
+
+
+@contextlib.contextmanager
+def staged_database(
+    database_path: str,
+    staging_dir: str,
+    max_staging_gb: float = 0.,
+    warm: bool = False,
+    files: Optional[Sequence[str]] = None,
+):
+    """Copies a database to a local disk for the duration of a search.
+
+    Yields the path of the database to search: its copy under staging_dir,
+    at the same path as on the Filestore share, or database_path itself if
+    staging_dir is empty or the disk has no room for the database. The copy
+    is reused while the size and modification time of the files (by default
+    those of database_files) are unchanged. Tasks sharing the disk share one
+    copy: it is made under an exclusive file lock and used under a shared
+    lock. When the staged databases would exceed the free disk space or
+    max_staging_gb (0 for no limit), the least recently used ones that are
+    not in use are evicted. With warm, the files are read into the page
+    cache before the search.
+    """
+    files = files or database_files(database_path)
+    if not staging_dir:
+        if warm:
+            warm_page_cache(files)
+        yield database_path
+        return
+
+    for directory in ('.locks', '.staged'):
+        os.makedirs(os.path.join(staging_dir, directory), exist_ok=True)
+    key = hashlib.sha256(database_path.encode()).hexdigest()[:16]
+    marker_path = os.path.join(staging_dir, '.staged', f'{key}.json')
+
+    def local_path(path):
+        return os.path.join(staging_dir, os.path.abspath(path).lstrip(os.sep))
+
+    with open(os.path.join(staging_dir, '.locks', f'{key}.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        signatures = {}
+        for path in files:
+            stat = os.stat(path)
+            signatures[path] = [stat.st_size, stat.st_mtime_ns]
+
+        marker = None
+        if os.path.exists(marker_path):
+            with open(marker_path) as f:
+                marker = dict(json.load(f), marker_path=marker_path)
+        is_staged = marker is not None and marker['files'] == signatures and all(
+            os.path.exists(path) for path in marker['local_files'])
+
+        if not is_staged:
+            if marker is not None:
+                _remove_staged_database(marker)
+            num_bytes = sum(size for size, _ in signatures.values())
+            if _make_staging_room(
+                    staging_dir, num_bytes, int(max_staging_gb * (1 << 30)),
+                    key):
+                t0 = time.time()
+                for path in files:
+                    os.makedirs(os.path.dirname(local_path(path)), exist_ok=True)
+                    shutil.copyfile(path, f'{local_path(path)}.tmp')
+                    os.replace(f'{local_path(path)}.tmp', local_path(path))
+                with open(marker_path, 'w') as f:
+                    json.dump({
+                        'key': key,
+                        'database_path': database_path,
+                        'files': signatures,
+                        'local_files': [local_path(path) for path in files],
+                        'size': num_bytes,
+                    }, f)
+                is_staged = True
+                logging.info(f'Staged {database_path} to {staging_dir} in '
+                             f'{time.time() - t0:.1f} s')
+            else:
+                logging.warning(f'No room to stage {database_path} to '
+                                f'{staging_dir}, searching it on the share')
+
+        if is_staged:
+            os.utime(marker_path)
+            # flock drops the exclusive lock before taking the shared one,
+            # so no eviction may run in between.
+            with _eviction_lock(staging_dir):
+                fcntl.flock(lock, fcntl.LOCK_SH)
+            search_files = [local_path(path) for path in files]
+            search_path = local_path(database_path)
+        else:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            search_files = files
+            search_path = database_path
+
+        if warm:
+            warm_page_cache(search_files)
+        yield search_path
+
+
+def database_shard_paths(database_path: str, num_shards: int) -> List[str]:
+    """Returns the paths of the pre-built shards of a FASTA database.
+
+    The shards of `<database>.fasta` are stored as
+    `<database>.fasta_shards/<index>-of-<num_shards>.fasta` by
+    utils/shard_utils.py. Databases that grew since they were split for
+    num_shards have more shards, so the number of shards recorded in the
+    manifest of the shards is used when there is one.
+    """
+    shard_dir = f'{database_path}_shards'
+    manifest_path = os.path.join(shard_dir, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            num_shards = json.load(f)['num_shards']
+    shard_paths = [
+        os.path.join(shard_dir, f'{index:05d}-of-{num_shards:05d}.fasta')
+        for index in range(num_shards)
+    ]
+    missing = [path for path in shard_paths if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(
+            f'Missing {len(missing)} of {num_shards} shards of {database_path}, '
+            f'e.g. {missing[0]}')
+    return shard_paths
+
+
+def database_num_sequences(database_path: str) -> Optional[int]:
+    """Returns the number of sequences of a sharded database, if indexed."""
+    manifest_path = os.path.join(f'{database_path}_shards', 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)['num_sequences']
+
+
+def _split_stockholm_rows(
+    sto: str
+) -> Tuple[List[str], Dict[str, str], Dict[str, str]]:
+    """Reads the aligned rows and DE descriptions of a Stockholm MSA."""
+    names = []
+    rows = {}
+    descriptions = {}
+    for line in sto.splitlines():
+        if line.startswith('#=GS'):
+            columns = line.split(maxsplit=3)
+            if len(columns) == 4 and columns[2] == 'DE':
+                descriptions[columns[1]] = columns[3]
+        elif line.strip() and not line.startswith(('#', '//')):
+            name, aligned = line.split()
+            if name not in rows:
+                names.append(name)
+                rows[name] = ''
+            rows[name] += aligned
+    return names, rows, descriptions
+
+
+def merge_stockholm_msas(
+    results: Sequence[Mapping[str, Any]],
+    max_hits: Optional[int] = None
+) -> str:
+    """Merges the jackhmmer results of database shards into one Stockholm MSA.
+
+    Hits are sorted by e-value (parsed from each shard's tblout) and truncated
+    to max_hits sequences, including the query, as merge_chunked_msa in
+    analysis/notebook_utils.py does for parsed MSAs. The insert columns of the
+    shard alignments are widened to fit the insertions of every kept hit, so
+    that the deletion matrix of each hit is preserved.
+    """
+    query_name = None
+    query_residues = None
+    hits = []
+    descriptions = {}
+    for shard_index, result in enumerate(results):
+        names, rows, shard_descriptions = _split_stockholm_rows(result['sto'])
+        if not names:
+            continue
+        e_values = parsers.parse_e_values_from_tblout(result['tbl'])
+        query = rows[names[0]]
+        match_columns = [i for i, res in enumerate(query) if res not in '-.']
+        if query_name is None:
+            query_name = names[0]
+            query_residues = [query[i] for i in match_columns]
+        bounds = [-1] + match_columns + [len(query)]
+        for name in names[1:]:
+            row = rows[name]
+            # Residues aligned to each query residue and the insertions before
+            # each query residue (plus the ones after the last).
+            matches = [row[i] for i in match_columns]
+            insertions = [
+                row[start + 1:end].replace('-', '').replace('.', '')
+                for start, end in zip(bounds[:-1], bounds[1:])]
+            # Jackhmmer lists sequences as <sequence name>/<from>-<to>.
+            e_value = e_values.get(name.partition('/')[0], float('inf'))
+            hits.append((e_value, shard_index, name, matches, insertions))
+        descriptions.update(shard_descriptions)
+
+    if query_name is None:
+        raise ValueError('None of the shard results contains an alignment.')
+
+    hits.sort(key=lambda hit: (hit[0], hit[1]))
+    if max_hits is not None:
+        hits = hits[:max(0, max_hits - 1)]
+
+    num_res = len(query_residues)
+    widths = [
+        max([len(hit[4][i]) for hit in hits], default=0)
+        for i in range(num_res + 1)]
+
+    def aligned_row(matches, insertions):
+        columns = []
+        for i in range(num_res + 1):
+            columns.append(insertions[i].ljust(widths[i], '-'))
+            if i < num_res:
+                columns.append(matches[i])
+        return ''.join(columns)
+
+    query_row = aligned_row(query_residues, [''] * (num_res + 1))
+    reference_row = aligned_row(['x'] * num_res, [''] * (num_res + 1))
+    rows = [(query_name, query_row)] + [
+        (name, aligned_row(matches, insertions))
+        for _, _, name, matches, insertions in hits]
+    name_width = max(len(name) for name, _ in rows + [('#=GC RF', '')])
+
+    lines = ['# STOCKHOLM 1.0', '']
+    for name, _ in rows:
+        if name in descriptions:
+            lines.append(f'#=GS {name} DE {descriptions[name]}')
+    lines.append('')
+    for name, row in rows:
+        lines.append(f'{name.ljust(name_width)} {row}')
+    lines.append(f"{'#=GC RF'.ljust(name_width)} "
+                 f"{reference_row.replace('-', '.')}")
+    lines.append('//')
+    return '\n'.join(lines) + '\n'
+
+
+def run_sharded_jackhmmer(
+    input_path: str,
+    msa_path: str,
+    shard_paths: Sequence[str],
+    maxseq: int,
+    n_cpu: int = 8,
+    num_workers: int = 0,
+    z_value: Optional[int] = None,
+):
+    """Runs jackhmmer on database shards concurrently and merges the hits.
+
+    The shards are searched by num_workers concurrent jackhmmer processes
+    (0 for one per shard) sharing n_cpu CPUs. z_value, the number of
+    sequences in the full database, makes the e-values of the shards those
+    of a search of the full database.
+    """
+    num_workers = min(num_workers or len(shard_paths), len(shard_paths))
+    shard_n_cpu = max(1, n_cpu // num_workers)
+
+    def search_shard(shard_path):
+        runner = jackhmmer.Jackhmmer(
+            binary_path=JACKHMMER_BINARY_PATH,
+            database_path=shard_path,
+            n_cpu=shard_n_cpu,
+            z_value=z_value,
+            get_tblout=True,
+        )
+        return runner.query(input_path, maxseq)[0]
+
+    logging.info(f'Searching {len(shard_paths)} shards with {num_workers} '
+                 f'workers of {shard_n_cpu} CPUs')
+    # The searches run as subprocesses, so threads are enough to overlap them
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=num_workers) as executor:
+        results = list(executor.map(search_shard, shard_paths))
+
+    sto = merge_stockholm_msas(results, max_hits=maxseq)
+    with open(msa_path, 'w') as f:
+        f.write(sto)
+
+    return parsers.parse_stockholm(sto), 'sto'
+
+
 def run_jackhmmer(
     input_path: str,
     msa_path: str,
     database_path: str,
     maxseq: int,
-    n_cpu: int = 8
+    n_cpu: int = 8,
+    num_shards: int = 0,
+    num_shard_workers: int = 0,
+    prefilter_max_candidates: int = 0,
+    prefilter_min_shared_kmers: int = 1,
 ):
-    """Runs jackhmeer and saves results to files."""
+    """Runs jackhmeer and saves results to files.
+
+    With num_shards, the pre-built shards of the database are searched
+    instead (see run_sharded_jackhmmer). With prefilter_max_candidates, only
+    the sequences of the database sharing the most k-mers with the query are
+    searched (see kmer_prefilter.py), with the e-values of a search of the
+    full database.
+    """
+
+    if num_shards and prefilter_max_candidates:
+        raise ValueError('Sharded searches cannot be prefiltered.')
+
+    if prefilter_max_candidates:
+        sequence, _, num_res = _read_sequence(input_path)
+        num_sequences = kmer_prefilter.load_metadata(
+            database_path)['num_sequences']
+        candidates = kmer_prefilter.select_candidates(
+            sequence, database_path, prefilter_max_candidates,
+            prefilter_min_shared_kmers)
+        logging.info(f'Searching {len(candidates)} of {num_sequences} '
+                     f'sequences of {database_path}')
+        if not len(candidates):
+            sto = (f'# STOCKHOLM 1.0\n\nquery {sequence}\n'
+                   f'#=GC RF {"x" * num_res}\n//\n')
+        else:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                subset_path = os.path.join(tmp_dir, 'candidates.fasta')
+                kmer_prefilter.write_candidates(
+                    database_path, candidates, subset_path)
+                runner = jackhmmer.Jackhmmer(
+                    binary_path=JACKHMMER_BINARY_PATH,
+                    database_path=subset_path,
+                    n_cpu=n_cpu,
+                    z_value=num_sequences,
+                )
+                sto = runner.query(input_path, maxseq)[0]['sto']
+        with open(msa_path, 'w') as f:
+            f.write(sto)
+        return parsers.parse_stockholm(sto), 'sto'
+
+    if num_shards:
+        return run_sharded_jackhmmer(
+            input_path=input_path,
+            msa_path=msa_path,
+            shard_paths=database_shard_paths(database_path, num_shards),
+            maxseq=maxseq,
+            n_cpu=n_cpu,
+            num_workers=num_shard_workers,
+            z_value=database_num_sequences(database_path),
+        )
 
     runner = jackhmmer.Jackhmmer(
         binary_path=JACKHMMER_BINARY_PATH,
@@ -481,6 +2399,125 @@ def run_hhblits(
     return parsers.parse_a3m(results['a3m']), 'a3m'
 
 
+class ParallelHitFeaturizer:
+    """Featurizes the template hits of a TemplateHitFeaturizer concurrently.
+
+    Reading the mmCIF of a hit and aligning it with kalign mostly waits on
+    I/O and a subprocess, so hits are featurized by num_workers threads.
+    Hits are processed in the order of the wrapped featurizer, and the
+    templates are those of the first max_hits hits that yield features, as
+    with get_templates of the featurizer: results are consumed in order and
+    at most num_workers hits past the last template are featurized in vain.
+    With num_workers of 1 or less, the featurizer runs as is.
+    """
+
+    def __init__(
+        self,
+        featurizer: templates.TemplateHitFeaturizer,
+        num_workers: int
+    ):
+        self._featurizer = featurizer
+        self._num_workers = num_workers
+
+    def get_templates(
+        self,
+        query_sequence: str,
+        hits: Sequence[parsers.TemplateHit]
+    ) -> templates.TemplateSearchResult:
+        featurizer = self._featurizer
+        if self._num_workers <= 1:
+            return featurizer.get_templates(
+                query_sequence=query_sequence, hits=hits)
+
+        # hmmsearch hits are kept in order if they have no sum_probs, and
+        # their templates deduplicated by sequence
+        is_hmmsearch = isinstance(featurizer, templates.HmmsearchHitFeaturizer)
+        if is_hmmsearch and (not hits or hits[0].sum_probs is None):
+            sorted_hits = list(hits)
+        else:
+            sorted_hits = sorted(hits, key=lambda x: x.sum_probs, reverse=True)
+
+        process_hit = functools.partial(
+            templates._process_single_hit,
+            query_sequence=query_sequence,
+            mmcif_dir=featurizer._mmcif_dir,
+            max_template_date=featurizer._max_template_date,
+            release_dates=featurizer._release_dates,
+            obsolete_pdbs=featurizer._obsolete_pdbs,
+            strict_error_check=featurizer._strict_error_check,
+            kalign_binary_path=featurizer._kalign_binary_path)
+
+        template_features = {name: [] for name in templates.TEMPLATE_FEATURES}
+        already_seen = set()
+        errors = []
+        warnings = []
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._num_workers) as executor:
+            remaining_hits = iter(sorted_hits)
+            pending = collections.deque()
+
+            def submit_next():
+                hit = next(remaining_hits, None)
+                if hit is not None:
+                    pending.append((hit, executor.submit(process_hit, hit=hit)))
+
+            for _ in range(self._num_workers):
+                submit_next()
+            while pending and len(already_seen) < featurizer._max_hits:
+                hit, future = pending.popleft()
+                result = future.result()
+                submit_next()
+
+                if result.error:
+                    errors.append(result.error)
+                if result.warning:
+                    warnings.append(result.warning)
+                if result.features is None:
+                    logging.debug(f'Skipped invalid hit {hit.name}, error: '
+                                  f'{result.error}, warning: {result.warning}')
+                    continue
+                # hhsearch templates are not deduplicated, a hit is its own key
+                key = (result.features['template_sequence'] if is_hmmsearch
+                       else len(already_seen))
+                if key in already_seen:
+                    continue
+                already_seen.add(key)
+                for name in template_features:
+                    template_features[name].append(result.features[name])
+
+            for _, future in pending:
+                future.cancel()
+
+        if already_seen:
+            template_features = {
+                name: np.stack(values, axis=0).astype(
+                    templates.TEMPLATE_FEATURES[name])
+                for name, values in template_features.items()}
+        elif is_hmmsearch:
+            # An all-zero template, as HmmsearchHitFeaturizer returns
+            num_res = len(query_sequence)
+            template_features = {
+                'template_aatype': np.zeros(
+                    (1, num_res, len(residue_constants.restypes_with_x_and_gap)),
+                    np.float32),
+                'template_all_atom_masks': np.zeros(
+                    (1, num_res, residue_constants.atom_type_num), np.float32),
+                'template_all_atom_positions': np.zeros(
+                    (1, num_res, residue_constants.atom_type_num, 3),
+                    np.float32),
+                'template_domain_names': np.array([''.encode()], dtype=object),
+                'template_sequence': np.array([''.encode()], dtype=object),
+                'template_sum_probs': np.array([0], dtype=np.float32)
+            }
+        else:
+            template_features = {
+                name: np.array([], dtype=dtype)
+                for name, dtype in templates.TEMPLATE_FEATURES.items()}
+
+        return templates.TemplateSearchResult(
+            features=template_features, errors=errors, warnings=warnings)
+
+
 def run_hhsearch(
     sequence_path: str,
     msa_path: str,
@@ -492,9 +2529,14 @@ def run_hhsearch(
     obsolete_path: str,
     max_template_date: str,
     max_template_hits: int,
-    maxseq: int
+    maxseq: int,
+    featurization_workers: int = 0
 ):
-    """Runs hhsearch and saves results to a file."""
+    """Runs hhsearch and saves results to a file.
+
+    Template hits are featurized by featurization_workers threads (see
+    ParallelHitFeaturizer).
+    """
 
     if msa_data_format != 'sto' and msa_data_format != 'a3m':
         raise ValueError(f'Unsupported MSA format: {msa_data_format}')
@@ -515,6 +2557,8 @@ def run_hhsearch(
         obsolete_pdbs_path=obsolete_path,
         release_dates_path=None,
     )
+    template_featurizer = ParallelHitFeaturizer(
+        template_featurizer, featurization_workers)
 
     with open(msa_path) as f:
         msa_str = f.read()
@@ -550,9 +2594,17 @@ def run_hmmsearch(
     mmcif_path: str,
     obsolete_path: str,
     max_template_date,
-    max_template_hits
+    max_template_hits,
+    search_daemon_address: str = '',
+    featurization_workers: int = 0
 ):
-    """Runs hhsearch and saves results to a file."""
+    """Runs hmmsearch and saves results to a file.
+
+    With search_daemon_address, the search runs on the resident search daemon
+    holding the template database in memory (see search_daemon.py), and on
+    the hmmsearch binary if the daemon fails. Template hits are featurized by
+    featurization_workers threads (see ParallelHitFeaturizer).
+    """
 
     if msa_data_format != 'sto':
         raise ValueError(f'Unsupported MSA format: {msa_data_format}')
@@ -573,6 +2625,8 @@ def run_hmmsearch(
         obsolete_pdbs_path=obsolete_path,
         release_dates_path=None
     )
+    template_featurizer = ParallelHitFeaturizer(
+        template_featurizer, featurization_workers)
 
     with open(msa_path) as f:
         msa_str = f.read()
@@ -581,7 +2635,19 @@ def run_hmmsearch(
     msa_for_templates = parsers.remove_empty_columns_from_stockholm_msa(
         msa_for_templates)
 
-    sto_str = template_searcher.query(msa_for_templates)
+    if search_daemon_address:
+        hmm = template_searcher.hmmbuild_runner.build_profile_from_sto(
+            msa_for_templates, model_construction='hand')
+        try:
+            sto_str = search_daemon.search(
+                search_daemon_address, template_db_path, hmm,
+                template_searcher.flags)
+        except (OSError, RuntimeError) as e:
+            logging.warning(f'Search daemon at {search_daemon_address} '
+                            f'failed, running hmmsearch: {e}')
+            sto_str = template_searcher.query_with_hmm(hmm)
+    else:
+        sto_str = template_searcher.query(msa_for_templates)
     with open(template_hits_path, 'w') as f:
         f.write(sto_str)
 
@@ -595,3 +2661,122 @@ def run_hmmsearch(
         pickle.dump(templates_result.features, f, protocol=4)
 
     return parsers.parse_stockholm(sto_str), templates_result.features
+
+
+def split_stockholm_by_query(sto_str: str) -> Dict[str, str]:
+    """Splits the alignments of a multi-query hmmsearch by query name.
+
+    `hmmsearch -A` writes one Stockholm alignment per query with included
+    hits, named after the query HMM by a `#=GF ID` line.
+    """
+    alignments = {}
+    lines = []
+    for line in sto_str.splitlines(keepends=True):
+        lines.append(line)
+        if line.strip() != '//':
+            continue
+        alignment = ''.join(lines)
+        lines = []
+        for alignment_line in alignment.splitlines():
+            if alignment_line.startswith('#=GF ID'):
+                alignments[alignment_line.split()[2]] = alignment
+                break
+    return alignments
+
+
+def _rename_hmm(hmm: str, name: str) -> str:
+    """Sets the NAME line of an HMM in HMMER3 text format."""
+    lines = hmm.splitlines(keepends=True)
+    for i, line in enumerate(lines):
+        if line.startswith('NAME '):
+            lines[i] = f'NAME  {name}\n'
+            break
+    return ''.join(lines)
+
+
+def run_batched_hmmsearch(
+    queries: Sequence[Mapping[str, str]],
+    template_db_path: str,
+    mmcif_path: str,
+    obsolete_path: str,
+    max_template_date,
+    max_template_hits,
+    search_daemon_address: str = '',
+    featurization_workers: int = 0
+) -> List[Tuple[str, Dict[str, Any]]]:
+    """Runs the template search of several chains in one hmmsearch pass.
+
+    Each query maps 'sequence' to the chain sequence and 'msa_path' and
+    'msa_data_format' to its uniref90 MSA, as for run_hmmsearch. An HMM is
+    built for each unique sequence, all the HMMs are searched against the
+    template database at once, on the search daemon if search_daemon_address
+    is given, and the hits are split back per chain before featurization by
+    featurization_workers threads (see ParallelHitFeaturizer). Returns the
+    Stockholm hits and template features of each query.
+    """
+    template_searcher = hmmsearch.Hmmsearch(
+        binary_path=HMMSEARCH_BINARY_PATH,
+        hmmbuild_binary_path=HMMBUILD_BINARY_PATH,
+        database_path=template_db_path
+    )
+
+    template_featurizer = templates.HmmsearchHitFeaturizer(
+        mmcif_dir=mmcif_path,
+        max_template_date=max_template_date,
+        max_hits=max_template_hits,
+        kalign_binary_path=KALIGN_BINARY_PATH,
+        obsolete_pdbs_path=obsolete_path,
+        release_dates_path=None
+    )
+    template_featurizer = ParallelHitFeaturizer(
+        template_featurizer, featurization_workers)
+
+    # Homomer chains share their MSA and templates
+    unique_queries = {}
+    for query in queries:
+        unique_queries.setdefault(query['sequence'], query)
+    names = {
+        sequence: f'query_{i}' for i, sequence in enumerate(unique_queries)}
+
+    hmms = []
+    for sequence, query in unique_queries.items():
+        if query['msa_data_format'] != 'sto':
+            raise ValueError(
+                f'Unsupported MSA format: {query["msa_data_format"]}')
+        with open(query['msa_path']) as f:
+            msa_str = f.read()
+        msa_for_templates = parsers.deduplicate_stockholm_msa(msa_str)
+        msa_for_templates = parsers.remove_empty_columns_from_stockholm_msa(
+            msa_for_templates)
+        hmm = template_searcher.hmmbuild_runner.build_profile_from_sto(
+            msa_for_templates, model_construction='hand')
+        hmms.append(_rename_hmm(hmm, names[sequence]))
+    hmms = ''.join(hmms)
+
+    logging.info(f'Searching {len(unique_queries)} HMMs of {len(queries)} '
+                 f'chains against {template_db_path}')
+    sto_str = None
+    if search_daemon_address:
+        try:
+            sto_str = search_daemon.search(
+                search_daemon_address, template_db_path, hmms,
+                template_searcher.flags)
+        except (OSError, RuntimeError) as e:
+            logging.warning(f'Search daemon at {search_daemon_address} '
+                            f'failed, running hmmsearch: {e}')
+    if sto_str is None:
+        sto_str = template_searcher.query_with_hmm(hmms)
+    alignments = split_stockholm_by_query(sto_str)
+
+    results = {}
+    for sequence, name in names.items():
+        # Queries without hits have no alignment, as with a single query
+        query_sto_str = alignments.get(name, '')
+        template_hits = template_searcher.get_template_hits(
+            output_string=query_sto_str, input_sequence=sequence)
+        templates_result = template_featurizer.get_templates(
+            query_sequence=sequence,
+            hits=template_hits)
+        results[sequence] = (query_sto_str, templates_result.features)
+
+    return [results[query['sequence']] for query in queries]
@@ -0,0 +1,140 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A component running the template search of all chains of a complex."""
+
+from kfp.v2 import dsl
+from kfp.v2.dsl import Artifact
+from kfp.v2.dsl import Input
+from kfp.v2.dsl import Output
+
+import config as config
+
+
+@dsl.component(
+    base_image=config.ALPHAFOLD_COMPONENTS_IMAGE
+)
+def batch_hmmsearch(
+    chains: list,
+    ref_databases: Input[Artifact],
+    template_db: str,
+    mmcif_db: str,
+    obsolete_db: str,
+    max_template_date: str,
+    template_hits: Output[Artifact],
+    max_template_hits: int = 20,
+    staging_dir: str = '',
+    staging_max_gb: float = 0.,
+    warm_page_cache: bool = False,
+    search_daemon_address: str = '',
+    featurization_workers: int = 0,
+):
+  """Searches templates for the chains of a complex in one hmmsearch pass.
+
+  chains are the outputs of aggregate_features_multimer run with
+  defer_templates, which records the uniref90 MSA of each chain. The
+  template features found for each chain are added to its features, which
+  are written to features.pkl next to them, where
+  aggregate_features_across_chains reads them. Chains aggregated without
+  MSAs already have their empty template features and are only copied. The
+  hits of each chain are written to template_hits, a directory of
+  <chain_id>.sto files. Template hits are featurized by
+  featurization_workers threads, one after another for 0 or 1.
+  """
+
+  import logging
+  import os
+  import pickle
+  import time
+
+  from alphafold_utils import run_batched_hmmsearch
+  from alphafold_utils import staged_database
+  from search_daemon import serves_database
+
+  logging.info('Starting batched hmmsearch search')
+  t0 = time.time()
+
+  def local_path(uri):
+    return uri.replace('gs://', '/gcs/', 1)
+
+  def write_features(features_uri, features):
+    features_path = os.path.join(
+        os.path.dirname(local_path(features_uri)), 'features.pkl')
+    with open(features_path, 'wb') as f:
+      pickle.dump(features, f, protocol=4)
+
+  queries = []
+  for chain in chains:
+    with open(local_path(chain['features_uri']), 'rb') as f:
+      features = pickle.load(f)
+    if not chain['template_msa_uri']:
+      write_features(chain['features_uri'], features)
+      continue
+    queries.append({
+        'features_uri': chain['features_uri'],
+        'chain_id': chain['chain_id'],
+        'features': features,
+        'sequence': features['sequence'][0].decode(),
+        'msa_path': local_path(chain['template_msa_uri']),
+        'msa_data_format': chain['template_msa_format'],
+    })
+
+  results = []
+  use_daemon = False
+  if queries:
+    mount_path = ref_databases.uri
+    template_db_path = os.path.join(
+        mount_path, ref_databases.metadata[template_db])
+    use_daemon = bool(search_daemon_address) and serves_database(
+        search_daemon_address, template_db_path)
+    if use_daemon:
+      # The daemon searches its in-memory copy of the share's database
+      staging_dir, warm_page_cache = '', False
+    with staged_database(
+        template_db_path, staging_dir, staging_max_gb, warm=warm_page_cache
+    ) as search_template_db_path:
+      results = run_batched_hmmsearch(
+          queries=queries,
+          template_db_path=search_template_db_path,
+          mmcif_path=os.path.join(
+              mount_path, ref_databases.metadata[mmcif_db]),
+          obsolete_path=os.path.join(
+              mount_path, ref_databases.metadata[obsolete_db]),
+          max_template_date=max_template_date,
+          max_template_hits=max_template_hits,
+          search_daemon_address=search_daemon_address if use_daemon else '',
+          featurization_workers=featurization_workers
+      )
+
+  os.makedirs(template_hits.path, exist_ok=True)
+  num_templates = {}
+  for query, (sto_str, template_features) in zip(queries, results):
+    chain_id = query['chain_id']
+    with open(os.path.join(template_hits.path, f'{chain_id}.sto'), 'w') as f:
+      f.write(sto_str)
+    write_features(
+        query['features_uri'], {**query['features'], **template_features})
+    num_templates[chain_id] = int(
+        template_features['template_domain_names'].shape[0])
+
+  template_hits.metadata['category'] = 'msa'
+  template_hits.metadata['data_format'] = 'sto'
+  template_hits.metadata['tool'] = 'hmmsearch'
+  template_hits.metadata['num_chains'] = len(queries)
+  template_hits.metadata['num_unique_chains'] = len(
+      {query['sequence'] for query in queries})
+  template_hits.metadata['total_num_templates'] = num_templates
+  template_hits.metadata['search_daemon'] = use_daemon
+
+  t1 = time.time()
+  logging.info(f'Batched hmmsearch search completed. Elapsed time: {t1-t0}')
@@ -15,16 +15,27 @@ def bfd_search(
     ref_databases: Input[Artifact],
     use_small_bfd: str,
     msa: Output[Artifact],
-    n_cpu: int = 8,
+    n_cpu: int = 0,
     maxseq: int = 10000,
+    staging_dir: str = '',
+    staging_max_gb: float = 0.,
+    warm_page_cache: bool = False,
 ):
-    """Runs either jackhmmer (small BFD) or hhblits (large BFD) search."""
+    """Runs either jackhmmer (small BFD) or hhblits (large BFD) search.
 
+    n_cpu defaults to the CPUs available to the task. With staging_dir, the
+    databases are searched from copies on the local disk (see
+    alphafold_utils.staged_database).
+    """
+
+    import contextlib
     import logging
     import os
     import time
 
     from alphafold_utils import run_jackhmmer, run_hhblits
+    from alphafold_utils import available_cpus, measure_cpu_usage, record_cpu_usage
+    from alphafold_utils import staged_database
 
     logging.info(f'Starting BFD search with use_small_bfd={use_small_bfd}')
     t0 = time.time()
@@ -34,6 +45,7 @@ def bfd_search(
         raise FileNotFoundError(f"Sequence file not found at {sequence.path}")
 
     mount_path = ref_databases.uri
+    n_cpu = n_cpu or available_cpus()
 
     if use_small_bfd == 'true':
         # Small BFD search using jackhmmer
@@ -41,15 +53,19 @@ def bfd_search(
         if not os.path.exists(database_path):
             raise FileNotFoundError(f"Small BFD database not found at {database_path}")
 
-        parsed_msa, msa_format = run_jackhmmer(
-            input_path=sequence.path,
-            database_path=database_path,
-            msa_path=msa.path,
-            n_cpu=n_cpu,
-            maxseq=maxseq
-        )
+        with staged_database(
+            database_path, staging_dir, staging_max_gb, warm=warm_page_cache
+        ) as search_database_path, measure_cpu_usage(n_cpu) as usage:
+            parsed_msa, msa_format = run_jackhmmer(
+                input_path=sequence.path,
+                database_path=search_database_path,
+                msa_path=msa.path,
+                n_cpu=n_cpu,
+                maxseq=maxseq
+            )
         tool_name = 'jackhmmer'
         databases = ['small_bfd']
+        staged = search_database_path != database_path
 
     else:
         # Large BFD search using hhblits
@@ -60,15 +76,22 @@ def bfd_search(
                 raise FileNotFoundError(f"Database {db_name} not found at {db_path}")
             database_paths.append(db_path)
 
-        parsed_msa, msa_format = run_hhblits(
-            input_path=sequence.path,
-            database_paths=database_paths,
-            msa_path=msa.path,
-            n_cpu=n_cpu,
-            maxseq=maxseq
-        )
+        with contextlib.ExitStack() as stack:
+            search_database_paths = [
+                stack.enter_context(staged_database(
+                    db_path, staging_dir, staging_max_gb, warm=warm_page_cache))
+                for db_path in database_paths]
+            with measure_cpu_usage(n_cpu) as usage:
+                parsed_msa, msa_format = run_hhblits(
+                    input_path=sequence.path,
+                    database_paths=search_database_paths,
+                    msa_path=msa.path,
+                    n_cpu=n_cpu,
+                    maxseq=maxseq
+                )
         tool_name = 'hhblits'
         databases = ['bfd', 'uniref30']
+        staged = search_database_paths != database_paths
 
     # Set metadata
     msa.metadata['category'] = 'msa'
@@ -76,6 +99,8 @@ def bfd_search(
     msa.metadata['data_format'] = msa_format
     msa.metadata['databases'] = databases
     msa.metadata['tool'] = tool_name
+    msa.metadata['staged'] = staged
+    record_cpu_usage(msa, usage)
 
     t1 = time.time()
     logging.info(f'BFD search completed using {tool_name}. Elapsed time: {t1-t0}')
\ No newline at end of file
@@ -0,0 +1,179 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A component running the uniref90, mgnify and BFD searches on one machine."""
+
+from kfp.v2 import dsl
+from kfp.v2.dsl import Artifact
+from kfp.v2.dsl import Input
+from kfp.v2.dsl import Output
+
+import config as config
+
+
+@dsl.component(
+    base_image=config.ALPHAFOLD_COMPONENTS_IMAGE
+)
+def colocated_msa_search(
+    sequence: Input[Artifact],
+    ref_databases: Input[Artifact],
+    use_small_bfd: str,
+    uniref_msa: Output[Artifact],
+    mgnify_msa: Output[Artifact],
+    bfd_msa: Output[Artifact],
+    uniref_max_hits: int = 10000,
+    mgnify_max_hits: int = 501,
+    bfd_max_hits: int = 10000,
+    uniref_n_cpu: int = 0,
+    mgnify_n_cpu: int = 0,
+    bfd_n_cpu: int = 0,
+    uniref_num_shards: int = 0,
+    uniref_prefilter_max_candidates: int = 0,
+    prefilter_min_shared_kmers: int = 1,
+    staging_dir: str = '',
+    staging_max_gb: float = 0.,
+    warm_page_cache: bool = False,
+):
+  """Runs the uniref90, mgnify and BFD searches concurrently.
+
+  The searches take the sharding, prefilter and staging options of the
+  jackhmmer and bfd_search components, and their MSAs and metadata are the
+  same. The CPUs of the machine are split among the searches (see
+  alphafold_utils.split_cpu_budget) unless a search is given its own n_cpu.
+  The cpu_utilization recorded in the metadata of each MSA is that of the
+  whole task, as the searches overlap.
+  """
+
+  import concurrent.futures
+  import contextlib
+  import logging
+  import os
+  import time
+
+  from alphafold_utils import database_files
+  from alphafold_utils import measure_cpu_usage
+  from alphafold_utils import record_cpu_usage
+  from alphafold_utils import run_hhblits
+  from alphafold_utils import run_jackhmmer
+  from alphafold_utils import split_cpu_budget
+  from alphafold_utils import staged_database
+
+  t0 = time.time()
+
+  # Ensure sequence file exists
+  if not os.path.exists(sequence.path):
+      raise FileNotFoundError(f"Sequence file not found at {sequence.path}")
+
+  mount_path = ref_databases.uri
+
+  def database_path(database):
+    path = os.path.join(mount_path, ref_databases.metadata[database])
+    if not os.path.exists(path):
+      raise FileNotFoundError(f"Database {database} not found at {path}")
+    return path
+
+  # hhblits on the full BFD is the longest search, the small BFD the shortest
+  cpu_budget = split_cpu_budget({
+      'uniref': 2,
+      'mgnify': 2,
+      'bfd': 1 if use_small_bfd == 'true' else 3,
+  })
+  cpu_budget = {
+      'uniref': uniref_n_cpu or cpu_budget['uniref'],
+      'mgnify': mgnify_n_cpu or cpu_budget['mgnify'],
+      'bfd': bfd_n_cpu or cpu_budget['bfd'],
+  }
+  logging.info(f'Starting co-located searches with CPU budget {cpu_budget}')
+
+  def search_jackhmmer(msa, database, maxseq, n_cpu, num_shards=0,
+                       prefilter_max_candidates=0):
+    path = database_path(database)
+    # Prefiltered searches read their candidates from the share, as in the
+    # jackhmmer component
+    staging = ('', False) if prefilter_max_candidates else (
+        staging_dir, warm_page_cache)
+    with staged_database(
+        path, staging[0], staging_max_gb, warm=staging[1],
+        files=database_files(path, num_shards)
+    ) as search_database_path:
+      parsed_msa, msa_format = run_jackhmmer(
+          input_path=sequence.path,
+          database_path=search_database_path,
+          msa_path=msa.path,
+          n_cpu=n_cpu,
+          maxseq=maxseq,
+          num_shards=num_shards,
+          prefilter_max_candidates=prefilter_max_candidates,
+          prefilter_min_shared_kmers=prefilter_min_shared_kmers
+      )
+    msa.metadata['category'] = 'msa'
+    msa.metadata['num_sequences'] = len(parsed_msa)
+    msa.metadata['data_format'] = msa_format
+    msa.metadata['databases'] = [database]
+    msa.metadata['tool'] = 'jackhmmer'
+    msa.metadata['num_shards'] = num_shards
+    msa.metadata['staged'] = search_database_path != path
+    msa.metadata['prefilter_max_candidates'] = prefilter_max_candidates
+
+  def search_bfd():
+    if use_small_bfd == 'true':
+      search_jackhmmer(bfd_msa, 'small_bfd', bfd_max_hits, cpu_budget['bfd'])
+      return
+    databases = ['bfd', 'uniref30']
+    paths = [database_path(database) for database in databases]
+    with contextlib.ExitStack() as stack:
+      search_database_paths = [
+          stack.enter_context(staged_database(
+              path, staging_dir, staging_max_gb, warm=warm_page_cache))
+          for path in paths]
+      parsed_msa, msa_format = run_hhblits(
+          input_path=sequence.path,
+          database_paths=search_database_paths,
+          msa_path=bfd_msa.path,
+          n_cpu=cpu_budget['bfd'],
+          maxseq=bfd_max_hits
+      )
+    bfd_msa.metadata['category'] = 'msa'
+    bfd_msa.metadata['num_sequences'] = len(parsed_msa)
+    bfd_msa.metadata['data_format'] = msa_format
+    bfd_msa.metadata['databases'] = databases
+    bfd_msa.metadata['tool'] = 'hhblits'
+    bfd_msa.metadata['staged'] = search_database_paths != paths
+
+  # The searches run as subprocesses, so threads are enough to overlap them
+  with measure_cpu_usage(sum(cpu_budget.values())) as cpu_usage, \
+      concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+    searches = {
+        'uniref': executor.submit(
+            search_jackhmmer, uniref_msa, 'uniref90', uniref_max_hits,
+            cpu_budget['uniref'], uniref_num_shards,
+            uniref_prefilter_max_candidates),
+        'mgnify': executor.submit(
+            search_jackhmmer, mgnify_msa, 'mgnify', mgnify_max_hits,
+            cpu_budget['mgnify']),
+        'bfd': executor.submit(search_bfd),
+    }
+    for name, search in searches.items():
+      try:
+        search.result()
+      except Exception as e:
+        logging.error(f"{name} search failed: {str(e)}")
+        raise
+
+  for name, msa in [('uniref', uniref_msa), ('mgnify', mgnify_msa),
+                    ('bfd', bfd_msa)]:
+    record_cpu_usage(msa, dict(cpu_usage, n_cpu=cpu_budget[name]))
+  logging.info(f'Task CPU utilization: {cpu_usage["cpu_utilization"]}')
+
+  t1 = time.time()
+  logging.info(f'Co-located searches completed. Elapsed time: {t1-t0}')
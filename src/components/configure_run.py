@@ -31,6 +31,8 @@ def configure_run(
     sequence: Output[Artifact],
     random_seed: int = None,
     num_multimer_predictions_per_model: int = 5,
+    sampling_bucket: str = '',
+    sampling_run_id: str = '',
 ) -> NamedTuple(
     'ConfigureRunOutputs',
     [
@@ -40,7 +42,12 @@ def configure_run(
         ('num_ensemble', int),
     ]
 ):
-  """Configures a pipeline run."""
+  """Configures a pipeline run.
+
+  With a sampling_bucket, each model runner gets a sampling_log_path under
+  gs://<sampling_bucket>/relax_targets/<sampling_run_id> for its predict
+  task to log the prediction to (see select_relax_targets).
+  """
 
   import random
   import sys
@@ -79,7 +86,10 @@ def configure_run(
       model_runners.append({
           'prediction_index': i,
           'model_name': model_name,
-          'random_seed': random_seed
+          'random_seed': random_seed,
+          'sampling_log_path': (
+              f'gs://{sampling_bucket}/relax_targets/{sampling_run_id}/'
+              f'{model_name}_pred_{i}.json' if sampling_bucket else ''),
       })
       random_seed += 1
 
@@ -26,6 +26,7 @@ def configure_run_multimer(
         ('num_ensemble', int),
         ('is_homomer_or_monomer', str),
         ('chain_info_list', list),
+        ('sampling_waves', list),
     ]
 ):
     """Configures a pipeline run."""
@@ -131,6 +132,17 @@ def configure_run_multimer(
                 'random_seed': current_seed
             })
 
+    # Group the model runners into waves of one seed per model for
+    # adaptive sampling
+    sampling_waves = []
+    for i in range(num_predictions_per_model):
+        sampling_waves.append({
+            'wave_index': int(i),
+            'model_runners': [
+                runner for runner in model_runners
+                if runner['prediction_index'] == i]
+        })
+
     # Set metadata for the sequence artifact
     sequence.metadata['category'] = 'sequence'
     sequence.metadata['description'] = seq_descs
@@ -139,9 +151,9 @@ def configure_run_multimer(
 
     output = namedtuple(
         'ConfigureRunOutputs',
-        ['sequence_path', 'model_runners', 'run_multimer_system', 'num_ensemble', 'is_homomer_or_monomer', 'chain_info_list']
+        ['sequence_path', 'model_runners', 'run_multimer_system', 'num_ensemble', 'is_homomer_or_monomer', 'chain_info_list', 'sampling_waves']
     )
 
     print(f"Chains output: {chain_info_list}")
 
-    return output(sequence.path, model_runners, run_multimer_system, num_ensemble, is_homomer_or_monomer, chain_info_list)
+    return output(sequence.path, model_runners, run_multimer_system, num_ensemble, is_homomer_or_monomer, chain_info_list, sampling_waves)
@@ -31,9 +31,14 @@ def data_pipeline(
     use_small_bfd: bool,
     max_template_date: str,
     msas: Output[Artifact],
-    features: Output[Artifact]
+    features: Output[Artifact],
+    featurization_workers: int = 0
 ):
-  """Configures and runs AlphaFold data pipelines."""
+  """Configures and runs AlphaFold data pipelines.
+
+  Template hits are featurized by featurization_workers threads, one after
+  another for 0 or 1.
+  """
 
   import logging
   import os
@@ -83,6 +88,7 @@ def data_pipeline(
       max_template_date=max_template_date,
       msa_output_path=msas.path,
       features_output_path=features.path,
+      featurization_workers=featurization_workers,
   )
 
   features.metadata['category'] = 'features'
@@ -0,0 +1,49 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A component that outputs the memory settings of unplanned predictions."""
+
+from typing import NamedTuple
+
+from kfp.v2 import dsl
+
+import config as config
+
+
+@dsl.component(
+    base_image=config.ALPHAFOLD_COMPONENTS_IMAGE
+)
+def default_memory_plan(
+    tf_force_unified_memory: str,
+    xla_python_client_mem_fraction: str,
+) -> NamedTuple(
+    'MemoryPlan',
+    [
+        ('tf_force_unified_memory', str),
+        ('xla_python_client_mem_fraction', str),
+        ('subbatch_size', int),
+    ]):
+  """Passes the memory settings through, with the model default subbatch size.
+
+  Stands in for plan_memory when memory planning is off.
+  """
+
+  import collections
+
+  MemoryPlan = collections.namedtuple(
+      'MemoryPlan',
+      ['tf_force_unified_memory', 'xla_python_client_mem_fraction',
+       'subbatch_size'])
+
+  return MemoryPlan(tf_force_unified_memory, xla_python_client_mem_fraction, 0)
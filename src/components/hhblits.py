@@ -29,17 +29,30 @@ def hhblits(
     ref_databases: Input[Artifact],
     databases: List[str],
     msa: Output[Artifact],
-    n_cpu: int = 12,
+    n_cpu: int = 0,
     maxseq: int = 1_000_000,
+    staging_dir: str = '',
+    staging_max_gb: float = 0.,
+    warm_page_cache: bool = False,
 ):
-  """Configures and runs hhblits."""
+  """Configures and runs hhblits.
 
+  n_cpu defaults to the CPUs available to the task. With staging_dir, the
+  databases are searched from copies on the local disk (see
+  alphafold_utils.staged_database).
+  """
+
+  import contextlib
   import logging
   import os
   import time
   import json
 
+  from alphafold_utils import available_cpus
+  from alphafold_utils import measure_cpu_usage
+  from alphafold_utils import record_cpu_usage
   from alphafold_utils import run_hhblits
+  from alphafold_utils import staged_database
 
   logging.info(f'Starting hhblits search on {databases}')
   t0 = time.time()
@@ -69,19 +82,30 @@ def hhblits(
   logging.info(f"Input sequence path: {sequence.path}")
   logging.info(f"Database paths: {database_paths}")
 
-  parsed_msa, msa_format = run_hhblits(
-      input_path=sequence.path,
-      database_paths=database_paths,
-      msa_path=msa.path,
-      n_cpu=n_cpu,
-      maxseq=maxseq
-  )
+  n_cpu = n_cpu or available_cpus()
+  logging.info(f"Using {n_cpu} CPUs")
+
+  with contextlib.ExitStack() as stack:
+    search_database_paths = [
+        stack.enter_context(staged_database(
+            db_path, staging_dir, staging_max_gb, warm=warm_page_cache))
+        for db_path in database_paths]
+    with measure_cpu_usage(n_cpu) as cpu_usage:
+      parsed_msa, msa_format = run_hhblits(
+          input_path=sequence.path,
+          database_paths=search_database_paths,
+          msa_path=msa.path,
+          n_cpu=n_cpu,
+          maxseq=maxseq
+      )
 
   msa.metadata['category'] = 'msa'
   msa.metadata['num_sequences'] = len(parsed_msa)
   msa.metadata['data_format'] = msa_format
   msa.metadata['databases'] = databases
   msa.metadata['tool'] = 'hhblits'
+  msa.metadata['staged'] = search_database_paths != database_paths
+  record_cpu_usage(msa, cpu_usage)
 
   t1 = time.time()
   logging.info(f'Hhblits search completed. Elapsed time: {t1-t0}')
@@ -37,9 +37,14 @@ def hhsearch(
     template_hits: Output[Artifact],
     template_features: Output[Artifact],
     max_template_hits: int = 20,
-    maxseq: int = 1_000_000
+    maxseq: int = 1_000_000,
+    featurization_workers: int = 0
 ):
-  """Configures and runs hhsearch."""
+  """Configures and runs hhsearch.
+
+  Template hits are featurized by featurization_workers threads, one after
+  another for 0 or 1.
+  """
 
   import logging
   import os
@@ -68,6 +73,7 @@ def hhsearch(
       template_hits_path=template_hits.path,
       template_features_path=template_features.path,
       maxseq=maxseq,
+      featurization_workers=featurization_workers,
   )
 
   template_hits.metadata['category'] = 'msa'
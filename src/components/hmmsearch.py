@@ -35,40 +35,67 @@ def hmmsearch(
     template_hits: Output[Artifact],
     template_features: Output[Artifact],
     max_template_hits: int = 20,
+    staging_dir: str = '',
+    staging_max_gb: float = 0.,
+    warm_page_cache: bool = False,
+    search_daemon_address: str = '',
+    featurization_workers: int = 0,
 ):
-  """Configures and runs hmmsearch."""
+  """Configures and runs hmmsearch.
+
+  With staging_dir, the template database is searched from a copy on the
+  local disk (see alphafold_utils.staged_database). With
+  search_daemon_address, the search runs on the resident search daemon if it
+  holds the template database (see search_daemon.py), and in the task
+  otherwise. Template hits are featurized by featurization_workers threads,
+  one after another for 0 or 1.
+  """
 
   import logging
   import os
   import time
 
   from alphafold_utils import run_hmmsearch
+  from alphafold_utils import staged_database
+  from search_daemon import serves_database
 
   logging.info('Starting hmmsearch search')
   t0 = time.time()
 
   mount_path = ref_databases.uri
 
-  msa, features = run_hmmsearch(
-      sequence_path=sequence.path,
-      msa_path=msa.path,
-      msa_data_format=msa.metadata['data_format'],
-      template_db_path=os.path.join(
-          mount_path, ref_databases.metadata[template_db]),
-      mmcif_path=os.path.join(
-          mount_path, ref_databases.metadata[mmcif_db]),
-      obsolete_path=os.path.join(
-          mount_path, ref_databases.metadata[obsolete_db]),
-      max_template_date=max_template_date,
-      max_template_hits=max_template_hits,
-      template_hits_path=template_hits.path,
-      template_features_path=template_features.path
-  )
+  template_db_path = os.path.join(
+      mount_path, ref_databases.metadata[template_db])
+  use_daemon = bool(search_daemon_address) and serves_database(
+      search_daemon_address, template_db_path)
+  if use_daemon:
+    # The daemon searches its in-memory copy of the share's database
+    staging_dir, warm_page_cache = '', False
+  with staged_database(
+      template_db_path, staging_dir, staging_max_gb, warm=warm_page_cache
+  ) as search_template_db_path:
+    msa, features = run_hmmsearch(
+        sequence_path=sequence.path,
+        msa_path=msa.path,
+        msa_data_format=msa.metadata['data_format'],
+        template_db_path=search_template_db_path,
+        mmcif_path=os.path.join(
+            mount_path, ref_databases.metadata[mmcif_db]),
+        obsolete_path=os.path.join(
+            mount_path, ref_databases.metadata[obsolete_db]),
+        max_template_date=max_template_date,
+        max_template_hits=max_template_hits,
+        template_hits_path=template_hits.path,
+        template_features_path=template_features.path,
+        search_daemon_address=search_daemon_address if use_daemon else '',
+        featurization_workers=featurization_workers
+    )
 
   template_hits.metadata['category'] = 'msa'
   template_hits.metadata['num_hits'] = len(msa)
   template_hits.metadata['data_format'] = 'sto'
   template_hits.metadata['tool'] = 'hmmearch'
+  template_hits.metadata['search_daemon'] = use_daemon
   template_features.metadata['category'] = 'features'
   template_features.metadata['data_format'] = 'pkl'
 
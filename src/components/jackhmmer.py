@@ -29,16 +29,38 @@ def jackhmmer(
     ref_databases: Input[Artifact],
     database: str,
     msa: Output[Artifact],
-    n_cpu: int = 8,
+    n_cpu: int = 0,
     maxseq: int = 10000,
+    num_shards: int = 0,
+    num_shard_workers: int = 0,
+    staging_dir: str = '',
+    staging_max_gb: float = 0.,
+    warm_page_cache: bool = False,
+    prefilter_max_candidates: int = 0,
+    prefilter_min_shared_kmers: int = 1,
 ):
-  """Configures and runs jackhmmer."""
+  """Configures and runs jackhmmer.
+
+  n_cpu defaults to the CPUs available to the task. With num_shards, the
+  pre-built shards of the database are searched by num_shard_workers
+  concurrent jackhmmer processes (0 for one per shard) and their hits are
+  merged by e-value. With staging_dir, the database is searched from a copy
+  on the local disk (see alphafold_utils.staged_database). With
+  prefilter_max_candidates, only the sequences sharing the most k-mers with
+  the query are searched (see kmer_prefilter.py); they are read from the
+  share, as staging the full database would defeat the prefilter.
+  """
 
   import logging
   import os
   import time
 
+  from alphafold_utils import available_cpus
+  from alphafold_utils import database_files
+  from alphafold_utils import measure_cpu_usage
+  from alphafold_utils import record_cpu_usage
   from alphafold_utils import run_jackhmmer
+  from alphafold_utils import staged_database
 
   logging.info(f'Starting jackhmmer search on {database}')
   logging.info(f'Sequence artifact URI: {sequence.uri}')
@@ -55,14 +77,25 @@ def jackhmmer(
   if not os.path.exists(database_path):
       raise FileNotFoundError(f"Database not found at {database_path}")
 
+  n_cpu = n_cpu or available_cpus()
+  if prefilter_max_candidates:
+    staging_dir, warm_page_cache = '', False
   try:
-    parsed_msa, msa_format = run_jackhmmer(
-      input_path=sequence.path,
-      database_path=database_path,
-      msa_path=msa.path,
-      n_cpu=n_cpu,
-      maxseq=maxseq
-    )
+    with staged_database(
+        database_path, staging_dir, staging_max_gb, warm=warm_page_cache,
+        files=database_files(database_path, num_shards)
+    ) as search_database_path, measure_cpu_usage(n_cpu) as cpu_usage:
+      parsed_msa, msa_format = run_jackhmmer(
+        input_path=sequence.path,
+        database_path=search_database_path,
+        msa_path=msa.path,
+        n_cpu=n_cpu,
+        maxseq=maxseq,
+        num_shards=num_shards,
+        num_shard_workers=num_shard_workers,
+        prefilter_max_candidates=prefilter_max_candidates,
+        prefilter_min_shared_kmers=prefilter_min_shared_kmers
+      )
 
   except Exception as e:
     logging.error(f"Jackhmmer search failed: {str(e)}")
@@ -73,6 +106,10 @@ def jackhmmer(
   msa.metadata['data_format'] = 'sto'
   msa.metadata['databases'] = [database]
   msa.metadata['tool'] = 'jackhmmer'
+  msa.metadata['num_shards'] = num_shards
+  msa.metadata['staged'] = search_database_path != database_path
+  msa.metadata['prefilter_max_candidates'] = prefilter_max_candidates
+  record_cpu_usage(msa, cpu_usage)
 
   t1 = time.time()
   logging.info(f'Jackhmmer search completed. Elapsed time: {t1-t0}')
@@ -0,0 +1,429 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A k-mer prefilter shrinking the target database of jackhmmer searches.
+
+A precomputed inverted index maps the k-mers of a database, over a reduced
+amino acid alphabet, to the sequences containing them. The sequences sharing
+the most k-mers with a query are written to a small FASTA that jackhmmer
+searches instead of the full database (see alphafold_utils.run_jackhmmer).
+
+The index of `<database>.fasta` is written to `<database>.fasta_kmers/`:
+
+  python kmer_prefilter.py build \
+      --database_path=/mnt/nfs/uniref90/uniref90.fasta --k=5
+
+Evaluate mode measures the recall of the prefiltered searches against full
+scans, and their speed-up, on small synthetic databases:
+
+  python kmer_prefilter.py evaluate --work_dir=/tmp/prefilter_eval \
+      --ks=4,5 --max_candidates=500,2000 --min_shared_kmers=1,2
+"""
+
+import array
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+DEFAULT_K = 5
+
+# Murphy et al. 10-letter reduced alphabet, which keeps the k-mers of
+# sequences related by conservative substitutions identical.
+REDUCED_ALPHABET = ('LVIM', 'C', 'A', 'G', 'ST', 'P', 'FYW', 'EDNQ', 'KR', 'H')
+
+# K-mers found in more than this fraction of the sequences, as in
+# low-complexity regions, do not select candidates.
+MAX_KMER_FRACTION = 0.05
+
+# Residues of the (k-mer, sequence) pairs sorted in memory at once while
+# building an index.
+_BUILD_BATCH_RESIDUES = 1 << 26
+
+_ALPHABET_CODES = np.full(256, -1, dtype=np.int64)
+for _code, _letters in enumerate(REDUCED_ALPHABET):
+    for _letter in _letters:
+        _ALPHABET_CODES[ord(_letter)] = _code
+        _ALPHABET_CODES[ord(_letter.lower())] = _code
+
+
+def index_dir(database_path: str) -> str:
+    """Returns the directory of the k-mer index of a database."""
+    return f'{database_path}_kmers'
+
+
+def kmer_codes(sequence: bytes, k: int) -> np.ndarray:
+    """Returns the sorted unique k-mer codes of a sequence.
+
+    K-mers containing residues outside the alphabet, such as X, are skipped.
+    """
+    residues = _ALPHABET_CODES[np.frombuffer(sequence, dtype=np.uint8)]
+    if len(residues) < k:
+        return np.zeros(0, dtype=np.int64)
+    windows = np.lib.stride_tricks.sliding_window_view(residues, k)
+    windows = windows[(windows >= 0).all(axis=1)]
+    powers = len(REDUCED_ALPHABET) ** np.arange(k - 1, -1, -1, dtype=np.int64)
+    return np.unique(windows @ powers)
+
+
+def _scan_records(database_path: str) -> Iterator[Tuple[int, int, bytes]]:
+    """Streams the (offset, length, sequence) of the records of a FASTA."""
+    with open(database_path, 'rb') as f:
+        offset = 0
+        record_offset = None
+        lines = []
+        for line in f:
+            if line.startswith(b'>'):
+                if record_offset is not None:
+                    yield record_offset, offset - record_offset, b''.join(lines)
+                record_offset = offset
+                lines = []
+            elif record_offset is not None:
+                lines.append(line.strip())
+            offset += len(line)
+        if record_offset is not None:
+            yield record_offset, offset - record_offset, b''.join(lines)
+
+
+def _fingerprint(database_path: str) -> Dict[str, int]:
+    stat = os.stat(database_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def build_index(database_path: str, k: int = DEFAULT_K) -> Dict[str, Any]:
+    """Builds the k-mer index of a database. Returns its metadata.
+
+    The (k-mer, sequence) pairs are sorted in batches spilled to disk, then
+    written to a memory-mapped postings array in k-mer order, so that only
+    the byte offsets and lengths of the records are held in memory.
+    """
+    output_dir = index_dir(database_path)
+    os.makedirs(output_dir, exist_ok=True)
+    num_kmers = len(REDUCED_ALPHABET) ** k
+    counts = np.zeros(num_kmers, dtype=np.int64)
+    offsets = array.array('Q')
+    lengths = array.array('L')
+
+    t0 = time.time()
+    with tempfile.TemporaryDirectory(dir=output_dir) as spill_dir:
+        runs = []
+        batch_codes = []
+        batch_ordinals = []
+        batch_residues = 0
+
+        def spill():
+            codes = np.concatenate(batch_codes)
+            ordinals = np.concatenate(batch_ordinals)
+            order = np.argsort(codes, kind='stable')
+            run_path = os.path.join(spill_dir, f'{len(runs)}.npz')
+            np.savez(run_path, codes=codes[order], ordinals=ordinals[order])
+            runs.append(run_path)
+            counts[:] += np.bincount(codes, minlength=len(counts))
+
+        for ordinal, (offset, length, sequence) in enumerate(
+                _scan_records(database_path)):
+            offsets.append(offset)
+            lengths.append(length)
+            codes = kmer_codes(sequence, k)
+            batch_codes.append(codes)
+            batch_ordinals.append(np.full(len(codes), ordinal, dtype=np.uint32))
+            batch_residues += len(sequence)
+            if batch_residues >= _BUILD_BATCH_RESIDUES:
+                spill()
+                batch_codes, batch_ordinals, batch_residues = [], [], 0
+        if batch_codes:
+            spill()
+
+        pointers = np.zeros(num_kmers + 1, dtype=np.int64)
+        np.cumsum(counts, out=pointers[1:])
+        postings = np.lib.format.open_memmap(
+            os.path.join(output_dir, 'postings.npy'), mode='w+',
+            dtype=np.uint32, shape=(int(pointers[-1]),))
+        cursors = pointers[:-1].copy()
+        # Runs are in sequence order, so each k-mer's postings are sorted
+        for run_path in runs:
+            with np.load(run_path) as run:
+                codes, ordinals = run['codes'], run['ordinals']
+            unique_codes, starts, run_counts = np.unique(
+                codes, return_index=True, return_counts=True)
+            ranks = np.arange(len(codes)) - np.repeat(starts, run_counts)
+            postings[cursors[codes] + ranks] = ordinals
+            cursors[unique_codes] += run_counts
+        postings.flush()
+        del postings
+
+    np.save(os.path.join(output_dir, 'pointers.npy'), pointers)
+    np.save(os.path.join(output_dir, 'offsets.npy'),
+            np.frombuffer(offsets, dtype=np.uint64))
+    np.save(os.path.join(output_dir, 'lengths.npy'),
+            np.array(lengths, dtype=np.uint32))
+    metadata = {
+        'database_path': database_path,
+        'database': _fingerprint(database_path),
+        'k': k,
+        'alphabet': list(REDUCED_ALPHABET),
+        'num_sequences': len(offsets),
+        'num_postings': int(pointers[-1]),
+    }
+    with open(os.path.join(output_dir, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    logging.info(f'Indexed {len(offsets)} sequences of {database_path} in '
+                 f'{time.time() - t0:.1f} s')
+    return metadata
+
+
+def load_metadata(database_path: str) -> Dict[str, Any]:
+    """Returns the metadata of the index of a database.
+
+    Raises an error if there is no index or it is older than the database.
+    """
+    metadata_path = os.path.join(index_dir(database_path), 'metadata.json')
+    if not os.path.exists(metadata_path):
+        raise FileNotFoundError(f'No k-mer index of {database_path}')
+    with open(metadata_path) as f:
+        metadata = json.load(f)
+    if metadata['database'] != _fingerprint(database_path):
+        raise ValueError(f'The k-mer index of {database_path} is out of date')
+    return metadata
+
+
+def select_candidates(
+    query_sequence: str,
+    database_path: str,
+    max_candidates: int,
+    min_shared_kmers: int = 1
+) -> np.ndarray:
+    """Returns the sequences sharing the most k-mers with a query.
+
+    At most max_candidates sequences sharing at least min_shared_kmers
+    k-mers are returned, in database order.
+    """
+    metadata = load_metadata(database_path)
+    directory = index_dir(database_path)
+    pointers = np.load(os.path.join(directory, 'pointers.npy'), mmap_mode='r')
+    postings = np.load(os.path.join(directory, 'postings.npy'), mmap_mode='r')
+
+    max_postings = max(1, int(MAX_KMER_FRACTION * metadata['num_sequences']))
+    matches = []
+    for code in kmer_codes(query_sequence.encode(), metadata['k']):
+        start, end = int(pointers[code]), int(pointers[code + 1])
+        if 0 < end - start <= max_postings:
+            matches.append(postings[start:end])
+    if not matches:
+        return np.zeros(0, dtype=np.int64)
+
+    ordinals, shared = np.unique(np.concatenate(matches), return_counts=True)
+    keep = shared >= min_shared_kmers
+    ordinals, shared = ordinals[keep], shared[keep]
+    if len(ordinals) > max_candidates:
+        best = np.argsort(-shared, kind='stable')[:max_candidates]
+        ordinals = np.sort(ordinals[best])
+    return ordinals.astype(np.int64)
+
+
+def write_candidates(
+    database_path: str,
+    ordinals: Sequence[int],
+    output_path: str
+):
+    """Writes the records of the given sequences of a database to a FASTA."""
+    directory = index_dir(database_path)
+    offsets = np.load(os.path.join(directory, 'offsets.npy'), mmap_mode='r')
+    lengths = np.load(os.path.join(directory, 'lengths.npy'), mmap_mode='r')
+    with open(database_path, 'rb') as src, open(output_path, 'wb') as dst:
+        for ordinal in ordinals:
+            src.seek(int(offsets[ordinal]))
+            dst.write(src.read(int(lengths[ordinal])))
+
+
+def _random_sequence(length: int, rng: random.Random) -> str:
+    return ''.join(rng.choice('ACDEFGHIKLMNPQRSTVWY') for _ in range(length))
+
+
+def _mutate(sequence: str, identity: float, rng: random.Random) -> str:
+    """Returns a homolog of a sequence with substitutions and indels."""
+    residues = []
+    for residue in sequence:
+        if rng.random() < identity:
+            residues.append(residue)
+        elif rng.random() < 0.9:
+            residues.append(_random_sequence(1, rng))
+        elif rng.random() < 0.5:
+            residues.append(residue + _random_sequence(rng.randint(1, 3), rng))
+    return ''.join(residues)
+
+
+def make_synthetic_database(
+    work_dir: str,
+    num_queries: int = 3,
+    query_length: int = 250,
+    num_homologs: int = 200,
+    num_decoys: int = 20000,
+    seed: int = 0
+) -> Tuple[List[str], str]:
+    """Writes queries and a database of their homologs among random decoys.
+
+    The homologs span sequence identities from 25% to 95%, and some are
+    fragments. Returns the query FASTA paths and the database path.
+    """
+    rng = random.Random(seed)
+    query_paths = []
+    records = []
+    for query_index in range(num_queries):
+        query = _random_sequence(query_length, rng)
+        query_path = os.path.join(work_dir, f'query_{query_index}.fasta')
+        with open(query_path, 'w') as f:
+            f.write(f'>query_{query_index}\n{query}\n')
+        query_paths.append(query_path)
+        for homolog_index in range(num_homologs):
+            identity = 0.25 + 0.7 * homolog_index / num_homologs
+            homolog = _mutate(query, identity, rng)
+            if rng.random() < 0.2:
+                start = rng.randint(0, len(homolog) // 2)
+                homolog = homolog[start:start + rng.randint(50, 150)]
+            records.append((f'hom_{query_index}_{homolog_index}', homolog))
+    for decoy_index in range(num_decoys):
+        records.append((f'decoy_{decoy_index}',
+                        _random_sequence(rng.randint(50, 500), rng)))
+    rng.shuffle(records)
+
+    database_path = os.path.join(work_dir, 'database.fasta')
+    with open(database_path, 'w') as f:
+        for name, sequence in records:
+            lines = '\n'.join(
+                sequence[i:i + 60] for i in range(0, len(sequence), 60))
+            f.write(f'>{name}\n{lines}\n')
+    return query_paths, database_path
+
+
+def _hit_names(msa) -> set:
+    # The query is the first sequence
+    return {description.partition('/')[0]
+            for description in msa.descriptions[1:]}
+
+
+def evaluate(
+    work_dir: str,
+    ks: Sequence[int] = (4, DEFAULT_K),
+    max_candidates: Sequence[int] = (500, 2000),
+    min_shared_kmers: Sequence[int] = (1, 2),
+    maxseq: int = 10000,
+    n_cpu: int = 4,
+    **database_args
+) -> List[Dict[str, Any]]:
+    """Compares prefiltered jackhmmer searches of a synthetic database to
+    full scans.
+
+    Returns, per prefilter setting, the recall of the hits of the full scans
+    and the speed-up of the searches, averaged over the queries.
+    """
+    import alphafold_utils
+
+    os.makedirs(work_dir, exist_ok=True)
+    query_paths, database_path = make_synthetic_database(
+        work_dir, **database_args)
+
+    full_hits = {}
+    full_times = {}
+    for query_path in query_paths:
+        t0 = time.time()
+        msa, _ = alphafold_utils.run_jackhmmer(
+            input_path=query_path,
+            msa_path=os.path.join(work_dir, 'full.sto'),
+            database_path=database_path,
+            maxseq=maxseq,
+            n_cpu=n_cpu)
+        full_times[query_path] = time.time() - t0
+        full_hits[query_path] = _hit_names(msa)
+
+    report = []
+    for k in ks:
+        build_index(database_path, k)
+        for candidates in max_candidates:
+            for min_shared in min_shared_kmers:
+                recalls = []
+                speedups = []
+                for query_path in query_paths:
+                    t0 = time.time()
+                    msa, _ = alphafold_utils.run_jackhmmer(
+                        input_path=query_path,
+                        msa_path=os.path.join(work_dir, 'prefiltered.sto'),
+                        database_path=database_path,
+                        maxseq=maxseq,
+                        n_cpu=n_cpu,
+                        prefilter_max_candidates=candidates,
+                        prefilter_min_shared_kmers=min_shared)
+                    elapsed = time.time() - t0
+                    hits = full_hits[query_path]
+                    recalls.append(
+                        len(_hit_names(msa) & hits) / len(hits) if hits else 1.)
+                    speedups.append(full_times[query_path] / elapsed)
+                report.append({
+                    'k': k,
+                    'max_candidates': candidates,
+                    'min_shared_kmers': min_shared,
+                    'recall': round(float(np.mean(recalls)), 4),
+                    'min_recall': round(float(np.min(recalls)), 4),
+                    'speedup': round(float(np.mean(speedups)), 2),
+                })
+                logging.info(f'Prefilter {report[-1]}')
+    shutil.rmtree(index_dir(database_path), ignore_errors=True)
+    return report
+
+
+if __name__ == '__main__':
+    from absl import app
+    from absl import flags
+
+    flags.DEFINE_string('database_path', None, 'FASTA database to index')
+    flags.DEFINE_integer('k', DEFAULT_K, 'K-mer length of the index')
+    flags.DEFINE_string('work_dir', None,
+                        'Directory for the synthetic databases in evaluate mode')
+    flags.DEFINE_list('ks', ['4', str(DEFAULT_K)], 'K-mer lengths to evaluate')
+    flags.DEFINE_list('max_candidates', ['500', '2000'],
+                      'Candidate set sizes to evaluate')
+    flags.DEFINE_list('min_shared_kmers', ['1', '2'],
+                      'Minimum shared k-mers to evaluate')
+    flags.DEFINE_integer('num_decoys', 20000,
+                         'Random sequences of the synthetic databases')
+    flags.DEFINE_integer('n_cpu', 4, 'CPUs of the jackhmmer searches')
+    FLAGS = flags.FLAGS
+
+    def _main(argv):
+        command = argv[1] if len(argv) > 1 else 'build'
+        if command == 'build' and FLAGS.database_path:
+            print(json.dumps(build_index(FLAGS.database_path, FLAGS.k),
+                             indent=2))
+        elif command == 'evaluate':
+            report = evaluate(
+                work_dir=FLAGS.work_dir or tempfile.mkdtemp(),
+                ks=[int(k) for k in FLAGS.ks],
+                max_candidates=[int(n) for n in FLAGS.max_candidates],
+                min_shared_kmers=[int(n) for n in FLAGS.min_shared_kmers],
+                n_cpu=FLAGS.n_cpu,
+                num_decoys=FLAGS.num_decoys)
+            print(json.dumps(report, indent=2))
+        else:
+            raise app.UsageError(
+                'Usage: kmer_prefilter.py build|evaluate; build needs '
+                '--database_path')
+
+    logging.basicConfig(level=logging.INFO)
+    app.run(_main)
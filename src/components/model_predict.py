@@ -36,10 +36,35 @@ def predict(
     tf_force_unified_memory: str,
     xla_python_client_mem_fraction: str,
     raw_prediction: Output[Artifact],
-    unrelaxed_protein: Output[Artifact]
-):
-  """Configures and runs AlphaFold model runner."""
+    unrelaxed_protein: Output[Artifact],
+    pad_to_buckets: bool = False,
+    residue_buckets: list = [],
+    msa_buckets: list = [],
+    use_prediction_cache: str = 'false',
+    prediction_cache_bucket: str = '',
+    sampling_log_path: str = '',
+    max_recycles: int = -1,
+    recycle_early_stop_tolerance: float = None,
+    output_policy: str = 'full',
+    output_names: list = [],
+    half_precision: bool = False,
+    subbatch_size: int = 0,
+) -> dict:
+  """Configures and runs AlphaFold model runner.
 
+  Returns the ranking confidence and the output URIs of the prediction.
+  With a sampling_log_path, they are also logged to GCS for adaptive seed
+  sampling and relax target selection. max_recycles (-1 for the model
+  default) and recycle_early_stop_tolerance (None for the model default)
+  override the recycling settings of the model config.
+
+  output_policy 'slim' keeps only output_names (empty for the default
+  selection) of the raw prediction in an .npz file, as float16 arrays
+  with half_precision. A positive subbatch_size, usually from the memory
+  plan, overrides the attention subbatch size of the model config.
+  """
+
+  import json
   import logging
   import time
   import os
@@ -71,9 +96,10 @@ def predict(
   else:
     model_features_path = model_features.path
 
-  raw_prediction.uri = f'{raw_prediction.uri}.pkl'
+  raw_prediction_format = 'npz' if output_policy == 'slim' else 'pkl'
+  raw_prediction.uri = f'{raw_prediction.uri}.{raw_prediction_format}'
   unrelaxed_protein.uri = f'{unrelaxed_protein.uri}.pdb'
-  prediction_result = alphafold_predict(
+  prediction_result, prediction_metadata = alphafold_predict(
       model_features_path=model_features_path,
       model_params_path=model_params.path,
       model_name=model_name,
@@ -81,14 +107,42 @@ def predict(
       run_multimer_system=run_multimer_system,
       random_seed=random_seed,
       raw_prediction_path=raw_prediction.path,
-      unrelaxed_protein_path=unrelaxed_protein.path
+      unrelaxed_protein_path=unrelaxed_protein.path,
+      residue_buckets=residue_buckets if pad_to_buckets else [],
+      msa_buckets=msa_buckets if pad_to_buckets else [],
+      prediction_cache_dir=(
+          f'gs://{prediction_cache_bucket}/prediction_cache'
+          if use_prediction_cache == 'true' else None),
+      max_recycles=max_recycles,
+      recycle_early_stop_tolerance=recycle_early_stop_tolerance,
+      output_policy=output_policy,
+      output_names=output_names,
+      half_precision=half_precision,
+      subbatch_size=subbatch_size,
   )
 
   raw_prediction.metadata['category'] = 'raw_prediction'
+  raw_prediction.metadata['data_format'] = raw_prediction_format
   raw_prediction.metadata['prediction_index'] = prediction_index
-  raw_prediction.metadata['ranking_confidence'] = prediction_result[
-      'ranking_confidence']
+  raw_prediction.metadata['model_name'] = model_name
+  raw_prediction.metadata['ranking_confidence'] = float(
+      prediction_result['ranking_confidence'])
+  raw_prediction.metadata.update(prediction_metadata)
   unrelaxed_protein.metadata['category'] = 'unrelaxed_protein'
 
+  prediction = {
+      'model_name': model_name,
+      'prediction_index': prediction_index,
+      'ranking_confidence': float(prediction_result['ranking_confidence']),
+      'raw_prediction_uri': raw_prediction.uri,
+      'unrelaxed_protein_uri': unrelaxed_protein.uri,
+  }
+  if sampling_log_path:
+    bucket_name, _, blob_path = sampling_log_path[len('gs://'):].partition('/')
+    storage.Client().bucket(bucket_name).blob(blob_path).upload_from_string(
+        json.dumps(prediction))
+
   t1 = time.time()
   logging.info(f'Model prediction completed. Elapsed time: {t1-t0}')
+
+  return prediction
@@ -0,0 +1,31 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A component that outputs an empty artifact."""
+
+from kfp.v2 import dsl
+from kfp.v2.dsl import Artifact
+from kfp.v2.dsl import Output
+
+import config as config
+
+
+@dsl.component(
+    base_image=config.ALPHAFOLD_COMPONENTS_IMAGE
+)
+def no_op_artifact_output(empty_artifact: Output[Artifact]):
+  """Outputs an empty artifact, for inputs of skipped searches."""
+
+  with open(empty_artifact.path, 'w') as f:
+    f.write('')
@@ -0,0 +1,106 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A component that plans the accelerator memory of the predictions."""
+
+from typing import NamedTuple
+
+from kfp.v2 import dsl
+from kfp.v2.dsl import Artifact
+from kfp.v2.dsl import Input
+from kfp.v2.dsl import Output
+
+import config as config
+
+
+@dsl.component(
+    base_image=config.ALPHAFOLD_COMPONENTS_IMAGE,
+    packages_to_install=['google-cloud-storage']
+)
+def plan_memory(
+    model_features: Input[Artifact],
+    model_runners: list,
+    run_multimer_system: bool,
+    accelerator_type: str,
+    accelerator_memory_gb: float,
+    machine_tiers: list,
+    memory_plan: Output[Artifact],
+) -> NamedTuple(
+    'MemoryPlan',
+    [
+        ('tf_force_unified_memory', str),
+        ('xla_python_client_mem_fraction', str),
+        ('subbatch_size', int),
+        ('recommended_machine_type', str),
+        ('recommended_accelerator_type', str),
+    ]):
+  """Plans the memory settings of the predictions from the feature shapes.
+
+  The peak memory of the model is estimated from the number of residues,
+  MSA rows and templates in model_features for the model config of the first
+  model runner. The plan picks the attention subbatch size and memory
+  fraction for accelerator_type, and recommends the smallest of
+  machine_tiers that fits the prediction. Pipelines that do not plan memory
+  use default_memory_plan instead.
+  """
+
+  import collections
+  import json
+  import logging
+  import pickle
+  import tempfile
+
+  from google.cloud import storage
+
+  MemoryPlan = collections.namedtuple(
+      'MemoryPlan',
+      ['tf_force_unified_memory', 'xla_python_client_mem_fraction',
+       'subbatch_size', 'recommended_machine_type',
+       'recommended_accelerator_type'])
+
+  from alphafold.model import config as model_config
+  from alphafold_utils import plan_memory as alphafold_plan_memory
+
+  # Download model features from GCS if it's a GCS path
+  if model_features.uri.startswith('gs://'):
+    bucket_name, _, blob_path = model_features.uri[
+        len('gs://'):].partition('/')
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+      storage.Client().bucket(bucket_name).blob(
+          blob_path).download_to_filename(temp_file.name)
+      model_features_path = temp_file.name
+  else:
+    model_features_path = model_features.path
+  with open(model_features_path, 'rb') as f:
+    features = pickle.load(f)
+
+  plan = alphafold_plan_memory(
+      features=features,
+      model_config=model_config.model_config(model_runners[0]['model_name']),
+      run_multimer_system=run_multimer_system,
+      accelerator_memory_gb=accelerator_memory_gb,
+      machine_tiers=machine_tiers)
+  logging.info(f'Memory plan: {plan}')
+
+  memory_plan.metadata['category'] = 'memory_plan'
+  memory_plan.metadata['accelerator_type'] = accelerator_type
+  memory_plan.metadata.update(plan)
+  with open(memory_plan.path, 'w') as f:
+    json.dump(plan, f, indent=2)
+
+  return MemoryPlan(
+      plan['tf_force_unified_memory'],
+      plan['xla_python_client_mem_fraction'],
+      plan['subbatch_size'],
+      plan['recommended_machine_type'],
+      plan['recommended_accelerator_type'])
@@ -0,0 +1,52 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A component that plans the relaxation of the predictions of a run."""
+
+from kfp.v2 import dsl
+
+import config as config
+
+
+@dsl.component(
+    base_image=config.ALPHAFOLD_COMPONENTS_IMAGE
+)
+def plan_relax(
+    is_run_relax: str,
+    relax_policy: str,
+) -> str:
+  """Returns the relax mode of a run, for pipelines to branch on.
+
+  'all' relaxes each prediction as soon as it is done, 'selected' relaxes
+  the predictions selected by relax_policy once all of them are done and
+  'none' relaxes none.
+  """
+
+  import logging
+
+  from alphafold_utils import RELAX_POLICIES
+
+  if relax_policy not in RELAX_POLICIES:
+    raise ValueError(f'Unsupported relax policy: {relax_policy}')
+
+  if is_run_relax != 'relax' or relax_policy == 'none':
+    relax_mode = 'none'
+  elif relax_policy == 'all':
+    relax_mode = 'all'
+  else:
+    relax_mode = 'selected'
+
+  logging.info(f'Relax mode {relax_mode} for policy {relax_policy}')
+
+  return relax_mode
@@ -0,0 +1,99 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A component that plans a wave of adaptive seed sampling."""
+
+from kfp.v2 import dsl
+
+import config as config
+
+
+@dsl.component(
+    base_image=config.ALPHAFOLD_COMPONENTS_IMAGE,
+    packages_to_install=['google-cloud-storage']
+)
+def plan_sampling_wave(
+    wave_index: int,
+    model_runners: list,
+    sampling_bucket: str,
+    sampling_run_id: str,
+    plateau_tolerance: float,
+    max_predictions: int = 0,
+) -> list:
+  """Selects the model runners to launch in an adaptive sampling wave.
+
+  Predictions of earlier waves log their ranking confidence under
+  gs://<sampling_bucket>/adaptive_sampling/<sampling_run_id>. Once the top
+  ranking confidence has plateaued or max_predictions (0 for no budget)
+  predictions ran, sampling stops and this and all later waves are empty.
+  """
+
+  import json
+  import logging
+
+  from google.cloud import storage
+
+  from alphafold_utils import sampling_has_converged
+
+  client = storage.Client()
+  bucket = client.bucket(sampling_bucket)
+  sampling_prefix = f'adaptive_sampling/{sampling_run_id}'
+  stop_blob = bucket.blob(f'{sampling_prefix}/stopped.json')
+
+  wave_confidences = {}
+  for blob in client.list_blobs(
+      sampling_bucket, prefix=f'{sampling_prefix}/wave_'):
+    entry = json.loads(blob.download_as_text())
+    wave_confidences.setdefault(int(entry['prediction_index']), []).append(
+        float(entry['ranking_confidence']))
+  num_predictions = sum(len(wave) for wave in wave_confidences.values())
+  completed_waves = [
+      wave_confidences[index] for index in sorted(wave_confidences)
+      if index < wave_index]
+
+  stop_reason = None
+  if stop_blob.exists():
+    stop_reason = json.loads(stop_blob.download_as_text())['reason']
+  elif sampling_has_converged(completed_waves, plateau_tolerance):
+    stop_reason = 'plateau'
+  elif max_predictions and num_predictions >= max_predictions:
+    stop_reason = 'budget'
+
+  if stop_reason:
+    if not stop_blob.exists():
+      stop_blob.upload_from_string(json.dumps({
+          'reason': stop_reason,
+          'wave_index': wave_index,
+          'num_predictions': num_predictions,
+      }))
+    logging.info(f'Adaptive sampling stopped ({stop_reason}) after '
+                 f'{num_predictions} predictions, skipping wave {wave_index}')
+    return []
+
+  if max_predictions:
+    model_runners = model_runners[:max_predictions - num_predictions]
+
+  wave_runners = []
+  for runner in model_runners:
+    prediction_name = f'{runner["model_name"]}_pred_{runner["prediction_index"]}'
+    wave_runners.append({
+        **runner,
+        'sampling_log_path': (
+            f'gs://{sampling_bucket}/{sampling_prefix}/wave_{wave_index}/'
+            f'{prediction_name}.json'),
+    })
+
+  logging.info(f'Launching {len(wave_runners)} predictions in wave '
+               f'{wave_index} after {num_predictions} predictions')
+
+  return wave_runners
@@ -38,27 +38,92 @@ def predict_relax(
     raw_predictions: Output[Artifact],
     unrelaxed_proteins: Output[Artifact],
     relaxed_proteins: Output[Artifact],
+    pad_to_buckets: bool = False,
+    residue_buckets: list = [],
+    msa_buckets: list = [],
+    use_prediction_cache: str = 'false',
+    prediction_cache_bucket: str = '',
+    relax_workers: int = 0,
+    relax_policy: str = 'all',
+    relax_top_k: int = 1,
+    max_relax_violations: int = -1,
+    adaptive_sampling: str = 'false',
+    plateau_tolerance: float = 0.01,
+    max_predictions: int = 0,
+    max_recycles: int = -1,
+    recycle_early_stop_tolerance: float = None,
+    output_policy: str = 'full',
+    output_names: list = [],
+    half_precision: bool = False,
+    run_memory_planner: bool = False,
+    accelerator_memory_gb: float = 0.,
 ):
-    """Runs AlphaFold predictions and (optionally) relaxations sequentially."""
+    """Runs AlphaFold predictions and (optionally) relaxations.
+
+    With relax_workers > 0, relaxations run on CPU worker processes while the
+    following predictions run on the accelerator. relax_policy is one of
+    'all', 'best', 'top_k' or 'none' and selects the predictions to relax by
+    ranking confidence. With max_relax_violations >= 0, predictions with at
+    most max_relax_violations structural violations are copied through
+    instead of relaxed.
+
+    With adaptive_sampling 'true', the predictions run in waves of one seed
+    per model until the top ranking confidence improves by less than
+    plateau_tolerance in a wave, or max_predictions (0 for no budget)
+    predictions ran.
+
+    max_recycles (-1 for the model default) and recycle_early_stop_tolerance
+    (None for the model default) override the recycling settings of the
+    model config. output_policy 'slim' keeps only output_names (empty for
+    the default selection) of the raw predictions in .npz files, as float16
+    arrays with half_precision.
+
+    With run_memory_planner, the attention subbatch size and the memory
+    settings are planned from the feature shapes for an accelerator with
+    accelerator_memory_gb of memory (see alphafold_utils.plan_memory), and
+    the plan is recorded in the raw_predictions metadata.
+    """
 
     import json
     import logging
     import os
     import time
 
+    from alphafold_utils import plan_memory as alphafold_plan_memory
     from alphafold_utils import predict_relax as alphafold_predict_relax
 
     os.makedirs(raw_predictions.path, exist_ok=True)
     os.makedirs(unrelaxed_proteins.path, exist_ok=True)
     os.makedirs(relaxed_proteins.path, exist_ok=True)
 
+    subbatch_size = 0
+    if run_memory_planner:
+        import pickle
+        from alphafold.model import config as model_config
+
+        with open(model_features.path, 'rb') as f:
+            features = pickle.load(f)
+        memory_plan = alphafold_plan_memory(
+            features=features,
+            model_config=model_config.model_config(
+                prediction_runners[0]['model_name']),
+            run_multimer_system=run_multimer_system,
+            accelerator_memory_gb=accelerator_memory_gb)
+        del features
+        logging.info(f'Memory plan: {memory_plan}')
+        raw_predictions.metadata['memory_plan'] = json.dumps(memory_plan)
+        subbatch_size = memory_plan['subbatch_size']
+        tf_force_unified_memory = memory_plan['tf_force_unified_memory']
+        xla_python_client_mem_fraction = memory_plan[
+            'xla_python_client_mem_fraction']
+
     os.environ['TF_FORCE_UNIFIED_MEMORY'] = tf_force_unified_memory
     os.environ['XLA_PYTHON_CLIENT_MEM_FRACTION'] = xla_python_client_mem_fraction
 
     logging.info(f'Starting predictions on {prediction_runners} ...')
     t0 = time.time()
 
-    ranking_confidences = alphafold_predict_relax(
+    ranking_confidences, timings, prediction_metadata = alphafold_predict_relax(
         model_features_path=model_features.path,
         model_params_path=model_params.path,
         prediction_runners=prediction_runners,
@@ -68,11 +133,37 @@ def predict_relax(
         raw_prediction_path=raw_predictions.path,
         unrelaxed_protein_path=unrelaxed_proteins.path,
         relaxed_protein_path=relaxed_proteins.path,
+        residue_buckets=residue_buckets if pad_to_buckets else [],
+        msa_buckets=msa_buckets if pad_to_buckets else [],
+        prediction_cache_dir=(
+            f'gs://{prediction_cache_bucket}/prediction_cache'
+            if use_prediction_cache == 'true' else None),
+        relax_workers=relax_workers,
+        relax_policy=relax_policy,
+        relax_top_k=relax_top_k,
+        max_violations=max_relax_violations,
+        adaptive_sampling=(adaptive_sampling == 'true'),
+        plateau_tolerance=plateau_tolerance,
+        max_predictions=max_predictions,
+        max_recycles=max_recycles,
+        recycle_early_stop_tolerance=recycle_early_stop_tolerance,
+        output_policy=output_policy,
+        output_names=output_names,
+        half_precision=half_precision,
+        subbatch_size=subbatch_size,
     )
 
     raw_predictions.metadata['category'] = 'raw_predictions'
+    raw_predictions.metadata['data_format'] = (
+        'npz' if output_policy == 'slim' else 'pkl')
     raw_predictions.metadata['ranking_confidences'] = json.dumps(
         ranking_confidences)
+    raw_predictions.metadata['timings'] = json.dumps(timings)
+    raw_predictions.metadata['num_predictions'] = len(ranking_confidences)
+    raw_predictions.metadata['recycling'] = json.dumps(prediction_metadata)
+    raw_predictions.metadata['recycle_time_saved'] = sum(
+        metadata.get('recycle_time_saved', 0.)
+        for metadata in prediction_metadata.values())
     unrelaxed_proteins.metadata['category'] = 'unrelaxed_proteins'
     relaxed_proteins.metadata['category'] = 'relaxed_proteins'
 
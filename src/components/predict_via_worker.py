@@ -0,0 +1,114 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A component that submits an AlphaFold prediction to a warm worker."""
+
+
+from kfp.v2 import dsl
+from kfp.v2.dsl import Artifact
+from kfp.v2.dsl import Input
+from kfp.v2.dsl import Output
+
+import config as config
+
+@dsl.component(
+    base_image=config.ALPHAFOLD_COMPONENTS_IMAGE
+)
+def predict_via_worker(
+    model_features: Input[Artifact],
+    model_name: str,
+    prediction_index: int,
+    num_ensemble: int,
+    run_multimer_system: bool,
+    random_seed: int,
+    prediction_worker_address: str,
+    raw_prediction: Output[Artifact],
+    unrelaxed_protein: Output[Artifact],
+    pad_to_buckets: bool = False,
+    residue_buckets: list = [],
+    msa_buckets: list = [],
+    use_prediction_cache: str = 'false',
+    prediction_cache_bucket: str = '',
+    max_recycles: int = -1,
+    recycle_early_stop_tolerance: float = None,
+    output_policy: str = 'full',
+    output_names: list = [],
+    half_precision: bool = False,
+    subbatch_size: int = 0,
+    timeout: int = 7200,
+) -> dict:
+  """Submits a prediction to a long-lived prediction worker.
+
+  The worker (see prediction_worker.py) keeps the model runners warm and
+  writes the outputs to the artifact URIs. Returns the ranking confidence
+  and the output URIs of the prediction, as predict does. prediction_worker_address is
+  tcp://<host>:<port> or a file queue directory shared with the worker.
+  """
+
+  import logging
+  import time
+
+  from prediction_worker import submit_job
+
+  logging.info(f'Submitting prediction {prediction_index} using model '
+               f'{model_name} to {prediction_worker_address}...')
+  t0 = time.time()
+
+  raw_prediction_format = 'npz' if output_policy == 'slim' else 'pkl'
+  raw_prediction.uri = f'{raw_prediction.uri}.{raw_prediction_format}'
+  unrelaxed_protein.uri = f'{unrelaxed_protein.uri}.pdb'
+  result = submit_job(
+      worker_address=prediction_worker_address,
+      job={
+          'model_features_path': model_features.uri,
+          'model_name': model_name,
+          'num_ensemble': num_ensemble,
+          'run_multimer_system': run_multimer_system,
+          'random_seed': int(random_seed),
+          'raw_prediction_path': raw_prediction.uri,
+          'unrelaxed_protein_path': unrelaxed_protein.uri,
+          'options': {
+              'residue_buckets': residue_buckets if pad_to_buckets else [],
+              'msa_buckets': msa_buckets if pad_to_buckets else [],
+              'prediction_cache_dir': (
+                  f'gs://{prediction_cache_bucket}/prediction_cache'
+                  if use_prediction_cache == 'true' else None),
+              'max_recycles': max_recycles,
+              'recycle_early_stop_tolerance': recycle_early_stop_tolerance,
+              'output_policy': output_policy,
+              'output_names': output_names,
+              'half_precision': half_precision,
+              'subbatch_size': subbatch_size,
+          },
+      },
+      timeout=timeout)
+
+  raw_prediction.metadata['category'] = 'raw_prediction'
+  raw_prediction.metadata['data_format'] = raw_prediction_format
+  raw_prediction.metadata['prediction_index'] = prediction_index
+  raw_prediction.metadata['model_name'] = model_name
+  raw_prediction.metadata['ranking_confidence'] = result['ranking_confidence']
+  raw_prediction.metadata['worker_elapsed_time'] = result['elapsed_time']
+  raw_prediction.metadata.update(result['prediction_metadata'])
+  unrelaxed_protein.metadata['category'] = 'unrelaxed_protein'
+
+  t1 = time.time()
+  logging.info(f'Model prediction completed. Elapsed time: {t1-t0}')
+
+  return {
+      'model_name': model_name,
+      'prediction_index': prediction_index,
+      'ranking_confidence': float(result['ranking_confidence']),
+      'raw_prediction_uri': raw_prediction.uri,
+      'unrelaxed_protein_uri': unrelaxed_protein.uri,
+  }
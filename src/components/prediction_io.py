@@ -0,0 +1,50 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Loading of raw prediction results, without depending on AlphaFold.
+
+Raw predictions are pickled prediction results, or slim columnar .npz files
+with one array per kept output (see alphafold_utils.save_prediction_result).
+The analysis notebooks load them with the same helper as the components.
+"""
+
+import pickle
+from typing import Any, Dict
+
+import numpy as np
+
+
+def load_prediction_result(prediction_result_path: str) -> Dict[str, Any]:
+    """Loads a pickled or slim (.npz) prediction result.
+
+    Outputs of slim predictions are nested by their '/'-joined names, so both
+    formats are indexed the same way, e.g.
+    ['structure_module']['final_atom_positions']. Scalar outputs, such as the
+    ranking confidence, come back as Python scalars rather than 0-d arrays.
+    """
+    with open(prediction_result_path, 'rb') as f:
+        is_npz = f.read(4) == b'PK\x03\x04'
+        f.seek(0)
+        if not is_npz:
+            return pickle.load(f)
+        with np.load(f, allow_pickle=False) as outputs:
+            prediction_result = {}
+            for name in outputs.files:
+                *parents, leaf = name.split('/')
+                node = prediction_result
+                for parent in parents:
+                    node = node.setdefault(parent, {})
+                value = outputs[name]
+                node[leaf] = value.item() if value.ndim == 0 else value
+    return prediction_result
@@ -0,0 +1,410 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A long-lived AlphaFold prediction worker.
+
+The worker keeps model runners, parameters and compiled executables warm
+across predictions, and serves predict jobs from a file queue or a socket:
+
+  python prediction_worker.py serve --model_params_path=/gcs/bucket/params \
+      --queue_dir=/mnt/nfs/alphafold/prediction_queue
+  python prediction_worker.py serve --model_params_path=/gcs/bucket/params \
+      --port=8470
+
+Jobs are submitted with submit_job, by the predict_via_worker component for
+example. Benchmark mode runs jobs in-process and reports jobs per hour:
+
+  python prediction_worker.py benchmark --platform=cpu \
+      --model_params_path=/path/to/params \
+      --model_features_path=/path/to/features.pkl \
+      --model_names=model_1_multimer_v3 --num_jobs=5
+"""
+
+import collections
+import json
+import logging
+import os
+import shutil
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from typing import Any, Dict, Mapping, Optional
+
+GCS_FUSE_ROOT = '/gcs'
+TCP_PREFIX = 'tcp://'
+
+# Staged model features kept on local disk, most recent last.
+MAX_STAGED_FEATURES = 4
+
+
+def _split_gcs_uri(uri: str):
+    bucket_name, _, blob_path = uri[len('gs://'):].partition('/')
+    return bucket_name, blob_path
+
+
+def _write_json_atomic(path: str, value: Mapping[str, Any]):
+    """Writes a JSON file that readers never see partially written."""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(value, f)
+    os.rename(tmp_path, path)
+
+
+class FileJobQueue:
+    """A job queue in a directory shared by the worker and its clients.
+
+    Jobs move from pending/ to running/ to done/. Claiming a job is an
+    atomic rename, so several workers can serve the same queue.
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+
+    def __init__(self, queue_dir: str):
+        self._queue_dir = queue_dir
+        for state in (self.PENDING, self.RUNNING, self.DONE):
+            os.makedirs(os.path.join(queue_dir, state), exist_ok=True)
+
+    def _path(self, state: str, job_id: str) -> str:
+        return os.path.join(self._queue_dir, state, f'{job_id}.json')
+
+    def submit(self, job: Mapping[str, Any]) -> str:
+        """Adds a job to the queue and returns its ID."""
+        job_id = job.get('job_id') or uuid.uuid4().hex
+        _write_json_atomic(
+            self._path(self.PENDING, job_id), {**job, 'job_id': job_id})
+        return job_id
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """Claims the oldest pending job, or returns None if there is none."""
+        pending_dir = os.path.join(self._queue_dir, self.PENDING)
+        pending = [
+            name for name in os.listdir(pending_dir) if name.endswith('.json')]
+        pending.sort(key=lambda name: os.path.getmtime(
+            os.path.join(pending_dir, name)))
+        for name in pending:
+            job_id = name[:-len('.json')]
+            running_path = self._path(self.RUNNING, job_id)
+            try:
+                os.rename(self._path(self.PENDING, job_id), running_path)
+            except FileNotFoundError:
+                continue  # Claimed by another worker.
+            with open(running_path) as f:
+                return json.load(f)
+        return None
+
+    def complete(self, job_id: str, result: Mapping[str, Any]):
+        """Publishes the result of a claimed job."""
+        _write_json_atomic(self._path(self.DONE, job_id), result)
+        os.remove(self._path(self.RUNNING, job_id))
+
+    def wait(
+        self,
+        job_id: str,
+        timeout: float,
+        poll_interval: float = 5.,
+    ) -> Dict[str, Any]:
+        """Waits for the result of a job."""
+        done_path = self._path(self.DONE, job_id)
+        deadline = time.time() + timeout
+        while not os.path.exists(done_path):
+            if time.time() > deadline:
+                raise TimeoutError(f'Prediction job {job_id} timed out')
+            time.sleep(poll_interval)
+        with open(done_path) as f:
+            result = json.load(f)
+        os.remove(done_path)
+        return result
+
+
+class PredictionWorker:
+    """Runs predict jobs with warm model runners.
+
+    A job holds the alphafold_utils.predict arguments except the model
+    parameters, which belong to the worker. Paths may be local or gs://
+    URIs. GCS paths go through the Cloud Storage FUSE mount when present.
+    """
+
+    def __init__(self, model_params_path: str, work_dir: Optional[str] = None):
+        # Imported here, so that clients submitting jobs do not import JAX.
+        import alphafold_utils
+
+        self._alphafold_utils = alphafold_utils
+        self._model_params_path = model_params_path
+        self._runner_cache = alphafold_utils.ModelRunnerCache()
+        self._work_dir = work_dir or tempfile.mkdtemp(prefix='prediction_worker')
+        self._staged_features = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _fuse_path(self, uri: str) -> Optional[str]:
+        if uri.startswith('gs://') and os.path.isdir(GCS_FUSE_ROOT):
+            return os.path.join(GCS_FUSE_ROOT, uri[len('gs://'):])
+        return None
+
+    def _stage_features(self, uri: str) -> str:
+        """Returns a local copy of model features, reused across jobs."""
+        if not uri.startswith('gs://'):
+            return uri
+        if uri in self._staged_features:
+            self._staged_features.move_to_end(uri)
+            return self._staged_features[uri]
+
+        local_path = os.path.join(self._work_dir, f'{uuid.uuid4().hex}.pkl')
+        fuse_path = self._fuse_path(uri)
+        if fuse_path:
+            shutil.copyfile(fuse_path, local_path)
+        else:
+            from google.cloud import storage
+            bucket_name, blob_path = _split_gcs_uri(uri)
+            storage.Client().bucket(bucket_name).blob(
+                blob_path).download_to_filename(local_path)
+
+        self._staged_features[uri] = local_path
+        while len(self._staged_features) > MAX_STAGED_FEATURES:
+            _, evicted_path = self._staged_features.popitem(last=False)
+            os.remove(evicted_path)
+        return local_path
+
+    def _output_path(self, uri: str, tmp_dir: str) -> str:
+        if not uri.startswith('gs://'):
+            os.makedirs(os.path.dirname(uri) or '.', exist_ok=True)
+            return uri
+        fuse_path = self._fuse_path(uri)
+        if fuse_path:
+            os.makedirs(os.path.dirname(fuse_path), exist_ok=True)
+            return fuse_path
+        return os.path.join(tmp_dir, os.path.basename(uri))
+
+    def _upload_output(self, local_path: str, uri: str):
+        if not uri.startswith('gs://') or self._fuse_path(uri):
+            return
+        from google.cloud import storage
+        bucket_name, blob_path = _split_gcs_uri(uri)
+        storage.Client().bucket(bucket_name).blob(
+            blob_path).upload_from_filename(local_path)
+
+    def run(self, job: Mapping[str, Any]) -> Dict[str, Any]:
+        """Runs a predict job and returns its result."""
+        job_id = job.get('job_id', '')
+        t_0 = time.time()
+        # Jobs share the accelerator, so they run one at a time.
+        with self._lock, tempfile.TemporaryDirectory(dir=self._work_dir) as tmp_dir:
+            try:
+                raw_prediction_path = self._output_path(
+                    job['raw_prediction_path'], tmp_dir)
+                unrelaxed_protein_path = self._output_path(
+                    job['unrelaxed_protein_path'], tmp_dir)
+                prediction_result, prediction_metadata = (
+                    self._alphafold_utils.predict(
+                        model_features_path=self._stage_features(
+                            job['model_features_path']),
+                        model_params_path=self._model_params_path,
+                        model_name=job['model_name'],
+                        num_ensemble=job['num_ensemble'],
+                        run_multimer_system=job['run_multimer_system'],
+                        random_seed=job['random_seed'],
+                        raw_prediction_path=raw_prediction_path,
+                        unrelaxed_protein_path=unrelaxed_protein_path,
+                        runner_cache=self._runner_cache,
+                        **job.get('options', {})))
+                self._upload_output(
+                    raw_prediction_path, job['raw_prediction_path'])
+                self._upload_output(
+                    unrelaxed_protein_path, job['unrelaxed_protein_path'])
+            except Exception as e:
+                logging.error(f'Prediction job {job_id} failed: {e}')
+                return {
+                    'job_id': job_id,
+                    'status': 'failed',
+                    'error': traceback.format_exc(),
+                    'elapsed_time': time.time() - t_0,
+                }
+
+        elapsed_time = time.time() - t_0
+        logging.info(f'Prediction job {job_id} completed. '
+                     f'Elapsed time: {elapsed_time}')
+        return {
+            'job_id': job_id,
+            'status': 'succeeded',
+            'ranking_confidence': float(
+                prediction_result['ranking_confidence']),
+            'prediction_metadata': prediction_metadata,
+            'elapsed_time': elapsed_time,
+        }
+
+
+def serve_queue(
+    worker: PredictionWorker,
+    queue_dir: str,
+    poll_interval: float = 5.,
+):
+    """Serves jobs from a file queue until interrupted."""
+    queue = FileJobQueue(queue_dir)
+    logging.info(f'Serving prediction jobs from {queue_dir}')
+    while True:
+        job = queue.claim()
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        queue.complete(job['job_id'], worker.run(job))
+
+
+def serve_socket(worker: PredictionWorker, host: str, port: int):
+    """Serves jobs sent as JSON lines over TCP until interrupted.
+
+    Each connection sends one job and receives its result.
+    """
+
+    class _Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            job = json.loads(self.rfile.readline())
+            result = worker.run(job)
+            self.wfile.write(json.dumps(result).encode() + b'\n')
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    with socketserver.ThreadingTCPServer((host, port), _Handler) as server:
+        logging.info(f'Serving prediction jobs on {host}:{port}')
+        server.serve_forever()
+
+
+def submit_job(
+    worker_address: str,
+    job: Mapping[str, Any],
+    timeout: float = 7200.,
+) -> Dict[str, Any]:
+    """Submits a job to a prediction worker and waits for its result.
+
+    worker_address is tcp://<host>:<port> for a socket worker, or the queue
+    directory of a file queue worker.
+    """
+    job = {**job, 'job_id': job.get('job_id') or uuid.uuid4().hex}
+    if worker_address.startswith(TCP_PREFIX):
+        host, _, port = worker_address[len(TCP_PREFIX):].rpartition(':')
+        with socket.create_connection((host, int(port)), timeout=timeout) as s:
+            s.sendall(json.dumps(job).encode() + b'\n')
+            with s.makefile('rb') as f:
+                result = json.loads(f.readline())
+    else:
+        queue = FileJobQueue(worker_address)
+        result = queue.wait(queue.submit(job), timeout)
+
+    if result['status'] != 'succeeded':
+        raise RuntimeError(
+            f'Prediction job {job["job_id"]} failed:\n{result.get("error")}')
+    return result
+
+
+def benchmark(
+    worker: PredictionWorker,
+    model_features_path: str,
+    model_names,
+    num_jobs: int,
+    output_dir: str,
+    run_multimer_system: bool = True,
+    options: Optional[Mapping[str, Any]] = None,
+) -> Dict[str, float]:
+    """Runs jobs on a worker and measures its throughput.
+
+    The first job of each model is cold: it loads the parameters and
+    compiles the model. The following jobs reuse the warm runners.
+    """
+    latencies = []
+    for i in range(num_jobs):
+        model_name = model_names[i % len(model_names)]
+        result = worker.run({
+            'job_id': f'benchmark_{i}',
+            'model_features_path': model_features_path,
+            'model_name': model_name,
+            'num_ensemble': 1,
+            'run_multimer_system': run_multimer_system,
+            'random_seed': i,
+            'raw_prediction_path': os.path.join(output_dir, f'result_{i}.pkl'),
+            'unrelaxed_protein_path': os.path.join(
+                output_dir, f'unrelaxed_{i}.pdb'),
+            'options': dict(options or {}),
+        })
+        if result['status'] != 'succeeded':
+            raise RuntimeError(result['error'])
+        latencies.append(result['elapsed_time'])
+
+    num_cold = min(len(model_names), num_jobs)
+    cold, warm = latencies[:num_cold], latencies[num_cold:]
+    report = {
+        'num_jobs': num_jobs,
+        'cold_latency': sum(cold) / len(cold),
+        'cold_jobs_per_hour': 3600. * len(cold) / sum(cold),
+        'jobs_per_hour': 3600. * num_jobs / sum(latencies),
+    }
+    if warm:
+        report['warm_latency'] = sum(warm) / len(warm)
+        report['warm_jobs_per_hour'] = 3600. * len(warm) / sum(warm)
+    return report
+
+
+if __name__ == '__main__':
+    from absl import app
+    from absl import flags
+
+    flags.DEFINE_string('model_params_path', None,
+                        'Directory with the params/ of the AlphaFold models')
+    flags.DEFINE_string('queue_dir', None, 'File queue directory to serve')
+    flags.DEFINE_string('host', '0.0.0.0', 'Host to serve the socket on')
+    flags.DEFINE_integer('port', None, 'Port to serve the socket on')
+    flags.DEFINE_string('work_dir', None, 'Directory for staged files')
+    flags.DEFINE_string('platform', None,
+                        'JAX platform to run on, e.g. cpu for local benchmarks')
+    flags.DEFINE_string('model_features_path', None,
+                        'Features to predict in benchmark mode')
+    flags.DEFINE_list('model_names', ['model_1_multimer_v3'],
+                      'Models to predict in benchmark mode')
+    flags.DEFINE_integer('num_jobs', 5, 'Number of benchmark jobs')
+    flags.DEFINE_bool('run_multimer_system', True,
+                      'Whether the benchmark features are multimer features')
+    flags.DEFINE_string('output_dir', None, 'Benchmark output directory')
+    flags.mark_flag_as_required('model_params_path')
+    FLAGS = flags.FLAGS
+
+    def _main(argv):
+        if FLAGS.platform:
+            import jax
+            jax.config.update('jax_platforms', FLAGS.platform)
+        worker = PredictionWorker(FLAGS.model_params_path, FLAGS.work_dir)
+
+        command = argv[1] if len(argv) > 1 else 'serve'
+        if command == 'benchmark':
+            report = benchmark(
+                worker=worker,
+                model_features_path=FLAGS.model_features_path,
+                model_names=FLAGS.model_names,
+                num_jobs=FLAGS.num_jobs,
+                output_dir=FLAGS.output_dir or tempfile.mkdtemp(),
+                run_multimer_system=FLAGS.run_multimer_system)
+            print(json.dumps(report, indent=2))
+        elif command == 'serve' and FLAGS.port:
+            serve_socket(worker, FLAGS.host, FLAGS.port)
+        elif command == 'serve' and FLAGS.queue_dir:
+            serve_queue(worker, FLAGS.queue_dir)
+        else:
+            raise app.UsageError(
+                'Usage: prediction_worker.py serve|benchmark; serve needs '
+                '--port or --queue_dir')
+
+    logging.basicConfig(level=logging.INFO)
+    app.run(_main)
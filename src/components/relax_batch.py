@@ -0,0 +1,123 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A component that relaxes a batch of predictions in one task."""
+
+from kfp.v2 import dsl
+from kfp.v2.dsl import Artifact
+from kfp.v2.dsl import Output
+
+import config as config
+from typing import List
+
+
+@dsl.component(
+    base_image=config.ALPHAFOLD_COMPONENTS_IMAGE,
+    packages_to_install=['google-cloud-storage']
+)
+def relax_batch(
+    relax_targets: list,
+    relaxed_proteins: Output[Artifact],
+    max_iterations: int = 0,
+    tolerance: float = 2.39,
+    stiffness: float = 10.0,
+    exclude_residues: List[str] = [],
+    max_outer_iterations: int = 3,
+    use_gpu: bool = False,
+    num_workers: int = 0,
+    max_violations: int = -1,
+):
+  """Configures and runs Amber relaxation of a batch of predictions.
+
+  relax_targets hold the unrelaxed_protein_uri of each prediction to relax
+  (see select_relax_targets). On the CPU, the predictions are relaxed in a
+  pool of num_workers processes (0 for one per CPU core). One relaxed PDB
+  per target is written to the relaxed_proteins directory. Targets with at
+  most max_violations structural violations are copied through (-1 relaxes
+  every target).
+  """
+
+  import json
+  import logging
+  import os
+  import tempfile
+  import time
+
+  from google.cloud import storage
+
+  from alphafold_utils import relax_proteins
+
+  t0 = time.time()
+  logging.info(f'Starting relaxation of {len(relax_targets)} predictions ...')
+
+  storage_client = storage.Client()
+  download_dir = tempfile.mkdtemp()
+  os.makedirs(relaxed_proteins.path, exist_ok=True)
+
+  unrelaxed_protein_paths = []
+  relaxed_protein_paths = []
+  relaxed_protein_uris = {}
+  for index, relax_target in enumerate(relax_targets):
+    unrelaxed_protein_uri = relax_target['unrelaxed_protein_uri']
+    # Outputs of a predict task are named after the task directory.
+    task_name = os.path.basename(os.path.dirname(unrelaxed_protein_uri))
+    unrelaxed_protein_path = os.path.join(
+        download_dir, f'unrelaxed_{index}_{task_name}.pdb')
+    if unrelaxed_protein_uri.startswith('gs://'):
+      bucket_name, _, blob_path = unrelaxed_protein_uri[
+          len('gs://'):].partition('/')
+      storage_client.bucket(bucket_name).blob(
+          blob_path).download_to_filename(unrelaxed_protein_path)
+    else:
+      unrelaxed_protein_path = unrelaxed_protein_uri
+    relaxed_protein_name = f'relaxed_{index}_{task_name}.pdb'
+    unrelaxed_protein_paths.append(unrelaxed_protein_path)
+    relaxed_protein_paths.append(
+        os.path.join(relaxed_proteins.path, relaxed_protein_name))
+    relaxed_protein_uris[unrelaxed_protein_uri] = (
+        f'{relaxed_proteins.uri}/{relaxed_protein_name}')
+
+  timings, relax_metadata = relax_proteins(
+      unrelaxed_protein_paths=unrelaxed_protein_paths,
+      relaxed_protein_paths=relaxed_protein_paths,
+      max_iterations=max_iterations,
+      tolerance=tolerance,
+      stiffness=stiffness,
+      exclude_residues=exclude_residues,
+      max_outer_iterations=max_outer_iterations,
+      use_gpu=use_gpu,
+      num_workers=num_workers,
+      max_violations=max_violations,
+  )
+
+  relaxed_proteins.metadata['category'] = 'relaxed_proteins'
+  relaxed_proteins.metadata['num_relaxed'] = len(relax_targets)
+  relaxed_proteins.metadata['relaxed_protein_uris'] = json.dumps(
+      relaxed_protein_uris)
+  relaxed_proteins.metadata['timings'] = json.dumps({
+      relax_target['unrelaxed_protein_uri']: timings[unrelaxed_protein_path]
+      for relax_target, unrelaxed_protein_path in zip(
+          relax_targets, unrelaxed_protein_paths)
+  })
+  relaxed_proteins.metadata['relax_metadata'] = json.dumps({
+      relax_target['unrelaxed_protein_uri']: relax_metadata[
+          unrelaxed_protein_path]
+      for relax_target, unrelaxed_protein_path in zip(
+          relax_targets, unrelaxed_protein_paths)
+  })
+  relaxed_proteins.metadata['num_relax_skipped'] = sum(
+      metadata.get('relax_skipped', False)
+      for metadata in relax_metadata.values())
+
+  t1 = time.time()
+  logging.info(f'Batch relaxation completed. Elapsed time: {t1-t0}')
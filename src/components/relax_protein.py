@@ -36,9 +36,15 @@ def relax(
     max_outer_iterations: int = 3,
     use_gpu: bool = True,
     tf_force_unified_memory: str = '',
-    xla_python_client_mem_fraction: str = ''
+    xla_python_client_mem_fraction: str = '',
+    max_violations: int = -1
 ):
-  """Configures and runs Amber relaxation."""
+  """Configures and runs Amber relaxation.
+
+  With max_violations >= 0, a prediction with at most max_violations
+  structural violations is copied through instead of relaxed. The violation
+  counts and the decision are recorded in the relaxed_protein metadata.
+  """
 
   import logging
   import time
@@ -53,7 +59,7 @@ def relax(
   logging.info('Starting model relaxation ...')
 
   relaxed_protein.uri = f'{relaxed_protein.uri}.pdb'
-  relaxed_protein_pdb = relax_protein(
+  relaxed_protein_pdb, relax_metadata = relax_protein(
       unrelaxed_protein_path=unrelaxed_protein.path,
       relaxed_protein_path=relaxed_protein.path,
       max_iterations=max_iterations,
@@ -61,10 +67,12 @@ def relax(
       stiffness=stiffness,
       exclude_residues=exclude_residues,
       max_outer_iterations=max_outer_iterations,
-      use_gpu=use_gpu
+      use_gpu=use_gpu,
+      max_violations=max_violations
   )
 
   relaxed_protein.metadata['category'] = 'relaxed_protein'
+  relaxed_protein.metadata.update(relax_metadata)
 
   t1 = time.time()
   logging.info(f'Model relaxation completed. Elapsed time: {t1-t0}')
@@ -0,0 +1,385 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A resident hmmsearch daemon, in the spirit of HMMER's hmmpgmd.
+
+The daemon reads sequence databases such as pdb_seqres into memory once and
+answers hmmsearch queries against them over a Unix or TCP socket, so that
+the template search of each chain does not re-read and re-parse the whole
+database:
+
+  python search_daemon.py serve --socket_path=/tmp/search_daemon.sock \
+      --database_paths=/mnt/nfs/alphafold/pdb_seqres/pdb_seqres.txt
+  python search_daemon.py serve --port=8471 \
+      --database_paths=/mnt/nfs/alphafold/pdb_seqres/pdb_seqres.txt
+
+Searches run in-process with pyhmmer, which wraps the HMMER library, and
+write the same Stockholm alignment as `hmmsearch -A`. Clients query the
+daemon with search, as alphafold_utils.run_hmmsearch does when it is given a
+daemon address, and fall back to the hmmsearch binary when the daemon is not
+reachable or does not hold the database. Benchmark mode compares the daemon
+with the hmmsearch binary on an HMM:
+
+  python search_daemon.py benchmark --hmm_path=/path/to/query.hmm \
+      --database_paths=/path/to/pdb_seqres.txt --num_queries=5
+"""
+
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
+import traceback
+from typing import Any, Dict, Mapping, Optional, Sequence
+
+TCP_PREFIX = 'tcp://'
+
+# hmmsearch options and the pyhmmer.hmmer.hmmsearch arguments they map to
+_OPTIONS = {
+    '-E': 'E',
+    '-T': 'T',
+    '-Z': 'Z',
+    '--domE': 'domE',
+    '--domT': 'domT',
+    '--domZ': 'domZ',
+    '--incE': 'incE',
+    '--incT': 'incT',
+    '--incdomE': 'incdomE',
+    '--incdomT': 'incdomT',
+    '--F1': 'F1',
+    '--F2': 'F2',
+    '--F3': 'F3',
+}
+
+
+def hmmsearch_options(flags: Sequence[str]) -> Dict[str, float]:
+    """Converts hmmsearch command line flags into pyhmmer arguments.
+
+    Raises ValueError for flags the daemon does not support, so that clients
+    fall back to the hmmsearch binary rather than search with other settings.
+    """
+    flags = list(flags)
+    if len(flags) % 2:
+        raise ValueError(f'Expected flag and value pairs, got {flags}')
+    options = {}
+    for flag, value in zip(flags[::2], flags[1::2]):
+        if flag not in _OPTIONS:
+            raise ValueError(f'Unsupported hmmsearch flag {flag}')
+        options[_OPTIONS[flag]] = float(value)
+    return options
+
+
+def _fingerprint(path: str):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class SearchDaemon:
+    """Holds sequence databases in memory and searches them with HMMs.
+
+    Databases are keyed by their real path, and are read again when their
+    size or modification time changes.
+    """
+
+    def __init__(self, database_paths: Sequence[str], n_cpu: int = 0):
+        import pyhmmer
+
+        self._pyhmmer = pyhmmer
+        self._alphabet = pyhmmer.easel.Alphabet.amino()
+        self._n_cpu = n_cpu
+        self._databases = {}
+        self._lock = threading.Lock()
+        for database_path in database_paths:
+            self._load(os.path.realpath(database_path))
+
+    def _load(self, database_path: str):
+        t0 = time.time()
+        fingerprint = _fingerprint(database_path)
+        with self._pyhmmer.easel.SequenceFile(
+                database_path, digital=True, alphabet=self._alphabet,
+                format='fasta') as f:
+            sequences = f.read_block()
+        self._databases[database_path] = {
+            'fingerprint': fingerprint,
+            'sequences': sequences,
+        }
+        logging.info(f'Loaded {len(sequences)} sequences of {database_path} '
+                     f'in {time.time() - t0:.1f}s')
+
+    def _sequences(self, database_path: str):
+        database_path = os.path.realpath(database_path)
+        with self._lock:
+            database = self._databases.get(database_path)
+            if database is None:
+                raise KeyError(f'Database {database_path} is not loaded')
+            if database['fingerprint'] != _fingerprint(database_path):
+                logging.info(f'Database {database_path} changed, reloading')
+                self._load(database_path)
+            return self._databases[database_path]['sequences']
+
+    def status(self) -> Dict[str, Any]:
+        """Returns the databases held by the daemon."""
+        with self._lock:
+            return {
+                'status': 'succeeded',
+                'databases': {
+                    path: {'num_sequences': len(database['sequences'])}
+                    for path, database in self._databases.items()},
+            }
+
+    def hmmsearch(
+        self,
+        database_path: str,
+        hmm: str,
+        flags: Sequence[str] = (),
+    ) -> str:
+        """Searches a database with HMMs and returns the hits as Stockholm.
+
+        hmm may hold several HMMs, which are searched in one pass over the
+        database. The alignments are those `hmmsearch -A` writes: for each
+        HMM with included hits, the hits untrimmed and named after the HMM.
+        """
+        sequences = self._sequences(database_path)
+        options = hmmsearch_options(flags)
+        with self._pyhmmer.plan7.HMMFile(io.BytesIO(hmm.encode())) as f:
+            queries = list(f)
+        with tempfile.TemporaryFile() as f:
+            for hits in self._pyhmmer.hmmer.hmmsearch(
+                    queries, sequences, cpus=self._n_cpu, **options):
+                # Without hits, hmmsearch writes no alignment
+                if not hits.included:
+                    continue
+                query = hits.query
+                msa = hits.to_msa(self._alphabet)
+                msa.name = query.name
+                if query.accession:
+                    msa.accession = query.accession
+                if query.description:
+                    msa.description = query.description
+                msa.write(f, 'stockholm')
+            f.seek(0)
+            return f.read().decode()
+
+    def run(self, request: Mapping[str, Any]) -> Dict[str, Any]:
+        """Runs a request and returns its result. Never raises."""
+        t0 = time.time()
+        try:
+            command = request.get('command', 'hmmsearch')
+            if command == 'status':
+                return self.status()
+            if command != 'hmmsearch':
+                raise ValueError(f'Unknown command {command}')
+            sto = self.hmmsearch(
+                request['database_path'], request['hmm'],
+                request.get('flags', ()))
+            return {
+                'status': 'succeeded',
+                'sto': sto,
+                'elapsed_time': time.time() - t0,
+            }
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('Search request failed')
+            return {'status': 'failed', 'error': traceback.format_exc()}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        result = self.server.daemon.run(request)
+        self.wfile.write(json.dumps(result).encode() + b'\n')
+
+
+class _ThreadingUnixServer(
+        socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(
+    daemon: SearchDaemon,
+    socket_path: Optional[str] = None,
+    host: str = '0.0.0.0',
+    port: Optional[int] = None,
+):
+    """Serves requests sent as JSON lines until interrupted.
+
+    Each connection sends one request and receives its result.
+    """
+    if port:
+        server = _ThreadingTCPServer((host, port), _Handler)
+        address = f'{TCP_PREFIX}{host}:{port}'
+    else:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _ThreadingUnixServer(socket_path, _Handler)
+        address = socket_path
+    server.daemon = daemon
+    with server:
+        logging.info(f'Serving searches on {address}')
+        server.serve_forever()
+
+
+def _connect(address: str, timeout: float) -> socket.socket:
+    if address.startswith(TCP_PREFIX):
+        host, _, port = address[len(TCP_PREFIX):].rpartition(':')
+        return socket.create_connection((host, int(port)), timeout=timeout)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    try:
+        s.connect(address)
+    except OSError:
+        s.close()
+        raise
+    return s
+
+
+def _request(
+    address: str,
+    request: Mapping[str, Any],
+    timeout: float,
+) -> Dict[str, Any]:
+    with _connect(address, timeout) as s:
+        s.sendall(json.dumps(request).encode() + b'\n')
+        with s.makefile('rb') as f:
+            result = json.loads(f.readline())
+    if result['status'] != 'succeeded':
+        raise RuntimeError(f'Search daemon request failed:\n{result["error"]}')
+    return result
+
+
+def serves_database(
+    address: str,
+    database_path: str,
+    timeout: float = 10.,
+) -> bool:
+    """Returns whether the daemon at address is up and holds a database.
+
+    address is tcp://<host>:<port> or the path of a Unix socket.
+    """
+    try:
+        status = _request(address, {'command': 'status'}, timeout)
+    except (OSError, ValueError, RuntimeError) as e:
+        logging.warning(f'Search daemon at {address} is not available: {e}')
+        return False
+    return os.path.realpath(database_path) in status['databases']
+
+
+def search(
+    address: str,
+    database_path: str,
+    hmm: str,
+    flags: Sequence[str] = (),
+    timeout: float = 3600.,
+) -> str:
+    """Searches a database held by the daemon at address with HMMs.
+
+    Returns the Stockholm alignment of the hits. Raises OSError if the
+    daemon is not reachable and RuntimeError if the search failed.
+    """
+    return _request(address, {
+        'command': 'hmmsearch',
+        'database_path': database_path,
+        'hmm': hmm,
+        'flags': list(flags),
+    }, timeout)['sto']
+
+
+def benchmark(
+    daemon: SearchDaemon,
+    hmm_path: str,
+    database_path: str,
+    flags: Sequence[str],
+    num_queries: int,
+    hmmsearch_binary_path: str = 'hmmsearch',
+) -> Dict[str, float]:
+    """Times queries of the daemon against runs of the hmmsearch binary."""
+    with open(hmm_path) as f:
+        hmm = f.read()
+
+    t0 = time.time()
+    for _ in range(num_queries):
+        sto = daemon.hmmsearch(database_path, hmm, flags)
+    daemon_latency = (time.time() - t0) / num_queries
+    report = {
+        'num_queries': num_queries,
+        'daemon_latency': daemon_latency,
+        'num_hits': sto.count('#=GS '),
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_path = os.path.join(tmp_dir, 'output.sto')
+        cmd = [hmmsearch_binary_path, '--noali', '--cpu', '8', *flags,
+               '-A', out_path, hmm_path, database_path]
+        t0 = time.time()
+        for _ in range(num_queries):
+            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        report['hmmsearch_latency'] = (time.time() - t0) / num_queries
+    report['speedup'] = report['hmmsearch_latency'] / daemon_latency
+    return report
+
+
+if __name__ == '__main__':
+    from absl import app
+    from absl import flags as absl_flags
+
+    absl_flags.DEFINE_list('database_paths', None,
+                           'Sequence databases to hold in memory')
+    absl_flags.DEFINE_string('socket_path', None,
+                             'Unix socket to serve on')
+    absl_flags.DEFINE_string('host', '0.0.0.0', 'Host to serve TCP on')
+    absl_flags.DEFINE_integer('port', None, 'Port to serve TCP on')
+    absl_flags.DEFINE_integer('n_cpu', 0,
+                              'Threads per search, 0 for all the CPUs')
+    absl_flags.DEFINE_string('hmm_path', None, 'HMM to search in benchmark mode')
+    absl_flags.DEFINE_integer('num_queries', 5, 'Number of benchmark queries')
+    absl_flags.DEFINE_list(
+        'hmmsearch_flags',
+        ['--F1', '0.1', '--F2', '0.1', '--F3', '0.1', '--incE', '100',
+         '-E', '100', '--domE', '100', '--incdomE', '100'],
+        'hmmsearch flags of the benchmark, those of the template search by '
+        'default')
+    absl_flags.mark_flag_as_required('database_paths')
+    FLAGS = absl_flags.FLAGS
+
+    def _main(argv):
+        daemon = SearchDaemon(FLAGS.database_paths, FLAGS.n_cpu)
+
+        command = argv[1] if len(argv) > 1 else 'serve'
+        if command == 'benchmark' and FLAGS.hmm_path:
+            report = benchmark(
+                daemon=daemon,
+                hmm_path=FLAGS.hmm_path,
+                database_path=FLAGS.database_paths[0],
+                flags=FLAGS.hmmsearch_flags,
+                num_queries=FLAGS.num_queries)
+            print(json.dumps(report, indent=2))
+        elif command == 'serve' and (FLAGS.port or FLAGS.socket_path):
+            serve(daemon, FLAGS.socket_path, FLAGS.host, FLAGS.port)
+        else:
+            raise app.UsageError(
+                'Usage: search_daemon.py serve|benchmark; serve needs --port '
+                'or --socket_path, benchmark needs --hmm_path')
+
+    logging.basicConfig(level=logging.INFO)
+    app.run(_main)
@@ -0,0 +1,72 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A component that selects the predictions to relax."""
+
+from kfp.v2 import dsl
+
+import config as config
+
+
+@dsl.component(
+    base_image=config.ALPHAFOLD_COMPONENTS_IMAGE,
+    packages_to_install=['google-cloud-storage']
+)
+def select_relax_targets(
+    predictions: list,
+    relax_policy: str,
+    relax_top_k: int = 1,
+) -> list:
+  """Ranks predictions by ranking confidence and selects the ones to relax.
+
+  predictions hold the outputs of the predict tasks, or the model runners
+  of the predictions with the sampling_log_path their predict task logged
+  its output to, for kfp versions without dsl.Collected.
+  """
+
+  import json
+  import logging
+
+  from google.cloud import storage
+
+  from alphafold_utils import select_relax_targets as select_targets
+
+  client = storage.Client()
+
+  ranking_confidences = {}
+  for prediction in predictions:
+    if 'sampling_log_path' in prediction:
+      bucket_name, _, blob_path = prediction['sampling_log_path'][
+          len('gs://'):].partition('/')
+      blob = client.bucket(bucket_name).blob(blob_path)
+      if not blob.exists():
+        logging.warning(
+            f'No sampling log at {prediction["sampling_log_path"]}')
+        continue
+      prediction = json.loads(blob.download_as_text())
+    ranking_confidences[prediction['unrelaxed_protein_uri']] = float(
+        prediction['ranking_confidence'])
+
+  relax_targets = []
+  for unrelaxed_protein_uri in select_targets(
+      ranking_confidences, relax_policy, relax_top_k):
+    relax_targets.append({
+        'unrelaxed_protein_uri': unrelaxed_protein_uri,
+        'ranking_confidence': ranking_confidences[unrelaxed_protein_uri],
+    })
+
+  logging.info(f'Selected {len(relax_targets)} of {len(ranking_confidences)} '
+               f'predictions to relax with policy {relax_policy}')
+
+  return relax_targets
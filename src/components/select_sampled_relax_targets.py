@@ -0,0 +1,69 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A component that selects the adaptively sampled predictions to relax."""
+
+from kfp.v2 import dsl
+
+import config as config
+
+
+@dsl.component(
+    base_image=config.ALPHAFOLD_COMPONENTS_IMAGE,
+    packages_to_install=['google-cloud-storage']
+)
+def select_sampled_relax_targets(
+    sampling_waves: list,
+    relax_policy: str,
+    relax_top_k: int = 1,
+) -> list:
+  """Ranks the predictions of all sampling waves and selects the ones to relax.
+
+  sampling_waves holds the model runners planned for each wave. Their
+  sampling logs give the ranking confidence of each prediction.
+  """
+
+  import json
+  import logging
+
+  from google.cloud import storage
+
+  from alphafold_utils import select_relax_targets as select_targets
+
+  client = storage.Client()
+
+  ranking_confidences = {}
+  for wave_runners in sampling_waves:
+    for runner in wave_runners:
+      bucket_name, _, blob_path = runner['sampling_log_path'][
+          len('gs://'):].partition('/')
+      blob = client.bucket(bucket_name).blob(blob_path)
+      if not blob.exists():
+        logging.warning(f'No sampling log at {runner["sampling_log_path"]}')
+        continue
+      entry = json.loads(blob.download_as_text())
+      ranking_confidences[entry['unrelaxed_protein_uri']] = float(
+          entry['ranking_confidence'])
+
+  relax_targets = []
+  for unrelaxed_protein_uri in select_targets(
+      ranking_confidences, relax_policy, relax_top_k):
+    relax_targets.append({
+        'unrelaxed_protein_uri': unrelaxed_protein_uri,
+        'ranking_confidence': ranking_confidences[unrelaxed_protein_uri],
+    })
+
+  logging.info(f'Selected {len(relax_targets)} of {len(ranking_confidences)} '
+               f'predictions to relax with policy {relax_policy}')
+
+  return relax_targets
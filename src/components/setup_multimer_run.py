@@ -0,0 +1,238 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A component that sets up a multimer pipeline run in a single task."""
+
+from typing import NamedTuple
+
+from kfp.v2 import dsl
+from kfp.v2.dsl import Artifact, Output
+
+import config as config
+
+
+@dsl.component(
+    base_image=config.ALPHAFOLD_COMPONENTS_IMAGE,
+    packages_to_install=['google-cloud-storage']
+)
+def setup_multimer_run(
+    sequence_path: str,
+    project: str,
+    use_small_bfd: str,
+    max_template_date: str,
+    uniref_max_hits: int,
+    mgnify_max_hits: int,
+    uniprot_max_hits: int,
+    sequence: Output[Artifact],
+    skip_msa: str = 'false',
+    random_seed: int = None,
+    num_multimer_predictions_per_model: int = 5,
+    model_names: list = None,
+    colocated_search_max_residues: int = 0,
+    batch_template_search: str = 'false',
+) -> NamedTuple(
+    'SetupRunOutputs',
+    [
+        ('model_runners', list),
+        ('run_multimer_system', bool),
+        ('num_ensemble', int),
+        ('is_homomer_or_monomer', str),
+        ('chain_info_list', list),
+        ('sampling_waves', list),
+        ('per_chain_features_dir', str),
+        ('chains_to_process', list),
+        ('chains_with_precomputed', list),
+        ('defer_templates', str),
+    ]
+):
+    """Configures a multimer run and finds the chains with cached features.
+
+    Does the work of configure_run_multimer, create_run_id and filter_chains
+    in one task: the FASTA is downloaded and parsed once, the per-chain
+    FASTA files are uploaded, and the feature cache paths of the chains are
+    hashed and looked up with one listing per path.
+
+    Chains of at most colocated_search_max_residues residues (0 for none)
+    get search_mode 'colocated', to run their MSA searches in one task
+    (see colocated_msa_search), and the others 'fan_out'.
+
+    defer_templates is 'true' when the templates of the chains are left to
+    batch_hmmsearch, with batch_template_search and MSAs to search them.
+    """
+
+    import hashlib
+    import json
+    import os
+    import random
+    import sys
+    from collections import namedtuple
+    from alphafold.data import parsers
+    from alphafold.data import pipeline_multimer
+    from alphafold.model import config as model_config
+    from google.cloud import storage
+
+    if not sequence_path.startswith('gs://'):
+        raise ValueError(f"Expected gs:// path, got {sequence_path}")
+    bucket_name = sequence_path.split('/')[2]
+
+    client = storage.Client()
+    bucket = client.bucket(bucket_name)
+
+    # Download and parse the input FASTA file
+    sequence.uri = f'{sequence.uri}.fasta'
+    with open(sequence.path, 'wb') as f:
+        client.download_blob_to_file(sequence_path, f)
+    with open(sequence.path) as f:
+        sequence_str = f.read()
+    seqs, seq_descs = parsers.parse_fasta(sequence_str)
+    chain_id_map = pipeline_multimer._make_chain_id_map(
+        sequences=seqs,
+        descriptions=seq_descs
+    )
+
+    # Upload the chain FASTA files next to the input sequence
+    gcs_dir = os.path.dirname(sequence_path)
+    sequence_basename = os.path.splitext(os.path.basename(sequence_path))[0]
+    chain_info_list = []
+    for chain_id, fasta_chain in chain_id_map.items():
+        gcs_chain_path = f"{gcs_dir}/{sequence_basename}_chain_{chain_id}.fasta"
+        bucket.blob(
+            gcs_chain_path.split('gs://' + bucket_name + '/')[1]
+        ).upload_from_string(f'>{chain_id}\n{fasta_chain.sequence}\n')
+        num_residues = len(fasta_chain.sequence)
+        chain_info_list.append({
+            'chain_id': chain_id,
+            'sequence_path': gcs_chain_path,
+            'description': fasta_chain.description,
+            'num_residues': num_residues,
+            'search_mode': (
+                'colocated' if num_residues <= colocated_search_max_residues
+                else 'fan_out'),
+        })
+
+    is_homomer_or_monomer = 'true' if len(set(seqs)) == 1 else 'false'
+
+    # Hash the feature cache paths as create_run_id does, so that features
+    # cached by earlier runs are found
+    out_bucket = client.bucket(project)
+    if not out_bucket.exists():
+        try:
+            out_bucket = client.create_bucket(project, location="us-central1")
+            print(f"Bucket {project} created")
+        except Exception as e:
+            print(f"Error creating bucket: {str(e)}")
+
+    base_params_no_skip = {
+        'use_small_bfd': use_small_bfd,
+        'max_template_date': max_template_date,
+        'uniref_max_hits': uniref_max_hits,
+        'mgnify_max_hits': mgnify_max_hits,
+        'uniprot_max_hits': uniprot_max_hits
+    }
+
+    def cache_path(params, sequence_content, prefix):
+        params = dict(params, sequence_content=sequence_content)
+        current_hash = hashlib.sha256(
+            json.dumps(params, sort_keys=True).encode()).hexdigest()
+        blob_names = [
+            blob.name for blob in out_bucket.list_blobs(
+                prefix=f"{prefix}/{current_hash}")]
+        return f"gs://{project}/{prefix}/{current_hash}", blob_names
+
+    chain_paths = {}
+    chains_to_process = []
+    chains_with_precomputed = []
+    for chain_info in chain_info_list:
+        chain_id = chain_info['chain_id']
+        chain_sequence = chain_id_map[chain_id].sequence
+        path, blob_names = cache_path(
+            base_params_no_skip, chain_sequence, "chain_msas")
+        if not blob_names and skip_msa != 'true':
+            path, blob_names = cache_path(
+                dict(base_params_no_skip, skip_msa=skip_msa), chain_sequence,
+                "chain_msas")
+        chain_paths[chain_id] = path
+
+        features_blob = f"{path.split('/', 3)[3]}/features.pkl"
+        if features_blob in blob_names:
+            chains_with_precomputed.append(chain_info)
+        else:
+            chains_to_process.append(chain_info)
+
+    full_protein_path, blob_names = cache_path(
+        base_params_no_skip, sequence_str, "full_protein_msas")
+    if not blob_names:
+        full_protein_path, _ = cache_path(
+            dict(base_params_no_skip, skip_msa=skip_msa), sequence_str,
+            "full_protein_msas")
+
+    per_chain_features_dir = json.dumps({
+        'full_protein': full_protein_path,
+        'chains': chain_paths
+    }, sort_keys=True)
+
+    print(f"Found {len(chains_with_precomputed)} chains with precomputed MSAs")
+    print(f"Need to process {len(chains_to_process)} chains")
+
+    # Configure model runners
+    if model_names is not None:
+        models = model_names
+    else:
+        models = model_config.MODEL_PRESETS['multimer']
+
+    if random_seed is None:
+        max_seed = sys.maxsize // (len(models) * num_multimer_predictions_per_model)
+        random_seed = int(random.randrange(max_seed))
+    else:
+        random_seed = int(random_seed)
+
+    model_runners = []
+    for model_name in models:
+        for i in range(num_multimer_predictions_per_model):
+            model_runners.append({
+                'prediction_index': int(i),
+                'model_name': model_name,
+                'random_seed': int(random_seed + i)
+            })
+
+    # Group the model runners into waves of one seed per model for
+    # adaptive sampling
+    sampling_waves = []
+    for i in range(num_multimer_predictions_per_model):
+        sampling_waves.append({
+            'wave_index': int(i),
+            'model_runners': [
+                runner for runner in model_runners
+                if runner['prediction_index'] == i]
+        })
+
+    sequence.metadata['category'] = 'sequence'
+    sequence.metadata['description'] = seq_descs
+    sequence.metadata['num_residues'] = [len(seq) for seq in seqs]
+    sequence.metadata['chain_info'] = chain_info_list
+
+    output = namedtuple(
+        'SetupRunOutputs',
+        ['model_runners', 'run_multimer_system', 'num_ensemble',
+         'is_homomer_or_monomer', 'chain_info_list', 'sampling_waves',
+         'per_chain_features_dir', 'chains_to_process',
+         'chains_with_precomputed', 'defer_templates']
+    )
+
+    defer_templates = (
+        'true' if batch_template_search == 'true' and skip_msa != 'true'
+        else 'false')
+
+    return output(model_runners, True, 1, is_homomer_or_monomer,
+                  chain_info_list, sampling_waves, per_chain_features_dir,
+                  chains_to_process, chains_with_precomputed, defer_templates)
@@ -11,76 +11,227 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""Config definitions for pipeline execution."""
+"""Config definitions for pipeline execution.
 
+The settings are read from the environment of the process, or from the
+values a config is loaded with (see load).
+"""
+
+import functools
+import importlib.util
 import os
+from typing import Mapping
 
 
-NFS_SERVER = os.getenv('NFS_SERVER')
-NFS_PATH = os.getenv('NFS_PATH')
-NFS_MOUNT_POINT = os.getenv('NFS_MOUNT_POINT', '/mnt/nfs/alphafold')
-NETWORK = os.getenv('NETWORK')
+# Values overriding the environment, set by load before the config is read
+_OVERRIDES = globals().get('_OVERRIDES', {})
 
-MODEL_PARAMS_GCS_LOCATION = os.getenv('MODEL_PARAMS_GCS_LOCATION')
 
-UNIREF90_PATH = os.getenv('UNIREF90_PATH', 'uniref90/uniref90.fasta')
-MGNIFY_PATH = os.getenv('MGNIFY_PATH', 'mgnify/mgy_clusters_2022_05.fa')
-BFD_PATH = os.getenv(
-    'BFD_PATH',
-    'bfd/bfd_metaclust_clu_complete_id30_c90_final_seq.sorted_opt')
-SMALL_BFD_PATH = os.getenv('SMALL_BFD_PATH',
-                           'small_bfd/bfd-first_non_consensus_sequences.fasta')
+def getenv(key: str, default=None):
+    """Returns the value of a setting of this config."""
+    return _OVERRIDES.get(key, os.environ.get(key, default))
 
-UNIREF30_PATH = os.getenv('UNIREF30_PATH','uniref30/UniRef30_2021_03')
 
-UNIPROT_PATH = os.getenv('UNIPROT_PATH', 'uniprot/uniprot.fasta')
-PDB70_PATH = os.getenv('PDB70_PATH', 'pdb70/pdb70')
-PDB_MMCIF_PATH = os.getenv('PDB_MMCIF_PATH', 'pdb_mmcif/mmcif_files')
-PDB_OBSOLETE_PATH = os.getenv('PDB_OBSOLETE_PATH', 'pdb_mmcif/obsolete.dat')
-PDB_SEQRES_PATH = os.getenv('PDB_SEQRES_PATH', 'pdb_seqres/pdb_seqres.txt')
+def load(values: Mapping[str, str]):
+    """Returns the config read with values in place of environment variables.
 
-UNIREF_MAX_HITS = int(os.getenv('UNIREF_MAX_HITS', '10000'))
-MGNIFY_MAX_HITS = int(os.getenv('MGNIFY_MAX_HITS', '501'))
-UNIPROT_MAX_HITS = int(os.getenv('UNIPROT_MAX_HITS', '50000'))
+    The config is a module of the same settings as this one. Unlike setting
+    the environment of the process, it leaves the settings of other configs
+    unchanged. Configs are memoized by values.
+    """
+    return _load(tuple(sorted(values.items())))
 
-DATA_PIPELINE_MACHINE_TYPE = os.getenv(
-    'DATA_PIPELINE_MACHINE_TYPE', 'c2-standard-16')
-JACKHMMER_MACHINE_TYPE = os.getenv('JACKHMMER_MACHINE_TYPE', 'n1-standard-8')
-HHSEARCH_MACHINE_TYPE = os.getenv('HHSEARCH_MACHINE_TYPE', 'c2-standard-16')
-HMMSEARCH_MACHINE_TYPE = os.getenv('HMMSEARCH_MACHINE_TYPE', 'c2-standard-16')
-HHBLITS_MACHINE_TYPE = os.getenv('HMMSEARCH_MACHINE_TYPE', 'c2-standard-16')
 
-ALPHAFOLD_COMPONENTS_IMAGE = os.getenv('ALPHAFOLD_COMPONENTS_IMAGE')
+@functools.lru_cache(maxsize=None)
+def _load(values):
+    spec = importlib.util.spec_from_file_location(__name__, __file__)
+    module = importlib.util.module_from_spec(spec)
+    module._OVERRIDES = dict(values)
+    spec.loader.exec_module(module)
+    return module
 
-PARALLELISM = int(os.getenv('PARALLELISM', '20'))
 
-XLA_PYTHON_CLIENT_MEM_FRACTION = os.getenv(
-    'XLA_PYTHON_CLIENT_MEM_FRACTION', '4.0')
-TF_FORCE_UNIFIED_MEMORY = os.getenv('TF_FORCE_UNIFIED_MEMORY', '1')
+NFS_SERVER = getenv('NFS_SERVER')
+NFS_PATH = getenv('NFS_PATH')
+NFS_MOUNT_POINT = getenv('NFS_MOUNT_POINT', '/mnt/nfs/alphafold')
+NETWORK = getenv('NETWORK')
+
+MODEL_PARAMS_GCS_LOCATION = getenv('MODEL_PARAMS_GCS_LOCATION')
+
+UNIREF90_PATH = getenv('UNIREF90_PATH', 'uniref90/uniref90.fasta')
+MGNIFY_PATH = getenv('MGNIFY_PATH', 'mgnify/mgy_clusters_2022_05.fa')
+BFD_PATH = getenv(
+    'BFD_PATH',
+    'bfd/bfd_metaclust_clu_complete_id30_c90_final_seq.sorted_opt')
+SMALL_BFD_PATH = getenv('SMALL_BFD_PATH',
+                        'small_bfd/bfd-first_non_consensus_sequences.fasta')
+
+UNIREF30_PATH = getenv('UNIREF30_PATH','uniref30/UniRef30_2021_03')
+
+UNIPROT_PATH = getenv('UNIPROT_PATH', 'uniprot/uniprot.fasta')
+PDB70_PATH = getenv('PDB70_PATH', 'pdb70/pdb70')
+PDB_MMCIF_PATH = getenv('PDB_MMCIF_PATH', 'pdb_mmcif/mmcif_files')
+PDB_OBSOLETE_PATH = getenv('PDB_OBSOLETE_PATH', 'pdb_mmcif/obsolete.dat')
+PDB_SEQRES_PATH = getenv('PDB_SEQRES_PATH', 'pdb_seqres/pdb_seqres.txt')
 
-PREDICT_MACHINE_TYPE = os.getenv('PREDICT_MACHINE_TYPE', 'g2-standard-48')
-PREDICT_ACCELERATOR_TYPE = os.getenv('PREDICT_ACCELERATOR_TYPE', 'NVIDIA_L4')
-PREDICT_ACCELERATOR_COUNT = int(os.getenv('PREDICT_ACCELERATOR_COUNT', '4'))
+UNIREF_MAX_HITS = int(getenv('UNIREF_MAX_HITS', '10000'))
+MGNIFY_MAX_HITS = int(getenv('MGNIFY_MAX_HITS', '501'))
+UNIPROT_MAX_HITS = int(getenv('UNIPROT_MAX_HITS', '50000'))
+
+DATA_PIPELINE_MACHINE_TYPE = getenv(
+    'DATA_PIPELINE_MACHINE_TYPE', 'c2-standard-16')
+JACKHMMER_MACHINE_TYPE = getenv('JACKHMMER_MACHINE_TYPE', 'n1-standard-8')
+HHSEARCH_MACHINE_TYPE = getenv('HHSEARCH_MACHINE_TYPE', 'c2-standard-16')
+HMMSEARCH_MACHINE_TYPE = getenv('HMMSEARCH_MACHINE_TYPE', 'c2-standard-16')
+HHBLITS_MACHINE_TYPE = getenv('HMMSEARCH_MACHINE_TYPE', 'c2-standard-16')
+
+# Number of pre-built shards of the uniref90 and uniprot databases searched
+# concurrently by jackhmmer. 0 searches the unsharded database.
+UNIREF90_NUM_SHARDS = int(getenv('UNIREF90_NUM_SHARDS', '0'))
+UNIPROT_NUM_SHARDS = int(getenv('UNIPROT_NUM_SHARDS', '0'))
+
+# Number of sequences of the uniref90 and uniprot databases sharing the most
+# k-mers with the query that jackhmmer searches, from the k-mer index built
+# by components/kmer_prefilter.py. 0 searches the full database.
+UNIREF90_PREFILTER_MAX_CANDIDATES = int(
+    getenv('UNIREF90_PREFILTER_MAX_CANDIDATES', '0'))
+UNIPROT_PREFILTER_MAX_CANDIDATES = int(
+    getenv('UNIPROT_PREFILTER_MAX_CANDIDATES', '0'))
+
+# Local directory the search tasks copy their databases to from the Filestore
+# share, shared by the tasks scheduled on a node. Databases are evicted least
+# recently used first beyond DATABASE_STAGING_MAX_GB (0 for the free disk
+# space). An empty directory searches the share directly.
+DATABASE_STAGING_DIR = getenv('DATABASE_STAGING_DIR', '')
+DATABASE_STAGING_MAX_GB = float(getenv('DATABASE_STAGING_MAX_GB', '0'))
+# Read the databases into the page cache before searching them
+DATABASE_STAGING_WARM_PAGE_CACHE = getenv(
+    'DATABASE_STAGING_WARM_PAGE_CACHE', 'false') == 'true'
+
+# Address of the resident search daemon holding the template database in
+# memory (components/search_daemon.py): tcp://<host>:<port> or the path of a
+# Unix socket. Empty, or a daemon that is not reachable, runs hmmsearch in
+# the search task.
+SEARCH_DAEMON_ADDRESS = getenv('SEARCH_DAEMON_ADDRESS', '')
+
+# Threads featurizing the template hits of a template search concurrently,
+# reading their mmCIF files and aligning them with kalign. 0 or 1 featurizes
+# them one after another.
+TEMPLATE_FEATURIZATION_WORKERS = int(
+    getenv('TEMPLATE_FEATURIZATION_WORKERS', '8'))
+
+# Chains of at most COLOCATED_SEARCH_MAX_RESIDUES residues run the uniref90,
+# mgnify and BFD searches concurrently in one task on
+# COLOCATED_SEARCH_MACHINE_TYPE. 0 runs every search in its own task.
+COLOCATED_SEARCH_MACHINE_TYPE = getenv(
+    'COLOCATED_SEARCH_MACHINE_TYPE', 'c2-standard-30')
+COLOCATED_SEARCH_MAX_RESIDUES = int(
+    getenv('COLOCATED_SEARCH_MAX_RESIDUES', '0'))
+
+ALPHAFOLD_COMPONENTS_IMAGE = getenv('ALPHAFOLD_COMPONENTS_IMAGE')
+
+PARALLELISM = int(getenv('PARALLELISM', '20'))
+
+XLA_PYTHON_CLIENT_MEM_FRACTION = getenv(
+    'XLA_PYTHON_CLIENT_MEM_FRACTION', '4.0')
+TF_FORCE_UNIFIED_MEMORY = getenv('TF_FORCE_UNIFIED_MEMORY', '1')
+
+# Buckets the model inputs are padded to when bucket padding is enabled, so
+# that predictions of similarly sized complexes reuse one compiled model
+PADDING_RESIDUE_BUCKETS = [int(size) for size in getenv(
+    'PADDING_RESIDUE_BUCKETS',
+    '256,384,512,768,1024,1280,1536,2048,2560,3072,4096').split(',')]
+PADDING_MSA_BUCKETS = [int(size) for size in getenv(
+    'PADDING_MSA_BUCKETS', '512,1024,2048').split(',')]
+
+# Outputs kept in the raw predictions by the 'slim' output policy. Nested
+# outputs are joined with '/'.
+SLIM_PREDICTION_OUTPUTS = getenv(
+    'SLIM_PREDICTION_OUTPUTS',
+    'plddt,predicted_aligned_error,max_predicted_aligned_error,ptm,iptm,'
+    'ranking_confidence,num_recycles,structure_module/final_atom_positions,'
+    'structure_module/final_atom_mask').split(',')
+
+# Recycling settings of the predictions. A negative MAX_RECYCLES keeps the
+# number of recycles of the model config. Multimer predictions stop
+# recycling early once the pairwise distances change by less than
+# RECYCLE_EARLY_STOP_TOLERANCE (in Angstroms) between recycles.
+MAX_RECYCLES = int(getenv('MAX_RECYCLES', '-1'))
+RECYCLE_EARLY_STOP_TOLERANCE = float(
+    getenv('RECYCLE_EARLY_STOP_TOLERANCE', '0.5'))
+
+# Memory of the supported accelerators in GB, used by the memory planner.
+# Other accelerators are planned for DEFAULT_ACCELERATOR_MEMORY_GB.
+ACCELERATOR_MEMORY_GB = {
+    'NVIDIA_TESLA_T4': 16.,
+    'NVIDIA_TESLA_V100': 16.,
+    'NVIDIA_L4': 24.,
+    'NVIDIA_TESLA_A100': 40.,
+    'NVIDIA_A100_80GB': 80.,
+}
+DEFAULT_ACCELERATOR_MEMORY_GB = float(
+    getenv('DEFAULT_ACCELERATOR_MEMORY_GB', '16'))
+
+# Machine tiers the memory planner recommends from, as comma-separated
+# <machine type>:<accelerator type> entries
+MEMORY_PLANNER_MACHINE_TIERS = [
+    {
+        'machine_type': machine_type,
+        'accelerator_type': accelerator_type,
+        'accelerator_memory_gb': float(ACCELERATOR_MEMORY_GB.get(
+            accelerator_type, DEFAULT_ACCELERATOR_MEMORY_GB)),
+    }
+    for machine_type, accelerator_type in (
+        tier.split(':') for tier in getenv(
+            'MEMORY_PLANNER_MACHINE_TIERS',
+            'g2-standard-12:NVIDIA_L4,a2-highgpu-1g:NVIDIA_TESLA_A100,'
+            'a2-ultragpu-1g:NVIDIA_A100_80GB').split(','))
+]
+
+PREDICT_MACHINE_TYPE = getenv('PREDICT_MACHINE_TYPE', 'g2-standard-48')
+PREDICT_ACCELERATOR_TYPE = getenv('PREDICT_ACCELERATOR_TYPE', 'NVIDIA_L4')
+PREDICT_ACCELERATOR_COUNT = int(getenv('PREDICT_ACCELERATOR_COUNT', '4'))
 
 # Instance (VM) configuration to run protein relaxation
-RELAX_MACHINE_TYPE = os.getenv('RELAX_MACHINE_TYPE', 'g2-standard-48')
-RELAX_ACCELERATOR_TYPE = os.getenv('RELAX_ACCELERATOR_TYPE', 'NVIDIA_L4')
-RELAX_ACCELERATOR_COUNT = int(os.getenv('RELAX_ACCELERATOR_COUNT', '4'))
+RELAX_MACHINE_TYPE = getenv('RELAX_MACHINE_TYPE', 'g2-standard-48')
+RELAX_ACCELERATOR_TYPE = getenv('RELAX_ACCELERATOR_TYPE', 'NVIDIA_L4')
+RELAX_ACCELERATOR_COUNT = int(getenv('RELAX_ACCELERATOR_COUNT', '4'))
+
+# Number of CPU relaxation worker processes that run alongside predictions
+# in the combined predict/relax component. 0 relaxes each prediction on the
+# accelerator before starting the next one.
+PREDICT_RELAX_WORKERS = int(getenv('PREDICT_RELAX_WORKERS', '4'))
+
+# Predictions with at most MAX_RELAX_VIOLATIONS structural violations
+# (clashes and bond violations) are not relaxed. -1 relaxes every prediction.
+MAX_RELAX_VIOLATIONS = int(getenv('MAX_RELAX_VIOLATIONS', '-1'))
+
+# CPU instance that relaxes the selected predictions in one batch task
+RELAX_BATCH_MACHINE_TYPE = getenv('RELAX_BATCH_MACHINE_TYPE', 'c2-standard-16')
+
+# Warm prediction worker (see components/prediction_worker.py) that the
+# persistent resource pipeline submits predictions to, as tcp://<host>:<port>
+# or a file queue directory shared with the worker. Empty runs a predict
+# job per prediction.
+PREDICTION_WORKER_ADDRESS = getenv('PREDICTION_WORKER_ADDRESS', '')
+PREDICTION_WORKER_CLIENT_MACHINE_TYPE = getenv(
+    'PREDICTION_WORKER_CLIENT_MACHINE_TYPE', 'n1-standard-4')
+PREDICTION_WORKER_TIMEOUT = int(getenv('PREDICTION_WORKER_TIMEOUT', '7200'))
 
 # Persistent resource configuration for prediction
-PREDICT_PERSISTENT_RESOURCE_ID = os.getenv('PREDICT_PERSISTENT_RESOURCE_ID', 'a100-persistent-resource-09')
-PREDICT_PERSISTENT_MACHINE_TYPE = os.getenv('PREDICT_PERSISTENT_MACHINE_TYPE', 'a2-ultragpu-1g')
-PREDICT_PERSISTENT_ACCELERATOR_TYPE = os.getenv('PREDICT_PERSISTENT_ACCELERATOR_TYPE', 'NVIDIA_A100_80GB')
-PREDICT_PERSISTENT_ACCELERATOR_COUNT = int(os.getenv('PREDICT_PERSISTENT_ACCELERATOR_COUNT', '1'))
-PREDICT_PERSISTENT_DISK_TYPE = os.getenv('PREDICT_PERSISTENT_DISK_TYPE', 'pd-ssd')
-PREDICT_PERSISTENT_DISK_SIZE = int(os.getenv('PREDICT_PERSISTENT_DISK_SIZE', '100'))
-PREDICT_PERSISTENT_REGION = os.getenv('PREDICT_PERSISTENT_REGION', 'us-central1')
+PREDICT_PERSISTENT_RESOURCE_ID = getenv('PREDICT_PERSISTENT_RESOURCE_ID', 'a100-persistent-resource-09')
+PREDICT_PERSISTENT_MACHINE_TYPE = getenv('PREDICT_PERSISTENT_MACHINE_TYPE', 'a2-ultragpu-1g')
+PREDICT_PERSISTENT_ACCELERATOR_TYPE = getenv('PREDICT_PERSISTENT_ACCELERATOR_TYPE', 'NVIDIA_A100_80GB')
+PREDICT_PERSISTENT_ACCELERATOR_COUNT = int(getenv('PREDICT_PERSISTENT_ACCELERATOR_COUNT', '1'))
+PREDICT_PERSISTENT_DISK_TYPE = getenv('PREDICT_PERSISTENT_DISK_TYPE', 'pd-ssd')
+PREDICT_PERSISTENT_DISK_SIZE = int(getenv('PREDICT_PERSISTENT_DISK_SIZE', '100'))
+PREDICT_PERSISTENT_REGION = getenv('PREDICT_PERSISTENT_REGION', 'us-central1')
 
 # Persistent resource configuration for relaxation
-RELAX_PERSISTENT_RESOURCE_ID = os.getenv('RELAX_PERSISTENT_RESOURCE_ID', 'a100-persistent-resource-09')
-RELAX_PERSISTENT_MACHINE_TYPE = os.getenv('RELAX_PERSISTENT_MACHINE_TYPE', 'a2-ultragpu-1g')
-RELAX_PERSISTENT_ACCELERATOR_TYPE = os.getenv('RELAX_PERSISTENT_ACCELERATOR_TYPE', 'NVIDIA_A100_80GB')
-RELAX_PERSISTENT_ACCELERATOR_COUNT = int(os.getenv('RELAX_PERSISTENT_ACCELERATOR_COUNT', '1'))
-RELAX_PERSISTENT_DISK_TYPE = os.getenv('RELAX_PERSISTENT_DISK_TYPE', 'pd-ssd')
-RELAX_PERSISTENT_DISK_SIZE = int(os.getenv('RELAX_PERSISTENT_DISK_SIZE', '100'))
-RELAX_PERSISTENT_REGION = os.getenv('RELAX_PERSISTENT_REGION', 'us-central1')
+RELAX_PERSISTENT_RESOURCE_ID = getenv('RELAX_PERSISTENT_RESOURCE_ID', 'a100-persistent-resource-09')
+RELAX_PERSISTENT_MACHINE_TYPE = getenv('RELAX_PERSISTENT_MACHINE_TYPE', 'a2-ultragpu-1g')
+RELAX_PERSISTENT_ACCELERATOR_TYPE = getenv('RELAX_PERSISTENT_ACCELERATOR_TYPE', 'NVIDIA_A100_80GB')
+RELAX_PERSISTENT_ACCELERATOR_COUNT = int(getenv('RELAX_PERSISTENT_ACCELERATOR_COUNT', '1'))
+RELAX_PERSISTENT_DISK_TYPE = getenv('RELAX_PERSISTENT_DISK_TYPE', 'pd-ssd')
+RELAX_PERSISTENT_DISK_SIZE = int(getenv('RELAX_PERSISTENT_DISK_SIZE', '100'))
+RELAX_PERSISTENT_REGION = getenv('RELAX_PERSISTENT_REGION', 'us-central1')
@@ -14,122 +14,232 @@
 
 """Universal Alphafold Inference Pipeline."""
 
+import functools
+
 from google_cloud_pipeline_components.v1.custom_job import create_custom_training_job_from_component
 from kfp.v2 import dsl
 
 import config as config
-from components import  configure_run as ConfigureRunOp
+from components import  configure_run
 from components import  data_pipeline
-from components import  predict as PredictOp
-from components import  relax as RelaxOp
-import os
-
-DataPipelineOp = create_custom_training_job_from_component(
-    data_pipeline,
-    display_name='Data Pipeline',
-    machine_type=config.DATA_PIPELINE_MACHINE_TYPE,
-    nfs_mounts=[dict(
-        server=config.NFS_SERVER,
-        path=config.NFS_PATH,
-        mountPoint=config.NFS_MOUNT_POINT)],
-    network=config.NETWORK
-)
-
-JobPredictOp = create_custom_training_job_from_component(
-    PredictOp,
-    display_name = 'Predict',
-    machine_type = 'g2-standard-12' if 'PREDICT_MACHINE_TYPE' not in os.environ else os.environ['PREDICT_MACHINE_TYPE'],
-    accelerator_type = 'NVIDIA_L4' if 'PREDICT_ACCELERATOR_TYPE' not in os.environ else os.environ['PREDICT_ACCELERATOR_TYPE'],
-    accelerator_count = '1' if 'PREDICT_ACCELERATOR_COUNT' not in os.environ else os.environ['PREDICT_ACCELERATOR_COUNT']
-)
-
-JobRelaxOp = create_custom_training_job_from_component(
-    RelaxOp,
-    display_name = 'Relax',
-    machine_type = 'g2-standard-12' if 'RELAX_MACHINE_TYPE' not in os.environ else os.environ['RELAX_MACHINE_TYPE'],
-    accelerator_type = 'NVIDIA_L4' if 'RELAX_ACCELERATOR_TYPE' not in os.environ else os.environ['RELAX_ACCELERATOR_TYPE'],
-    accelerator_count = '1' if 'RELAX_ACCELERATOR_COUNT' not in os.environ else os.environ['RELAX_ACCELERATOR_COUNT']
-)
-
-@dsl.pipeline(
-    name='alphafold-inference-pipeline',
-    description='AlphaFold inference using original data pipeline.'
-)
-def alphafold_inference_pipeline(
-    sequence_path: str,
-    project: str,
-    region: str,
-    max_template_date: str,
-    model_preset: str = 'monomer',
-    use_small_bfd: bool = True,
-    num_multimer_predictions_per_model: int = 5,
-    is_run_relax: str = 'relax'
-):
-  """Universal Alphafold Inference Pipeline."""
-  run_config = ConfigureRunOp(
-      sequence_path=sequence_path,
-      model_preset=model_preset,
-      num_multimer_predictions_per_model=num_multimer_predictions_per_model,
-  ).set_display_name('Configure Pipeline Run')
-
-  model_parameters = dsl.importer(
-      artifact_uri=os.environ['MODEL_PARAMS_GCS_LOCATION'],
-      artifact_class=dsl.Artifact,
-      reimport=True
-  ).set_display_name('Model parameters')
-
-  reference_databases = dsl.importer(
-      artifact_uri=config.NFS_MOUNT_POINT,
-      artifact_class=dsl.Dataset,
-      reimport=False,
-      metadata={
-          'uniref90': config.UNIREF90_PATH,
-          'mgnify': config.MGNIFY_PATH,
-          'bfd': config.BFD_PATH,
-          'small_bfd': config.SMALL_BFD_PATH,
-          'uniref30': config.UNIREF30_PATH,
-          'pdb70': config.PDB70_PATH,
-          'pdb_mmcif': config.PDB_MMCIF_PATH,
-          'pdb_obsolete': config.PDB_OBSOLETE_PATH,
-          'pdb_seqres': config.PDB_SEQRES_PATH,
-          'uniprot': config.UNIPROT_PATH,
-          }
-  ).set_display_name('Reference databases')
-
-  data_pipeline = DataPipelineOp(
-      project=project,
-      location=region,
-      ref_databases=reference_databases.output,
-      sequence=run_config.outputs['sequence'],
-      max_template_date=max_template_date,
-      run_multimer_system=run_config.outputs['run_multimer_system'],
-      use_small_bfd=use_small_bfd,
-  ).set_display_name('Prepare Features')
-
-  with dsl.ParallelFor(
-        loop_args=run_config.outputs['model_runners'], 
-        parallelism=config.PARALLELISM
-        ) as model_runner:
-    model_predict = JobPredictOp(
+from components import  predict
+from components import  relax
+from components.plan_relax import plan_relax
+from components.select_relax_targets import select_relax_targets
+
+
+def _with_base_image(component, base_image, **component_options):
+  """Returns the component built on base_image.
+
+  component_options are the options of the dsl.component decorator of the
+  component other than base_image, like packages_to_install, which the
+  component is rebuilt with.
+  """
+  if component.component_spec.implementation.container.image == base_image:
+    return component
+  return dsl.component(
+      component.python_func, base_image=base_image, **component_options)
+
+
+@functools.lru_cache(maxsize=None)
+def build_pipeline(pipeline_config):
+  """Returns the pipeline built with the settings of a config.
+
+  pipeline_config is the config module or a config returned by config.load,
+  whose values the components and custom jobs of the pipeline are built with
+  instead of those of the environment of the process. Pipelines are
+  memoized by config.
+  """
+  base_image = pipeline_config.ALPHAFOLD_COMPONENTS_IMAGE
+  ConfigureRunOp = _with_base_image(configure_run, base_image)
+  PredictOp = _with_base_image(
+      predict, base_image, packages_to_install=['google-cloud-storage'])
+  RelaxOp = _with_base_image(
+      relax, base_image, packages_to_install=['google-cloud-storage'])
+  PlanRelaxOp = _with_base_image(plan_relax, base_image)
+  SelectRelaxTargetsOp = _with_base_image(
+      select_relax_targets, base_image,
+      packages_to_install=['google-cloud-storage'])
+
+  DataPipelineOp = create_custom_training_job_from_component(
+      _with_base_image(data_pipeline, base_image),
+      display_name='Data Pipeline',
+      machine_type=pipeline_config.DATA_PIPELINE_MACHINE_TYPE,
+      nfs_mounts=[dict(
+          server=pipeline_config.NFS_SERVER,
+          path=pipeline_config.NFS_PATH,
+          mountPoint=pipeline_config.NFS_MOUNT_POINT)],
+      network=pipeline_config.NETWORK
+  )
+
+  JobPredictOp = create_custom_training_job_from_component(
+      PredictOp,
+      display_name = 'Predict',
+      machine_type = pipeline_config.getenv('PREDICT_MACHINE_TYPE', 'g2-standard-12'),
+      accelerator_type = pipeline_config.getenv('PREDICT_ACCELERATOR_TYPE', 'NVIDIA_L4'),
+      accelerator_count = pipeline_config.getenv('PREDICT_ACCELERATOR_COUNT', '1')
+  )
+
+  JobRelaxOp = create_custom_training_job_from_component(
+      RelaxOp,
+      display_name = 'Relax',
+      machine_type = pipeline_config.getenv('RELAX_MACHINE_TYPE', 'g2-standard-12'),
+      accelerator_type = pipeline_config.getenv('RELAX_ACCELERATOR_TYPE', 'NVIDIA_L4'),
+      accelerator_count = pipeline_config.getenv('RELAX_ACCELERATOR_COUNT', '1')
+  )
+
+  @dsl.pipeline(
+      name='alphafold-inference-pipeline',
+      description='AlphaFold inference using original data pipeline.'
+  )
+  def alphafold_inference_pipeline(
+      sequence_path: str,
+      project: str,
+      region: str,
+      max_template_date: str,
+      model_preset: str = 'monomer',
+      use_small_bfd: bool = True,
+      num_multimer_predictions_per_model: int = 5,
+      is_run_relax: str = 'relax',
+      relax_policy: str = 'all',
+      relax_top_k: int = 1,
+      max_relax_violations: int = pipeline_config.MAX_RELAX_VIOLATIONS,
+      pad_to_buckets: bool = False,
+      use_prediction_cache: str = 'false',
+      max_recycles: int = pipeline_config.MAX_RECYCLES,
+      recycle_early_stop_tolerance: float = pipeline_config.RECYCLE_EARLY_STOP_TOLERANCE,
+      output_policy: str = 'full',
+      half_precision_outputs: bool = False
+  ):
+    """Universal Alphafold Inference Pipeline."""
+    run_config = ConfigureRunOp(
+        sequence_path=sequence_path,
+        model_preset=model_preset,
+        num_multimer_predictions_per_model=num_multimer_predictions_per_model,
+        sampling_bucket=project,
+        sampling_run_id=dsl.PIPELINE_JOB_ID_PLACEHOLDER,
+    ).set_display_name('Configure Pipeline Run')
+
+    relax_mode = PlanRelaxOp(
+        is_run_relax=is_run_relax,
+        relax_policy=relax_policy,
+    ).set_display_name('Plan relaxation')
+
+    model_parameters = dsl.importer(
+        artifact_uri=pipeline_config.MODEL_PARAMS_GCS_LOCATION,
+        artifact_class=dsl.Artifact,
+        reimport=True
+    ).set_display_name('Model parameters')
+
+    reference_databases = dsl.importer(
+        artifact_uri=pipeline_config.NFS_MOUNT_POINT,
+        artifact_class=dsl.Dataset,
+        reimport=False,
+        metadata={
+            'uniref90': pipeline_config.UNIREF90_PATH,
+            'mgnify': pipeline_config.MGNIFY_PATH,
+            'bfd': pipeline_config.BFD_PATH,
+            'small_bfd': pipeline_config.SMALL_BFD_PATH,
+            'uniref30': pipeline_config.UNIREF30_PATH,
+            'pdb70': pipeline_config.PDB70_PATH,
+            'pdb_mmcif': pipeline_config.PDB_MMCIF_PATH,
+            'pdb_obsolete': pipeline_config.PDB_OBSOLETE_PATH,
+            'pdb_seqres': pipeline_config.PDB_SEQRES_PATH,
+            'uniprot': pipeline_config.UNIPROT_PATH,
+            }
+    ).set_display_name('Reference databases')
+
+    data_pipeline = DataPipelineOp(
         project=project,
         location=region,
-        model_features=data_pipeline.outputs['features'],
-        model_params=model_parameters.output,
-        model_name=model_runner.model_name,
-        prediction_index=model_runner.prediction_index,
+        ref_databases=reference_databases.output,
+        sequence=run_config.outputs['sequence'],
+        max_template_date=max_template_date,
         run_multimer_system=run_config.outputs['run_multimer_system'],
-        num_ensemble=run_config.outputs['num_ensemble'],
-        random_seed=model_runner.random_seed,
-        tf_force_unified_memory=config.TF_FORCE_UNIFIED_MEMORY,
-        xla_python_client_mem_fraction=config.XLA_PYTHON_CLIENT_MEM_FRACTION
-    ).set_display_name('Predict')
-
-    with dsl.Condition(is_run_relax == 'relax'):
-      relax_protein = JobRelaxOp(
-        project=project,
-        location=region,
-        unrelaxed_protein=model_predict.outputs['unrelaxed_protein'],
-        use_gpu=True,
-        tf_force_unified_memory=config.TF_FORCE_UNIFIED_MEMORY,
-        xla_python_client_mem_fraction=config.XLA_PYTHON_CLIENT_MEM_FRACTION
-      ).set_display_name('Relax protein')
+        use_small_bfd=use_small_bfd,
+        featurization_workers=pipeline_config.TEMPLATE_FEATURIZATION_WORKERS,
+    ).set_display_name('Prepare Features')
+
+    with dsl.ParallelFor(
+          run_config.outputs['model_runners'],
+          parallelism=pipeline_config.PARALLELISM
+          ) as model_runner:
+      model_predict = JobPredictOp(
+          project=project,
+          location=region,
+          model_features=data_pipeline.outputs['features'],
+          model_params=model_parameters.output,
+          model_name=model_runner.model_name,
+          prediction_index=model_runner.prediction_index,
+          run_multimer_system=run_config.outputs['run_multimer_system'],
+          num_ensemble=run_config.outputs['num_ensemble'],
+          random_seed=model_runner.random_seed,
+          tf_force_unified_memory=pipeline_config.TF_FORCE_UNIFIED_MEMORY,
+          xla_python_client_mem_fraction=pipeline_config.XLA_PYTHON_CLIENT_MEM_FRACTION,
+          pad_to_buckets=pad_to_buckets,
+          residue_buckets=pipeline_config.PADDING_RESIDUE_BUCKETS,
+          msa_buckets=pipeline_config.PADDING_MSA_BUCKETS,
+          use_prediction_cache=use_prediction_cache,
+          prediction_cache_bucket=project,
+          max_recycles=max_recycles,
+          recycle_early_stop_tolerance=recycle_early_stop_tolerance,
+          output_policy=output_policy,
+          output_names=pipeline_config.SLIM_PREDICTION_OUTPUTS,
+          half_precision=half_precision_outputs,
+          sampling_log_path=model_runner.sampling_log_path
+      ).set_display_name('Predict')
+
+      with dsl.Condition(relax_mode.output == 'all'):
+        relax_protein = JobRelaxOp(
+          project=project,
+          location=region,
+          unrelaxed_protein=model_predict.outputs['unrelaxed_protein'],
+          use_gpu=True,
+          max_violations=max_relax_violations,
+          tf_force_unified_memory=pipeline_config.TF_FORCE_UNIFIED_MEMORY,
+          xla_python_client_mem_fraction=pipeline_config.XLA_PYTHON_CLIENT_MEM_FRACTION
+        ).set_display_name('Relax protein')
+
+    # Relax only the best ranked predictions once all predictions are done
+    with dsl.Condition(relax_mode.output == 'selected'):
+      if hasattr(dsl, 'Collected'):
+        relax_targets = SelectRelaxTargetsOp(
+          predictions=dsl.Collected(model_predict.outputs['Output']),
+          relax_policy=relax_policy,
+          relax_top_k=relax_top_k,
+        )
+      else:
+        # kfp 1.8, which the portal compiles the pipeline with, cannot fan
+        # in the loop outputs: the predictions are read from their logs
+        relax_targets = SelectRelaxTargetsOp(
+          predictions=run_config.outputs['model_runners'],
+          relax_policy=relax_policy,
+          relax_top_k=relax_top_k,
+        ).after(model_predict)
+      relax_targets.set_display_name('Select predictions to relax')
+
+      with dsl.ParallelFor(
+        relax_targets.output,
+        parallelism=pipeline_config.PARALLELISM
+      ) as relax_target:
+        unrelaxed_protein = dsl.importer(
+          artifact_uri=relax_target.unrelaxed_protein_uri,
+          artifact_class=dsl.Artifact,
+          reimport=False,
+          metadata={'category': 'unrelaxed_protein'}
+        ).set_display_name('Import unrelaxed protein')
+
+        JobRelaxOp(
+          project=project,
+          location=region,
+          unrelaxed_protein=unrelaxed_protein.output,
+          use_gpu=True,
+          max_violations=max_relax_violations,
+          tf_force_unified_memory=pipeline_config.TF_FORCE_UNIFIED_MEMORY,
+          xla_python_client_mem_fraction=pipeline_config.XLA_PYTHON_CLIENT_MEM_FRACTION
+        ).set_display_name('Relax protein')
+
+  return alphafold_inference_pipeline
+
+
+alphafold_inference_pipeline = build_pipeline(config)
@@ -53,7 +53,20 @@ def alphafold_inference_pipeline_seq(
     model_preset: str = 'monomer',
     use_small_bfd: bool = True,
     num_multimer_predictions_per_model: int = 5,
-    is_run_relax: str = 'relax'
+    is_run_relax: str = 'relax',
+    relax_policy: str = 'all',
+    relax_top_k: int = 1,
+    max_relax_violations: int = config.MAX_RELAX_VIOLATIONS,
+    adaptive_sampling: str = 'false',
+    plateau_tolerance: float = 0.01,
+    max_predictions: int = 0,
+    pad_to_buckets: bool = False,
+    use_prediction_cache: str = 'false',
+    max_recycles: int = config.MAX_RECYCLES,
+    recycle_early_stop_tolerance: float = config.RECYCLE_EARLY_STOP_TOLERANCE,
+    output_policy: str = 'full',
+    half_precision_outputs: bool = False,
+    run_memory_planner: bool = False
 ):
     """Universal Alphafold Inference Pipeline."""
     run_config = ConfigureRunOp(
@@ -94,6 +107,7 @@ def alphafold_inference_pipeline_seq(
         max_template_date=max_template_date,
         run_multimer_system=run_config.outputs['run_multimer_system'],
         use_small_bfd=use_small_bfd,
+        featurization_workers=config.TEMPLATE_FEATURIZATION_WORKERS,
     ).set_display_name('Prepare Features')
 
     model_predict_relax = JobPredictRelaxOp(
@@ -106,5 +120,26 @@ def alphafold_inference_pipeline_seq(
         num_ensemble=run_config.outputs['num_ensemble'],
         is_run_relax=is_run_relax,
         tf_force_unified_memory=config.TF_FORCE_UNIFIED_MEMORY,
-        xla_python_client_mem_fraction=config.XLA_PYTHON_CLIENT_MEM_FRACTION
+        xla_python_client_mem_fraction=config.XLA_PYTHON_CLIENT_MEM_FRACTION,
+        pad_to_buckets=pad_to_buckets,
+        residue_buckets=config.PADDING_RESIDUE_BUCKETS,
+        msa_buckets=config.PADDING_MSA_BUCKETS,
+        use_prediction_cache=use_prediction_cache,
+        prediction_cache_bucket=project,
+        max_recycles=max_recycles,
+        recycle_early_stop_tolerance=recycle_early_stop_tolerance,
+        output_policy=output_policy,
+        output_names=config.SLIM_PREDICTION_OUTPUTS,
+        half_precision=half_precision_outputs,
+        relax_workers=config.PREDICT_RELAX_WORKERS,
+        relax_policy=relax_policy,
+        relax_top_k=relax_top_k,
+        max_relax_violations=max_relax_violations,
+        adaptive_sampling=adaptive_sampling,
+        plateau_tolerance=plateau_tolerance,
+        max_predictions=max_predictions,
+        run_memory_planner=run_memory_planner,
+        accelerator_memory_gb=float(config.ACCELERATOR_MEMORY_GB.get(
+            config.PREDICT_ACCELERATOR_TYPE,
+            config.DEFAULT_ACCELERATOR_MEMORY_GB))
     ).set_display_name('Predict/Relax')
@@ -87,7 +87,13 @@ def alphafold_monomer_pipeline(
     max_template_date: str,
     uniref_max_hits: int = config.UNIREF_MAX_HITS,
     mgnify_max_hits: int = config.MGNIFY_MAX_HITS,
-    is_run_relax: str = 'relax'
+    is_run_relax: str = 'relax',
+    max_relax_violations: int = config.MAX_RELAX_VIOLATIONS,
+    pad_to_buckets: bool = False,
+    use_prediction_cache: str = 'false',
+    max_recycles: int = config.MAX_RECYCLES,
+    output_policy: str = 'full',
+    half_precision_outputs: bool = False
 ):
   """Monomer-optimized Alphafold Inference Pipeline."""
   run_config = ConfigureRunOp(
@@ -126,6 +132,11 @@ def alphafold_monomer_pipeline(
       ref_databases=reference_databases.output,
       sequence=run_config.outputs['sequence'],
       maxseq=uniref_max_hits,
+      num_shards=config.UNIREF90_NUM_SHARDS,
+      prefilter_max_candidates=config.UNIREF90_PREFILTER_MAX_CANDIDATES,
+      staging_dir=config.DATABASE_STAGING_DIR,
+      staging_max_gb=config.DATABASE_STAGING_MAX_GB,
+      warm_page_cache=config.DATABASE_STAGING_WARM_PAGE_CACHE,
   )
   search_uniref.set_display_name('Search Uniref')
 
@@ -135,7 +146,10 @@ def alphafold_monomer_pipeline(
       database='mgnify',
       ref_databases=reference_databases.output,
       sequence=run_config.outputs['sequence'],
-      maxseq=mgnify_max_hits
+      maxseq=mgnify_max_hits,
+      staging_dir=config.DATABASE_STAGING_DIR,
+      staging_max_gb=config.DATABASE_STAGING_MAX_GB,
+      warm_page_cache=config.DATABASE_STAGING_WARM_PAGE_CACHE,
   )
   search_mgnify.set_display_name('Search Mgnify')
 
@@ -145,6 +159,9 @@ def alphafold_monomer_pipeline(
       databases=['uniref30'],
       ref_databases=reference_databases.output,
       sequence=run_config.outputs['sequence'],
+      staging_dir=config.DATABASE_STAGING_DIR,
+      staging_max_gb=config.DATABASE_STAGING_MAX_GB,
+      warm_page_cache=config.DATABASE_STAGING_WARM_PAGE_CACHE,
   )
   search_uniclust.set_display_name('Search Uniclust')
 
@@ -154,6 +171,9 @@ def alphafold_monomer_pipeline(
       databases=['bfd'],
       ref_databases=reference_databases.output,
       sequence=run_config.outputs['sequence'],
+      staging_dir=config.DATABASE_STAGING_DIR,
+      staging_max_gb=config.DATABASE_STAGING_MAX_GB,
+      warm_page_cache=config.DATABASE_STAGING_WARM_PAGE_CACHE,
   )
   search_bfd.set_display_name('Search BFD')
 
@@ -167,6 +187,7 @@ def alphafold_monomer_pipeline(
       ref_databases=reference_databases.output,
       sequence=run_config.outputs['sequence'],
       msa=search_uniref.outputs['msa'],
+      featurization_workers=config.TEMPLATE_FEATURIZATION_WORKERS,
   )
   search_pdb.set_display_name('Search Pdb')
 
@@ -192,7 +213,16 @@ def alphafold_monomer_pipeline(
         num_ensemble=run_config.outputs['num_ensemble'],
         random_seed=model_runner.random_seed,
         tf_force_unified_memory=config.TF_FORCE_UNIFIED_MEMORY,
-        xla_python_client_mem_fraction=config.XLA_PYTHON_CLIENT_MEM_FRACTION
+        xla_python_client_mem_fraction=config.XLA_PYTHON_CLIENT_MEM_FRACTION,
+        pad_to_buckets=pad_to_buckets,
+        residue_buckets=config.PADDING_RESIDUE_BUCKETS,
+        msa_buckets=config.PADDING_MSA_BUCKETS,
+        use_prediction_cache=use_prediction_cache,
+        prediction_cache_bucket=project,
+        max_recycles=max_recycles,
+        output_policy=output_policy,
+        output_names=config.SLIM_PREDICTION_OUTPUTS,
+        half_precision=half_precision_outputs
     )
     model_predict.set_display_name('Predict')
 
@@ -202,6 +232,7 @@ def alphafold_monomer_pipeline(
         location=region,
         unrelaxed_protein=model_predict.outputs['unrelaxed_protein'],
         use_gpu=True,
+        max_violations=max_relax_violations,
         tf_force_unified_memory=config.TF_FORCE_UNIFIED_MEMORY,
         xla_python_client_mem_fraction=config.XLA_PYTHON_CLIENT_MEM_FRACTION
       )
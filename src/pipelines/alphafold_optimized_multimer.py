@@ -19,16 +19,23 @@ from kfp.v2.dsl import Artifact, importer
 import config as config
 from components.aggregate_features_multimer import aggregate_features_multimer
 from components.aggregate_features_across_chains import aggregate_features_across_chains as AggregateFeaturesAcrossChainsOp
-from components.configure_run_multimer import configure_run_multimer as ConfigureRunOp
+from components.setup_multimer_run import setup_multimer_run as SetupRunOp
 from components import hhblits
 from components.hmmsearch import hmmsearch
+from components.batch_hmmsearch import batch_hmmsearch
+from components.no_op_artifact_output import no_op_artifact_output
 from components import jackhmmer
 from components import predict as PredictOp
 from components import relax as RelaxOp
-from components.download_sequence import download_sequence as DownloadSequenceOp
-from components.filter_chains import filter_chains as FilterChainsOp
+from components.relax_batch import relax_batch as RelaxBatchOp
+from components.plan_relax import plan_relax as PlanRelaxOp
+from components.select_relax_targets import select_relax_targets as SelectRelaxTargetsOp
+from components.select_sampled_relax_targets import select_sampled_relax_targets as SelectSampledRelaxTargetsOp
+from components.plan_sampling_wave import plan_sampling_wave as PlanSamplingWaveOp
+from components.plan_memory import plan_memory as PlanMemoryOp
+from components.default_memory_plan import default_memory_plan as DefaultMemoryPlanOp
 from components.bfd_search import bfd_search
-from components.create_run_id import create_run_id as CreateRunIdOp
+from components.colocated_msa_search import colocated_msa_search
 import os
 
 JackhmmerOp = create_custom_training_job_from_component(
@@ -66,6 +73,19 @@ BFDSearchOp = create_custom_training_job_from_component(
     network=config.NETWORK
 )
 
+ColocatedSearchOp = create_custom_training_job_from_component(
+    colocated_msa_search,
+    display_name='ColocatedSearch',
+    machine_type=config.COLOCATED_SEARCH_MACHINE_TYPE,
+    nfs_mounts=[dict(
+        server=config.NFS_SERVER,
+        path=config.NFS_PATH,
+        mountPoint=config.NFS_MOUNT_POINT,
+        mountOptions=['rw,nfsvers=3,exec']
+    )],
+    network=config.NETWORK
+)
+
 HHblitsOp = create_custom_training_job_from_component(
     hhblits,
     display_name='HHblits',
@@ -92,6 +112,19 @@ HHsearchOp = create_custom_training_job_from_component(
     network=config.NETWORK
 )
 
+BatchHmmsearchOp = create_custom_training_job_from_component(
+    batch_hmmsearch,
+    display_name='BatchHmmSearch',
+    machine_type=config.HMMSEARCH_MACHINE_TYPE,
+    nfs_mounts=[dict(
+        server=config.NFS_SERVER,
+        path=config.NFS_PATH,
+        mountPoint=config.NFS_MOUNT_POINT,
+        mountOptions=['rw,nfsvers=3,exec']
+    )],
+    network=config.NETWORK
+)
+
 JobPredictOp = create_custom_training_job_from_component(
     PredictOp,
     display_name = 'Predict',
@@ -108,6 +141,56 @@ JobRelaxOp = create_custom_training_job_from_component(
     accelerator_count = '1' if 'RELAX_ACCELERATOR_COUNT' not in os.environ else os.environ['RELAX_ACCELERATOR_COUNT']
 )
 
+JobRelaxBatchOp = create_custom_training_job_from_component(
+    RelaxBatchOp,
+    display_name='Relax batch',
+    machine_type=config.RELAX_BATCH_MACHINE_TYPE,
+)
+
+def _relax_prediction(project, region, unrelaxed_protein, max_relax_violations):
+    """Relaxes a prediction in a relax task of its own."""
+    return JobRelaxOp(
+        project=project,
+        location=region,
+        unrelaxed_protein=unrelaxed_protein,
+        use_gpu=True,
+        max_violations=max_relax_violations,
+        tf_force_unified_memory=config.TF_FORCE_UNIFIED_MEMORY,
+        xla_python_client_mem_fraction=config.XLA_PYTHON_CLIENT_MEM_FRACTION
+    ).set_display_name('Relax protein')
+
+
+def _relax_targets(project, region, relax_targets, batch_relax,
+                   max_relax_violations):
+    """Relaxes the selected predictions in one batch task or a task each.
+
+    relax_targets is the task selecting the predictions to relax.
+    """
+    with dsl.Condition(batch_relax == 'true'):
+        JobRelaxBatchOp(
+            project=project,
+            location=region,
+            relax_targets=relax_targets.output,
+            max_violations=max_relax_violations,
+        ).set_display_name('Relax proteins')
+
+    with dsl.Condition(batch_relax == 'false'):
+        with dsl.ParallelFor(
+            relax_targets.output,
+            parallelism=config.PARALLELISM
+        ) as relax_target:
+            unrelaxed_protein = dsl.importer(
+                artifact_uri=relax_target.unrelaxed_protein_uri,
+                artifact_class=dsl.Artifact,
+                reimport=False,
+                metadata={'category': 'unrelaxed_protein'}
+            ).set_display_name('Import unrelaxed protein')
+
+            _relax_prediction(
+                project, region, unrelaxed_protein.output,
+                max_relax_violations)
+
+
 @dsl.pipeline(
     name='alphafold-multimer-optimized',
     description='AlphaFold multimer inference using parallized MSA search.'
@@ -122,20 +205,49 @@ def alphafold_multimer_pipeline(
     mgnify_max_hits: int = config.MGNIFY_MAX_HITS,
     uniprot_max_hits: int = config.UNIPROT_MAX_HITS,
     is_run_relax: str = 'relax',
+    relax_policy: str = 'all',
+    relax_top_k: int = 1,
+    max_relax_violations: int = config.MAX_RELAX_VIOLATIONS,
+    adaptive_sampling: str = 'false',
+    plateau_tolerance: float = 0.01,
+    max_predictions: int = 0,
+    pad_to_buckets: bool = False,
+    use_prediction_cache: str = 'true',
+    max_recycles: int = config.MAX_RECYCLES,
+    recycle_early_stop_tolerance: float = config.RECYCLE_EARLY_STOP_TOLERANCE,
+    output_policy: str = 'full',
+    half_precision_outputs: bool = False,
+    run_memory_planner: str = 'false',
+    batch_relax: str = 'false',
     num_multimer_predictions_per_model: int = 5,
     use_small_bfd: str = 'true',
+    colocated_search_max_residues: int = config.COLOCATED_SEARCH_MAX_RESIDUES,
+    batch_template_search: str = 'false',
 ):
     """Multimer-optimized Alphafold Inference Pipeline."""
 
     from kfp.v2 import dsl
     from kfp.v2.dsl import Artifact, importer
 
-    # Configure the run
-    run_config = ConfigureRunOp(
+    # Configure the run, create the unique run ID and find the chains with
+    # precomputed features in a single task
+    run_config = SetupRunOp(
         sequence_path=sequence_path,
-        model_preset='multimer',
-        num_multimer_predictions_per_model=num_multimer_predictions_per_model
-    ).set_display_name('Configure Multimer Pipeline Run')
+        project=project,
+        use_small_bfd=use_small_bfd,
+        max_template_date=max_template_date,
+        uniref_max_hits=uniref_max_hits,
+        mgnify_max_hits=mgnify_max_hits,
+        uniprot_max_hits=uniprot_max_hits,
+        num_multimer_predictions_per_model=num_multimer_predictions_per_model,
+        batch_template_search=batch_template_search,
+        colocated_search_max_residues=colocated_search_max_residues,
+    ).set_display_name('Set up Multimer Pipeline Run')
+
+    relax_mode = PlanRelaxOp(
+        is_run_relax=is_run_relax,
+        relax_policy=relax_policy,
+    ).set_display_name('Plan relaxation')
 
     model_parameters = dsl.importer(
         artifact_uri=config.MODEL_PARAMS_GCS_LOCATION,
@@ -161,33 +273,15 @@ def alphafold_multimer_pipeline(
         }
     ).set_display_name('Reference databases')
 
-    # Create the features directory first without sequence dependency
-    per_chain_features_dir = CreateRunIdOp(
-        sequence_path=sequence_path,
-        use_small_bfd=use_small_bfd,
-        max_template_date=max_template_date,
-        uniref_max_hits=uniref_max_hits,
-        mgnify_max_hits=mgnify_max_hits,
-        uniprot_max_hits=uniprot_max_hits,
-        project=project
-    ).set_display_name('Create unique run ID')
-
     chain_feature_ops = []
 
-    # Create a component to filter chains based on precomputed features
-    filter_chains = FilterChainsOp(
-        chain_info_list=run_config.outputs['chain_info_list'],
-        per_chain_features_dir=per_chain_features_dir.output,
-        project=project
-    ).set_display_name('Filter chains')
-
     # Process chains without precomputed features
     with dsl.ParallelFor(
-        filter_chains.outputs['chains_to_process'],
+        run_config.outputs['chains_to_process'],
         parallelism=config.PARALLELISM
     ) as chain:
         # Import the sequence artifact from GCS URI
-        raw_artifact = importer(
+        sequence_artifact = importer(
             artifact_uri=chain.sequence_path,
             artifact_class=Artifact,
             metadata={
@@ -198,106 +292,275 @@ def alphafold_multimer_pipeline(
             reimport=True,
         ).set_display_name(f"Import sequence artifact for chain {chain.chain_id}")
 
-        # Download sequence
-        sequence_artifact = DownloadSequenceOp(raw_artifact.output)
-        
         # MSA searches
         msa_searches = {}
-        
-        # Uniref search
-        msa_searches['uniref'] = JackhmmerOp(
-            project=project,
-            location=region,
-            database='uniref90',
-            ref_databases=reference_databases.output,
-            sequence=sequence_artifact.output,
-            maxseq=uniref_max_hits,
-        ).set_display_name('Search Uniref')
 
-        # Mgnify search
-        msa_searches['mgnify'] = JackhmmerOp(
-            project=project,
-            location=region,
-            database='mgnify',
-            ref_databases=reference_databases.output,
-            sequence=sequence_artifact.output,
-            maxseq=mgnify_max_hits,
-        ).set_display_name('Search Mgnify')
+        # Small chains run the three searches concurrently in one task,
+        # larger ones fan out to a task per search
+        with dsl.If(chain.search_mode == 'colocated'):
+            colocated_search = ColocatedSearchOp(
+                project=project,
+                location=region,
+                sequence=sequence_artifact.output,
+                ref_databases=reference_databases.output,
+                use_small_bfd=use_small_bfd,
+                uniref_max_hits=uniref_max_hits,
+                mgnify_max_hits=mgnify_max_hits,
+                uniref_num_shards=config.UNIREF90_NUM_SHARDS,
+                uniref_prefilter_max_candidates=config.UNIREF90_PREFILTER_MAX_CANDIDATES,
+                staging_dir=config.DATABASE_STAGING_DIR,
+                staging_max_gb=config.DATABASE_STAGING_MAX_GB,
+                warm_page_cache=config.DATABASE_STAGING_WARM_PAGE_CACHE,
+            ).set_display_name('Search Uniref, Mgnify and BFD')
+
+        with dsl.Else():
+            # Uniref search
+            uniref_search = JackhmmerOp(
+                project=project,
+                location=region,
+                database='uniref90',
+                ref_databases=reference_databases.output,
+                sequence=sequence_artifact.output,
+                maxseq=uniref_max_hits,
+                num_shards=config.UNIREF90_NUM_SHARDS,
+                prefilter_max_candidates=config.UNIREF90_PREFILTER_MAX_CANDIDATES,
+                staging_dir=config.DATABASE_STAGING_DIR,
+                staging_max_gb=config.DATABASE_STAGING_MAX_GB,
+                warm_page_cache=config.DATABASE_STAGING_WARM_PAGE_CACHE,
+            ).set_display_name('Search Uniref')
+
+            # Mgnify search
+            mgnify_search = JackhmmerOp(
+                project=project,
+                location=region,
+                database='mgnify',
+                ref_databases=reference_databases.output,
+                sequence=sequence_artifact.output,
+                maxseq=mgnify_max_hits,
+                staging_dir=config.DATABASE_STAGING_DIR,
+                staging_max_gb=config.DATABASE_STAGING_MAX_GB,
+                warm_page_cache=config.DATABASE_STAGING_WARM_PAGE_CACHE,
+            ).set_display_name('Search Mgnify')
+
+            # BFD search (combined component)
+            bfd_msa_search = BFDSearchOp(
+                project=project,
+                location=region,
+                sequence=sequence_artifact.output,
+                ref_databases=reference_databases.output,
+                use_small_bfd=use_small_bfd,
+                staging_dir=config.DATABASE_STAGING_DIR,
+                staging_max_gb=config.DATABASE_STAGING_MAX_GB,
+                warm_page_cache=config.DATABASE_STAGING_WARM_PAGE_CACHE,
+            ).set_display_name('Search BFD')
 
-        # BFD search (combined component)
-        msa_searches['bfd'] = BFDSearchOp(
+        msa_searches['uniref'] = dsl.OneOf(
+            colocated_search.outputs['uniref_msa'],
+            uniref_search.outputs['msa'])
+        msa_searches['mgnify'] = dsl.OneOf(
+            colocated_search.outputs['mgnify_msa'],
+            mgnify_search.outputs['msa'])
+        msa_searches['bfd'] = dsl.OneOf(
+            colocated_search.outputs['bfd_msa'],
+            bfd_msa_search.outputs['msa'])
+
+        # PDB search, batched across the chains after the loop if
+        # batch_template_search is set
+        with dsl.If(batch_template_search == 'false'):
+            search_pdb = HHsearchOp(
+                project=project,
+                location=region,
+                template_db='pdb_seqres',
+                mmcif_db='pdb_mmcif',
+                obsolete_db='pdb_obsolete',
+                max_template_date=max_template_date,
+                ref_databases=reference_databases.output,
+                sequence=sequence_artifact.output,
+                msa=msa_searches['uniref'],
+                staging_dir=config.DATABASE_STAGING_DIR,
+                staging_max_gb=config.DATABASE_STAGING_MAX_GB,
+                warm_page_cache=config.DATABASE_STAGING_WARM_PAGE_CACHE,
+                search_daemon_address=config.SEARCH_DAEMON_ADDRESS,
+                featurization_workers=config.TEMPLATE_FEATURIZATION_WORKERS,
+            ).set_display_name('Search PDB')
+
+        with dsl.Else():
+            no_template = no_op_artifact_output()
+
+        template_features = dsl.OneOf(
+            search_pdb.outputs['template_features'], no_template.output)
+
+        # Aggregate features
+        aggregate_features = AggregateOp(
             project=project,
             location=region,
             sequence=sequence_artifact.output,
             ref_databases=reference_databases.output,
-            use_small_bfd=use_small_bfd,
-        ).set_display_name('Search BFD')
+            msa1=msa_searches['uniref'],
+            msa2=msa_searches['mgnify'],
+            msa3=msa_searches['bfd'],
+            template_features=template_features,
+            chain_id=chain.chain_id,
+            per_chain_features_dir=run_config.outputs['per_chain_features_dir'],
+            is_homomer=run_config.outputs['is_homomer_or_monomer'],
+            maxseq=uniprot_max_hits,
+            uniprot_num_shards=config.UNIPROT_NUM_SHARDS,
+            uniprot_prefilter_max_candidates=config.UNIPROT_PREFILTER_MAX_CANDIDATES,
+            defer_templates=batch_template_search,
+        ).set_display_name(f"Aggregate features chain {chain.chain_id}")
+        
+        chain_feature_ops.append(aggregate_features)
 
-        # PDB search
-        search_pdb = HHsearchOp(
+    # Search the templates of all chains in one pass over pdb_seqres before
+    # aggregating the features across chains
+    with dsl.If(run_config.outputs['defer_templates'] == 'true'):
+        batch_search_pdb = BatchHmmsearchOp(
             project=project,
             location=region,
+            chains=dsl.Collected(aggregate_features.outputs['Output']),
             template_db='pdb_seqres',
             mmcif_db='pdb_mmcif',
             obsolete_db='pdb_obsolete',
             max_template_date=max_template_date,
             ref_databases=reference_databases.output,
-            sequence=sequence_artifact.output,
-            msa=msa_searches['uniref'].outputs['msa'],
-        ).set_display_name('Search PDB')
+            staging_dir=config.DATABASE_STAGING_DIR,
+            staging_max_gb=config.DATABASE_STAGING_MAX_GB,
+            warm_page_cache=config.DATABASE_STAGING_WARM_PAGE_CACHE,
+            search_daemon_address=config.SEARCH_DAEMON_ADDRESS,
+            featurization_workers=config.TEMPLATE_FEATURIZATION_WORKERS,
+        ).set_display_name('Search PDB for all chains')
 
-        # Aggregate features
-        aggregate_features = AggregateOp(
-            project=project,
-            location=region,
-            sequence=sequence_artifact.output,
-            msa1=msa_searches['uniref'].outputs['msa'],
-            msa2=msa_searches['mgnify'].outputs['msa'],
-            msa3=msa_searches['bfd'].outputs['msa'],
-            template_features=search_pdb.outputs['template_features'],
-            chain_id=chain.chain_id,
-            per_chain_features_dir=per_chain_features_dir.output,
-            is_homomer=run_config.outputs['is_homomer_or_monomer'],
-            maxseq=uniprot_max_hits,
-        ).after(per_chain_features_dir).after(search_pdb).set_display_name(f"Aggregate features chain {chain.chain_id}")
-        
-        chain_feature_ops.append(aggregate_features)
+        batch_aggregate_features_across_chains = AggregateFeaturesAcrossChainsOp(
+            per_chain_features_dir=run_config.outputs['per_chain_features_dir'],
+            sequences=run_config.outputs['sequence'],
+            is_homomer_or_monomer=run_config.outputs['is_homomer_or_monomer'],
+            output_features_path=run_config.outputs['per_chain_features_dir'],
+        ).after(batch_search_pdb)
 
-    # Aggregate features across chains
-    aggregate_features_across_chains = AggregateFeaturesAcrossChainsOp(
-        per_chain_features_dir=per_chain_features_dir.output,
-        sequences=run_config.outputs['sequence'],
-        is_homomer_or_monomer=run_config.outputs['is_homomer_or_monomer'],
-        output_features_path=per_chain_features_dir.output,
-    ).after(per_chain_features_dir).after(*chain_feature_ops)
+    with dsl.Else():
+        aggregate_features_across_chains = AggregateFeaturesAcrossChainsOp(
+            per_chain_features_dir=run_config.outputs['per_chain_features_dir'],
+            sequences=run_config.outputs['sequence'],
+            is_homomer_or_monomer=run_config.outputs['is_homomer_or_monomer'],
+            output_features_path=run_config.outputs['per_chain_features_dir'],
+        ).after(*chain_feature_ops)
 
-    # Second ParallelFor loop for model predictions
-    with dsl.ParallelFor(
-        loop_args=run_config.outputs['model_runners'], 
-        parallelism=config.PARALLELISM
-    ) as model_runner:
+    model_features = dsl.OneOf(
+        batch_aggregate_features_across_chains.outputs['features'],
+        aggregate_features_across_chains.outputs['features'])
+
+    # Plan the accelerator memory of the predictions from the feature shapes
+    with dsl.If(run_memory_planner == 'true'):
+        planned_memory = PlanMemoryOp(
+            model_features=model_features,
+            model_runners=run_config.outputs['model_runners'],
+            run_multimer_system=True,
+            accelerator_type=config.PREDICT_ACCELERATOR_TYPE,
+            accelerator_memory_gb=float(config.ACCELERATOR_MEMORY_GB.get(
+                config.PREDICT_ACCELERATOR_TYPE,
+                config.DEFAULT_ACCELERATOR_MEMORY_GB)),
+            machine_tiers=config.MEMORY_PLANNER_MACHINE_TIERS,
+        ).set_display_name('Plan memory')
+    with dsl.Else():
+        default_memory = DefaultMemoryPlanOp(
+            tf_force_unified_memory=config.TF_FORCE_UNIFIED_MEMORY,
+            xla_python_client_mem_fraction=config.XLA_PYTHON_CLIENT_MEM_FRACTION,
+        ).set_display_name('Default memory settings')
+
+    tf_force_unified_memory = dsl.OneOf(
+        planned_memory.outputs['tf_force_unified_memory'],
+        default_memory.outputs['tf_force_unified_memory'])
+    xla_python_client_mem_fraction = dsl.OneOf(
+        planned_memory.outputs['xla_python_client_mem_fraction'],
+        default_memory.outputs['xla_python_client_mem_fraction'])
+    subbatch_size = dsl.OneOf(
+        planned_memory.outputs['subbatch_size'],
+        default_memory.outputs['subbatch_size'])
+
+    def predict_and_relax(model_runner, **predict_options):
+        """Runs a prediction, and relaxes it in relax mode 'all'."""
         model_predict = JobPredictOp(
             project=project,
             location=region,
-            model_features=aggregate_features_across_chains.outputs['features'],
+            model_features=model_features,
             model_params=model_parameters.output,
             model_name=model_runner.model_name,
             prediction_index=model_runner.prediction_index,
             run_multimer_system=run_config.outputs['run_multimer_system'],
             num_ensemble=run_config.outputs['num_ensemble'],
             random_seed=model_runner.random_seed,
-            tf_force_unified_memory=config.TF_FORCE_UNIFIED_MEMORY,
-            xla_python_client_mem_fraction=config.XLA_PYTHON_CLIENT_MEM_FRACTION
-        )
-        model_predict.set_display_name('Predict')
+            tf_force_unified_memory=tf_force_unified_memory,
+            xla_python_client_mem_fraction=xla_python_client_mem_fraction,
+            subbatch_size=subbatch_size,
+            pad_to_buckets=pad_to_buckets,
+            residue_buckets=config.PADDING_RESIDUE_BUCKETS,
+            msa_buckets=config.PADDING_MSA_BUCKETS,
+            use_prediction_cache=use_prediction_cache,
+            prediction_cache_bucket=project,
+            max_recycles=max_recycles,
+            recycle_early_stop_tolerance=recycle_early_stop_tolerance,
+            output_policy=output_policy,
+            output_names=config.SLIM_PREDICTION_OUTPUTS,
+            half_precision=half_precision_outputs,
+            **predict_options
+        ).set_display_name('Predict')
 
-        with dsl.Condition(is_run_relax == 'relax'):
-            relax_protein = JobRelaxOp(
-                project=project,
-                location=region,
-                unrelaxed_protein=model_predict.outputs['unrelaxed_protein'],
-                use_gpu=True,
-                tf_force_unified_memory=config.TF_FORCE_UNIFIED_MEMORY,
-                xla_python_client_mem_fraction=config.XLA_PYTHON_CLIENT_MEM_FRACTION
-            )
-            relax_protein.set_display_name('Relax protein')
\ No newline at end of file
+        with dsl.Condition(relax_mode.output == 'all'):
+            _relax_prediction(
+                project, region, model_predict.outputs['unrelaxed_protein'],
+                max_relax_violations)
+        return model_predict
+
+    # Second ParallelFor loop for model predictions
+    with dsl.Condition(adaptive_sampling == 'false'):
+        with dsl.ParallelFor(
+            run_config.outputs['model_runners'],
+            parallelism=config.PARALLELISM
+        ) as model_runner:
+            model_predict = predict_and_relax(model_runner)
+
+        # Relax only the best ranked predictions once all predictions are done
+        with dsl.Condition(relax_mode.output == 'selected'):
+            relax_targets = SelectRelaxTargetsOp(
+                predictions=dsl.Collected(model_predict.outputs['Output']),
+                relax_policy=relax_policy,
+                relax_top_k=relax_top_k,
+            ).set_display_name('Select predictions to relax')
+
+            _relax_targets(
+                project, region, relax_targets, batch_relax, max_relax_violations)
+
+    # Adaptive sampling launches one seed per model at a time and stops
+    # launching seeds once the top ranking confidence has plateaued
+    with dsl.Condition(adaptive_sampling == 'true'):
+        with dsl.ParallelFor(
+            run_config.outputs['sampling_waves'],
+            parallelism=1
+        ) as sampling_wave:
+            wave_runners = PlanSamplingWaveOp(
+                wave_index=sampling_wave.wave_index,
+                model_runners=sampling_wave.model_runners,
+                sampling_bucket=project,
+                sampling_run_id=dsl.PIPELINE_JOB_ID_PLACEHOLDER,
+                plateau_tolerance=plateau_tolerance,
+                max_predictions=max_predictions,
+            ).set_display_name('Plan sampling wave')
+
+            with dsl.ParallelFor(
+                wave_runners.output,
+                parallelism=config.PARALLELISM
+            ) as model_runner:
+                model_predict = predict_and_relax(
+                    model_runner,
+                    sampling_log_path=model_runner.sampling_log_path)
+
+        # Relax only the best ranked predictions of all waves
+        with dsl.Condition(relax_mode.output == 'selected'):
+            relax_targets = SelectSampledRelaxTargetsOp(
+                sampling_waves=dsl.Collected(wave_runners.output),
+                relax_policy=relax_policy,
+                relax_top_k=relax_top_k,
+            ).set_display_name('Select predictions to relax')
+
+            _relax_targets(
+                project, region, relax_targets, batch_relax, max_relax_violations)
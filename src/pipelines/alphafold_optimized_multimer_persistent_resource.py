@@ -14,21 +14,28 @@
 """Multimer-optimized Alphafold Inference Pipeline."""
 from google_cloud_pipeline_components.v1.custom_job import create_custom_training_job_from_component
 from kfp.v2 import dsl
-from kfp.v2.dsl import Artifact, importer, Output
+from kfp.v2.dsl import Artifact, importer
 
 import config as config
 from components.aggregate_features_multimer import aggregate_features_multimer
 from components.aggregate_features_across_chains import aggregate_features_across_chains as AggregateFeaturesAcrossChainsOp
-from components.configure_run_multimer import configure_run_multimer as ConfigureRunOp
+from components.setup_multimer_run import setup_multimer_run as SetupRunOp
 from components import hhblits
 from components.hmmsearch import hmmsearch
+from components.batch_hmmsearch import batch_hmmsearch
+from components.no_op_artifact_output import no_op_artifact_output
 from components import jackhmmer
 from components import predict as PredictOp
+from components.predict_via_worker import predict_via_worker as PredictViaWorkerOp
 from components import relax as RelaxOp
-from components.download_sequence import download_sequence as DownloadSequenceOp
-from components.filter_chains import filter_chains as FilterChainsOp
+from components.relax_batch import relax_batch as RelaxBatchOp
+from components.plan_relax import plan_relax as PlanRelaxOp
+from components.select_relax_targets import select_relax_targets as SelectRelaxTargetsOp
+from components.select_sampled_relax_targets import select_sampled_relax_targets as SelectSampledRelaxTargetsOp
+from components.plan_sampling_wave import plan_sampling_wave as PlanSamplingWaveOp
+from components.plan_memory import plan_memory as PlanMemoryOp
+from components.default_memory_plan import default_memory_plan as DefaultMemoryPlanOp
 from components.bfd_search import bfd_search
-from components.create_run_id import create_run_id as CreateRunIdOp
 import os
 
 JackhmmerOp = create_custom_training_job_from_component(
@@ -92,6 +99,19 @@ HHsearchOp = create_custom_training_job_from_component(
     network=config.NETWORK
 )
 
+BatchHmmsearchOp = create_custom_training_job_from_component(
+    batch_hmmsearch,
+    display_name='BatchHmmSearch',
+    machine_type=config.HMMSEARCH_MACHINE_TYPE,
+    nfs_mounts=[dict(
+        server=config.NFS_SERVER,
+        path=config.NFS_PATH,
+        mountPoint=config.NFS_MOUNT_POINT,
+        mountOptions=['rw,nfsvers=3,exec']
+    )],
+    network=config.NETWORK
+)
+
 JobPredictOp = create_custom_training_job_from_component(
     PredictOp,
     display_name='Predict',
@@ -103,6 +123,17 @@ JobPredictOp = create_custom_training_job_from_component(
     boot_disk_size_gb=config.PREDICT_PERSISTENT_DISK_SIZE,
 )
 
+JobPredictViaWorkerOp = create_custom_training_job_from_component(
+    PredictViaWorkerOp,
+    display_name='Predict (worker)',
+    machine_type=config.PREDICTION_WORKER_CLIENT_MACHINE_TYPE,
+    nfs_mounts=[dict(
+        server=config.NFS_SERVER,
+        path=config.NFS_PATH,
+        mountPoint=config.NFS_MOUNT_POINT)],
+    network=config.NETWORK
+)
+
 JobRelaxOp = create_custom_training_job_from_component(
     RelaxOp,
     display_name='Relax',
@@ -114,11 +145,55 @@ JobRelaxOp = create_custom_training_job_from_component(
     boot_disk_size_gb=config.RELAX_PERSISTENT_DISK_SIZE,
 )
 
-@dsl.component
-def no_op_artifact_output(empty_artifact: Output[Artifact]):
-    # Just create an empty file
-    with open(empty_artifact.path, 'w') as f:
-        f.write("")  # empty file
+JobRelaxBatchOp = create_custom_training_job_from_component(
+    RelaxBatchOp,
+    display_name='Relax batch',
+    machine_type=config.RELAX_BATCH_MACHINE_TYPE,
+)
+
+def _relax_prediction(project, region, unrelaxed_protein, max_relax_violations):
+    """Relaxes a prediction in a relax task of its own."""
+    return JobRelaxOp(
+        project=project,
+        location=region,
+        unrelaxed_protein=unrelaxed_protein,
+        use_gpu=True,
+        max_violations=max_relax_violations,
+        tf_force_unified_memory=config.TF_FORCE_UNIFIED_MEMORY,
+        xla_python_client_mem_fraction=config.XLA_PYTHON_CLIENT_MEM_FRACTION
+    ).set_display_name('Relax protein')
+
+
+def _relax_targets(project, region, relax_targets, batch_relax,
+                   max_relax_violations):
+    """Relaxes the selected predictions in one batch task or a task each.
+
+    relax_targets is the task selecting the predictions to relax.
+    """
+    with dsl.Condition(batch_relax == 'true'):
+        JobRelaxBatchOp(
+            project=project,
+            location=region,
+            relax_targets=relax_targets.output,
+            max_violations=max_relax_violations,
+        ).set_display_name('Relax proteins')
+
+    with dsl.Condition(batch_relax == 'false'):
+        with dsl.ParallelFor(
+            relax_targets.output,
+            parallelism=config.PARALLELISM
+        ) as relax_target:
+            unrelaxed_protein = dsl.importer(
+                artifact_uri=relax_target.unrelaxed_protein_uri,
+                artifact_class=dsl.Artifact,
+                reimport=False,
+                metadata={'category': 'unrelaxed_protein'}
+            ).set_display_name('Import unrelaxed protein')
+
+            _relax_prediction(
+                project, region, unrelaxed_protein.output,
+                max_relax_violations)
+
 
 @dsl.pipeline(
     name='alphafold-multimer-optimized',
@@ -134,23 +209,52 @@ def alphafold_multimer_pipeline(
     mgnify_max_hits: int = config.MGNIFY_MAX_HITS,
     uniprot_max_hits: int = config.UNIPROT_MAX_HITS,
     is_run_relax: str = 'relax',
+    relax_policy: str = 'all',
+    relax_top_k: int = 1,
+    max_relax_violations: int = config.MAX_RELAX_VIOLATIONS,
+    adaptive_sampling: str = 'false',
+    plateau_tolerance: float = 0.01,
+    max_predictions: int = 0,
+    pad_to_buckets: bool = False,
+    use_prediction_cache: str = 'true',
+    max_recycles: int = config.MAX_RECYCLES,
+    recycle_early_stop_tolerance: float = config.RECYCLE_EARLY_STOP_TOLERANCE,
+    output_policy: str = 'full',
+    half_precision_outputs: bool = False,
+    run_memory_planner: str = 'false',
+    batch_relax: str = 'false',
+    prediction_worker_address: str = config.PREDICTION_WORKER_ADDRESS,
     num_multimer_predictions_per_model: int = 5,
     use_small_bfd: str = 'true',
     skip_msa: str = 'false',
-    model_names: list = None
+    model_names: list = None,
+    batch_template_search: str = 'false',
 ):
     """Multimer-optimized Alphafold Inference Pipeline."""
 
     from kfp.v2 import dsl
     from kfp.v2.dsl import Artifact, importer
 
-    # Configure the run
-    run_config = ConfigureRunOp(
+    # Configure the run, create the unique run ID and find the chains with
+    # precomputed features in a single task
+    run_config = SetupRunOp(
         sequence_path=sequence_path,
-        model_preset='multimer',
+        project=project,
+        use_small_bfd=use_small_bfd,
+        skip_msa=skip_msa,
+        max_template_date=max_template_date,
+        uniref_max_hits=uniref_max_hits,
+        mgnify_max_hits=mgnify_max_hits,
+        uniprot_max_hits=uniprot_max_hits,
         num_multimer_predictions_per_model=num_multimer_predictions_per_model,
-        model_names=model_names
-    ).set_display_name('Configure Multimer Pipeline Run')
+        batch_template_search=batch_template_search,
+        model_names=model_names,
+    ).set_display_name('Set up Multimer Pipeline Run')
+
+    relax_mode = PlanRelaxOp(
+        is_run_relax=is_run_relax,
+        relax_policy=relax_policy,
+    ).set_display_name('Plan relaxation')
 
     model_parameters = dsl.importer(
         artifact_uri=config.MODEL_PARAMS_GCS_LOCATION,
@@ -176,37 +280,18 @@ def alphafold_multimer_pipeline(
         }
     ).set_display_name('Reference databases')
 
-    # Create the features directory first without sequence dependency
-    per_chain_features_dir = CreateRunIdOp(
-        sequence_path=sequence_path,
-        use_small_bfd=use_small_bfd,
-        skip_msa=skip_msa,
-        max_template_date=max_template_date,
-        uniref_max_hits=uniref_max_hits,
-        mgnify_max_hits=mgnify_max_hits,
-        uniprot_max_hits=uniprot_max_hits,
-        project=project
-    ).set_display_name('Create unique run ID')
-
     chain_feature_ops = []
 
-    # Create a component to filter chains based on precomputed features
-    filter_chains = FilterChainsOp(
-        chain_info_list=run_config.outputs['chain_info_list'],
-        msa_path_info=per_chain_features_dir.output,
-        project=project
-    ).set_display_name('Filter chains')
-
     # Process chains without precomputed features
     with dsl.ParallelFor(
-        items=filter_chains.outputs['chains_to_process'],
+        items=run_config.outputs['chains_to_process'],
         parallelism=config.PARALLELISM
     ) as item:
         chain_id = item.chain_id
         sequence_path_for_chain = item.sequence_path
         description = item.description
 
-        raw_artifact = dsl.importer(
+        sequence_artifact = dsl.importer(
             artifact_uri=sequence_path_for_chain,
             artifact_class=dsl.Artifact,
             metadata={
@@ -217,8 +302,6 @@ def alphafold_multimer_pipeline(
             reimport=True,
         ).set_display_name(f"Import sequence artifact for chain {chain_id}")
 
-        sequence_artifact = DownloadSequenceOp(sequence=raw_artifact.output)
-
         # If skip_msa is false, run MSA searches and template search
         with dsl.Condition(skip_msa == 'false'):
             uniref_msa = JackhmmerOp(
@@ -228,6 +311,11 @@ def alphafold_multimer_pipeline(
                 ref_databases=reference_databases.output,
                 sequence=sequence_artifact.output,
                 maxseq=uniref_max_hits,
+                num_shards=config.UNIREF90_NUM_SHARDS,
+                prefilter_max_candidates=config.UNIREF90_PREFILTER_MAX_CANDIDATES,
+                staging_dir=config.DATABASE_STAGING_DIR,
+                staging_max_gb=config.DATABASE_STAGING_MAX_GB,
+                warm_page_cache=config.DATABASE_STAGING_WARM_PAGE_CACHE,
             ).set_display_name('Search Uniref')
 
             mgnify_msa = JackhmmerOp(
@@ -237,6 +325,9 @@ def alphafold_multimer_pipeline(
                 ref_databases=reference_databases.output,
                 sequence=sequence_artifact.output,
                 maxseq=mgnify_max_hits,
+                staging_dir=config.DATABASE_STAGING_DIR,
+                staging_max_gb=config.DATABASE_STAGING_MAX_GB,
+                warm_page_cache=config.DATABASE_STAGING_WARM_PAGE_CACHE,
             ).set_display_name('Search Mgnify')
 
             bfd_msa = BFDSearchOp(
@@ -245,19 +336,37 @@ def alphafold_multimer_pipeline(
                 sequence=sequence_artifact.output,
                 ref_databases=reference_databases.output,
                 use_small_bfd=use_small_bfd,
+                staging_dir=config.DATABASE_STAGING_DIR,
+                staging_max_gb=config.DATABASE_STAGING_MAX_GB,
+                warm_page_cache=config.DATABASE_STAGING_WARM_PAGE_CACHE,
             ).set_display_name('Search BFD')
 
-            search_pdb = HHsearchOp(
-                project=project,
-                location=region,
-                template_db='pdb_seqres',
-                mmcif_db='pdb_mmcif',
-                obsolete_db='pdb_obsolete',
-                max_template_date=max_template_date,
-                ref_databases=reference_databases.output,
-                sequence=sequence_artifact.output,
-                msa=uniref_msa.outputs['msa'],
-            ).set_display_name('Search PDB')
+            # PDB search, batched across the chains after the loop if
+            # batch_template_search is set
+            with dsl.If(batch_template_search == 'false'):
+                search_pdb = HHsearchOp(
+                    project=project,
+                    location=region,
+                    template_db='pdb_seqres',
+                    mmcif_db='pdb_mmcif',
+                    obsolete_db='pdb_obsolete',
+                    max_template_date=max_template_date,
+                    ref_databases=reference_databases.output,
+                    sequence=sequence_artifact.output,
+                    msa=uniref_msa.outputs['msa'],
+                    staging_dir=config.DATABASE_STAGING_DIR,
+                    staging_max_gb=config.DATABASE_STAGING_MAX_GB,
+                    warm_page_cache=config.DATABASE_STAGING_WARM_PAGE_CACHE,
+                    search_daemon_address=config.SEARCH_DAEMON_ADDRESS,
+                    featurization_workers=config.TEMPLATE_FEATURIZATION_WORKERS,
+                ).set_display_name('Search PDB')
+
+            with dsl.Else():
+                deferred_template = no_op_artifact_output()
+
+            template_features = dsl.OneOf(
+                search_pdb.outputs['template_features'],
+                deferred_template.output)
 
             aggregate_features = AggregateOp(
                 project=project,
@@ -267,13 +376,16 @@ def alphafold_multimer_pipeline(
                 msa1=uniref_msa.outputs['msa'],
                 msa2=mgnify_msa.outputs['msa'],
                 msa3=bfd_msa.outputs['msa'],
-                template_features=search_pdb.outputs['template_features'],
+                template_features=template_features,
                 chain_id=chain_id,
-                per_chain_features_dir=per_chain_features_dir.output,
+                per_chain_features_dir=run_config.outputs['per_chain_features_dir'],
                 is_homomer=run_config.outputs['is_homomer_or_monomer'],
                 maxseq=uniprot_max_hits,
-                skip_msa=skip_msa
-            ).after(search_pdb, per_chain_features_dir).set_display_name(f"Aggregate features chain {chain_id} (with MSA)")
+                uniprot_num_shards=config.UNIPROT_NUM_SHARDS,
+                uniprot_prefilter_max_candidates=config.UNIPROT_PREFILTER_MAX_CANDIDATES,
+                skip_msa=skip_msa,
+                defer_templates=batch_template_search,
+            ).set_display_name(f"Aggregate features chain {chain_id} (with MSA)")
 
             chain_feature_ops.append(aggregate_features)
 
@@ -292,49 +404,212 @@ def alphafold_multimer_pipeline(
                 msa3=no_msa_art.output,
                 template_features=no_template.output,
                 chain_id=chain_id,
-                per_chain_features_dir=per_chain_features_dir.output,
+                per_chain_features_dir=run_config.outputs['per_chain_features_dir'],
                 is_homomer=run_config.outputs['is_homomer_or_monomer'],
                 maxseq=uniprot_max_hits,
                 skip_msa=skip_msa
-            ).after(per_chain_features_dir).set_display_name(f"Aggregate features chain {chain_id} (no MSA)")
+            ).set_display_name(f"Aggregate features chain {chain_id} (no MSA)")
 
             chain_feature_ops.append(aggregate_features_no_msa)
 
-    # Aggregate features across chains
-    aggregate_features_across_chains = AggregateFeaturesAcrossChainsOp(
-        per_chain_features_dir=per_chain_features_dir.output,
-        sequences=run_config.outputs['sequence'],
-        is_homomer_or_monomer=run_config.outputs['is_homomer_or_monomer'],
-        output_features_path=per_chain_features_dir.output,
-    ).after(per_chain_features_dir).after(*chain_feature_ops)
+    # Search the templates of all chains in one pass over pdb_seqres before
+    # aggregating the features across chains
+    with dsl.If(run_config.outputs['defer_templates'] == 'true'):
+        batch_search_pdb = BatchHmmsearchOp(
+            project=project,
+            location=region,
+            chains=dsl.Collected(aggregate_features.outputs['Output']),
+            template_db='pdb_seqres',
+            mmcif_db='pdb_mmcif',
+            obsolete_db='pdb_obsolete',
+            max_template_date=max_template_date,
+            ref_databases=reference_databases.output,
+            staging_dir=config.DATABASE_STAGING_DIR,
+            staging_max_gb=config.DATABASE_STAGING_MAX_GB,
+            warm_page_cache=config.DATABASE_STAGING_WARM_PAGE_CACHE,
+            search_daemon_address=config.SEARCH_DAEMON_ADDRESS,
+            featurization_workers=config.TEMPLATE_FEATURIZATION_WORKERS,
+        ).set_display_name('Search PDB for all chains')
 
-    # Second ParallelFor loop for model predictions
-    with dsl.ParallelFor(
-        items=run_config.outputs['model_runners'],
-        parallelism=config.PARALLELISM
-    ) as model_runner:
+        batch_aggregate_features_across_chains = AggregateFeaturesAcrossChainsOp(
+            per_chain_features_dir=run_config.outputs['per_chain_features_dir'],
+            sequences=run_config.outputs['sequence'],
+            is_homomer_or_monomer=run_config.outputs['is_homomer_or_monomer'],
+            output_features_path=run_config.outputs['per_chain_features_dir'],
+        ).after(batch_search_pdb)
+
+    with dsl.Else():
+        aggregate_features_across_chains = AggregateFeaturesAcrossChainsOp(
+            per_chain_features_dir=run_config.outputs['per_chain_features_dir'],
+            sequences=run_config.outputs['sequence'],
+            is_homomer_or_monomer=run_config.outputs['is_homomer_or_monomer'],
+            output_features_path=run_config.outputs['per_chain_features_dir'],
+        ).after(*chain_feature_ops)
+
+    model_features = dsl.OneOf(
+        batch_aggregate_features_across_chains.outputs['features'],
+        aggregate_features_across_chains.outputs['features'])
+
+    # Plan the accelerator memory of the predictions from the feature shapes
+    with dsl.If(run_memory_planner == 'true'):
+        planned_memory = PlanMemoryOp(
+            model_features=model_features,
+            model_runners=run_config.outputs['model_runners'],
+            run_multimer_system=True,
+            accelerator_type=config.PREDICT_PERSISTENT_ACCELERATOR_TYPE,
+            accelerator_memory_gb=float(config.ACCELERATOR_MEMORY_GB.get(
+                config.PREDICT_PERSISTENT_ACCELERATOR_TYPE,
+                config.DEFAULT_ACCELERATOR_MEMORY_GB)),
+            machine_tiers=config.MEMORY_PLANNER_MACHINE_TIERS,
+        ).set_display_name('Plan memory')
+    with dsl.Else():
+        default_memory = DefaultMemoryPlanOp(
+            tf_force_unified_memory=config.TF_FORCE_UNIFIED_MEMORY,
+            xla_python_client_mem_fraction=config.XLA_PYTHON_CLIENT_MEM_FRACTION,
+        ).set_display_name('Default memory settings')
+
+    tf_force_unified_memory = dsl.OneOf(
+        planned_memory.outputs['tf_force_unified_memory'],
+        default_memory.outputs['tf_force_unified_memory'])
+    xla_python_client_mem_fraction = dsl.OneOf(
+        planned_memory.outputs['xla_python_client_mem_fraction'],
+        default_memory.outputs['xla_python_client_mem_fraction'])
+    subbatch_size = dsl.OneOf(
+        planned_memory.outputs['subbatch_size'],
+        default_memory.outputs['subbatch_size'])
+
+    def predict_and_relax(model_runner, **predict_options):
+        """Runs a prediction, and relaxes it in relax mode 'all'."""
         model_predict = JobPredictOp(
             project=project,
             location=region,
-            model_features=aggregate_features_across_chains.outputs['features'],
+            model_features=model_features,
             model_params=model_parameters.output,
             model_name=model_runner.model_name,
             prediction_index=model_runner.prediction_index,
             run_multimer_system=run_config.outputs['run_multimer_system'],
             num_ensemble=run_config.outputs['num_ensemble'],
             random_seed=model_runner.random_seed,
-            tf_force_unified_memory=config.TF_FORCE_UNIFIED_MEMORY,
-            xla_python_client_mem_fraction=config.XLA_PYTHON_CLIENT_MEM_FRACTION
-        )
-        model_predict.set_display_name('Predict')
+            tf_force_unified_memory=tf_force_unified_memory,
+            xla_python_client_mem_fraction=xla_python_client_mem_fraction,
+            subbatch_size=subbatch_size,
+            pad_to_buckets=pad_to_buckets,
+            residue_buckets=config.PADDING_RESIDUE_BUCKETS,
+            msa_buckets=config.PADDING_MSA_BUCKETS,
+            use_prediction_cache=use_prediction_cache,
+            prediction_cache_bucket=project,
+            max_recycles=max_recycles,
+            recycle_early_stop_tolerance=recycle_early_stop_tolerance,
+            output_policy=output_policy,
+            output_names=config.SLIM_PREDICTION_OUTPUTS,
+            half_precision=half_precision_outputs,
+            **predict_options
+        ).set_display_name('Predict')
 
-        with dsl.Condition(is_run_relax == 'relax'):
-            relax_protein = JobRelaxOp(
-                project=project,
-                location=region,
-                unrelaxed_protein=model_predict.outputs['unrelaxed_protein'],
-                use_gpu=True,
-                tf_force_unified_memory=config.TF_FORCE_UNIFIED_MEMORY,
-                xla_python_client_mem_fraction=config.XLA_PYTHON_CLIENT_MEM_FRACTION
-            )
-            relax_protein.set_display_name('Relax protein')
\ No newline at end of file
+        with dsl.Condition(relax_mode.output == 'all'):
+            _relax_prediction(
+                project, region, model_predict.outputs['unrelaxed_protein'],
+                max_relax_violations)
+        return model_predict
+
+    # Second ParallelFor loop for model predictions
+    with dsl.Condition(adaptive_sampling == 'false'):
+        with dsl.Condition(prediction_worker_address == ''):
+            with dsl.ParallelFor(
+                items=run_config.outputs['model_runners'],
+                parallelism=config.PARALLELISM
+            ) as model_runner:
+                model_predict = predict_and_relax(model_runner)
+
+            # Relax only the best ranked predictions once all predictions are done
+            with dsl.Condition(relax_mode.output == 'selected'):
+                relax_targets = SelectRelaxTargetsOp(
+                    predictions=dsl.Collected(model_predict.outputs['Output']),
+                    relax_policy=relax_policy,
+                    relax_top_k=relax_top_k,
+                ).set_display_name('Select predictions to relax')
+
+                _relax_targets(
+                    project, region, relax_targets, batch_relax, max_relax_violations)
+
+        # Submit the predictions to the warm prediction worker
+        with dsl.Condition(prediction_worker_address != ''):
+            with dsl.ParallelFor(
+                items=run_config.outputs['model_runners'],
+                parallelism=config.PARALLELISM
+            ) as model_runner:
+                model_predict = JobPredictViaWorkerOp(
+                    project=project,
+                    location=region,
+                    model_features=model_features,
+                    model_name=model_runner.model_name,
+                    prediction_index=model_runner.prediction_index,
+                    run_multimer_system=run_config.outputs['run_multimer_system'],
+                    num_ensemble=run_config.outputs['num_ensemble'],
+                    random_seed=model_runner.random_seed,
+                    pad_to_buckets=pad_to_buckets,
+                    residue_buckets=config.PADDING_RESIDUE_BUCKETS,
+                    msa_buckets=config.PADDING_MSA_BUCKETS,
+                    use_prediction_cache=use_prediction_cache,
+                    prediction_cache_bucket=project,
+                    max_recycles=max_recycles,
+                    recycle_early_stop_tolerance=recycle_early_stop_tolerance,
+                    output_policy=output_policy,
+                    output_names=config.SLIM_PREDICTION_OUTPUTS,
+                    half_precision=half_precision_outputs,
+                    subbatch_size=subbatch_size,
+                    prediction_worker_address=prediction_worker_address,
+                    timeout=config.PREDICTION_WORKER_TIMEOUT
+                )
+                model_predict.set_display_name('Predict (worker)')
+
+                with dsl.Condition(relax_mode.output == 'all'):
+                    _relax_prediction(
+                        project, region, model_predict.outputs['unrelaxed_protein'],
+                        max_relax_violations)
+
+            # Relax only the best ranked predictions once all predictions are done
+            with dsl.Condition(relax_mode.output == 'selected'):
+                relax_targets = SelectRelaxTargetsOp(
+                    predictions=dsl.Collected(model_predict.outputs['Output']),
+                    relax_policy=relax_policy,
+                    relax_top_k=relax_top_k,
+                ).set_display_name('Select predictions to relax')
+
+                _relax_targets(
+                    project, region, relax_targets, batch_relax, max_relax_violations)
+
+    # Adaptive sampling launches one seed per model at a time and stops
+    # launching seeds once the top ranking confidence has plateaued
+    with dsl.Condition(adaptive_sampling == 'true'):
+        with dsl.ParallelFor(
+            items=run_config.outputs['sampling_waves'],
+            parallelism=1
+        ) as sampling_wave:
+            wave_runners = PlanSamplingWaveOp(
+                wave_index=sampling_wave.wave_index,
+                model_runners=sampling_wave.model_runners,
+                sampling_bucket=project,
+                sampling_run_id=dsl.PIPELINE_JOB_ID_PLACEHOLDER,
+                plateau_tolerance=plateau_tolerance,
+                max_predictions=max_predictions,
+            ).set_display_name('Plan sampling wave')
+
+            with dsl.ParallelFor(
+                items=wave_runners.output,
+                parallelism=config.PARALLELISM
+            ) as model_runner:
+                model_predict = predict_and_relax(
+                    model_runner,
+                    sampling_log_path=model_runner.sampling_log_path)
+
+        # Relax only the best ranked predictions of all waves
+        with dsl.Condition(relax_mode.output == 'selected'):
+            relax_targets = SelectSampledRelaxTargetsOp(
+                sampling_waves=dsl.Collected(wave_runners.output),
+                relax_policy=relax_policy,
+                relax_top_k=relax_top_k,
+            ).set_display_name('Select predictions to relax')
+
+            _relax_targets(
+                project, region, relax_targets, batch_relax, max_relax_violations)
@@ -14,8 +14,14 @@
 
 """A utility to compile AlphaFold inference pipelines."""
 
+import functools
+import hashlib
 import importlib
+import json
 import os
+import tempfile
+import threading
+from typing import Dict, Mapping
 
 from absl import flags
 from absl import app
@@ -65,6 +71,75 @@ def _get_fun_by_name(fun_string: str):
     return func, fun_name
 
 
+_SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Compiled pipeline templates by key, see pipeline_template
+_templates: Dict[str, str] = {}
+_templates_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def _sources_digest() -> str:
+    """Returns the digest of the sources the pipelines are compiled from."""
+    digest = hashlib.sha256()
+    for package in ('components', 'pipelines'):
+        package_dir = os.path.join(_SRC_DIR, package)
+        for file_name in sorted(os.listdir(package_dir)):
+            if file_name.endswith('.py'):
+                with open(os.path.join(package_dir, file_name), 'rb') as f:
+                    digest.update(file_name.encode() + f.read())
+    with open(os.path.join(_SRC_DIR, 'config.py'), 'rb') as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def pipeline_template(
+    pipeline_builder: str,
+    config_values: Mapping[str, str],
+    cache_dir: str,
+) -> str:
+    """Returns the path to the template of a pipeline compiled with a config.
+
+    pipeline_builder names the function building the pipeline from a config,
+    like pipelines.alphafold_inference_pipeline.build_pipeline, and
+    config_values are the settings of the config in place of the environment
+    variables config.py reads (see config.load). A template is compiled once
+    for every pipeline, config_values and sources of the pipelines, and kept
+    in cache_dir, where processes sharing the directory reuse it. Run
+    parameters are passed to the template as parameter values when the
+    pipeline job is created.
+    """
+    sources_digest = _sources_digest()
+    key = hashlib.sha256(json.dumps(
+        [pipeline_builder, sorted(config_values.items()), sources_digest]
+    ).encode()).hexdigest()[:16]
+
+    with _templates_lock:
+        if key in _templates:
+            return _templates[key]
+        module_name = pipeline_builder.rsplit('.', 2)[-2]
+        template_path = os.path.join(cache_dir, f'{module_name}-{key}.json')
+        if not os.path.exists(template_path):
+            logging.info(f'Compiling {pipeline_builder} to {template_path}')
+            build_pipeline, _ = _get_fun_by_name(pipeline_builder)
+            pipeline_func = build_pipeline(
+                importlib.import_module('config').load(config_values))
+            os.makedirs(cache_dir, exist_ok=True)
+            # Compile next to the template and rename, so that processes
+            # sharing cache_dir never read a partial template
+            fd, compile_path = tempfile.mkstemp(suffix='.json', dir=cache_dir)
+            os.close(fd)
+            try:
+                compiler.Compiler().compile(
+                    pipeline_func=pipeline_func, package_path=compile_path)
+                os.replace(compile_path, template_path)
+            finally:
+                if os.path.exists(compile_path):
+                    os.remove(compile_path)
+        _templates[key] = template_path
+        return template_path
+
+
 def get_filestore_info(project_id: str, instance_id: str, location: str):
     """Returns the IP address and the full network name of a given Filestore"""
     client = resourcemanager_v3.ProjectsClient()
@@ -0,0 +1,465 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A utility to estimate the runtime and node-hours of pipeline runs.
+
+The wall time of every task of past runs is collected, from the task details
+of their pipeline jobs or from a local JSONL log, together with the number of
+residues and chains of the run and the MSA depth recorded in the metadata of
+the task's artifacts. A log-linear runtime model is fitted for each stage
+(task) of a pipeline, from which the durations of the stages of a new run,
+its critical path and its node-hours are estimated before it is submitted:
+
+python -m utils.estimate_utils collect --project_id=<PROJECT_ID> \
+    --region=<REGION> --timings_path=timings.jsonl
+python -m utils.estimate_utils estimate --timings_path=timings.jsonl \
+    --pipeline=alphafold-inference-pipeline --sequence_path=T1050.fasta \
+    --params=model_preset=monomer,is_run_relax=relax
+
+Stages run in the order of PHASES. Stages of a phase run concurrently, those
+of `chain` scope once for every unique chain, those of `prediction` scope
+once for every prediction and those of `relax` scope once for every relaxed
+prediction, parallelism tasks at a time.
+"""
+
+import json
+import math
+import re
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence
+
+import numpy as np
+from Bio import SeqIO
+
+
+# The stages of the pipelines by phase, with the scope of each stage
+PHASES = [
+    {'configure-run': 'run', 'configure-run-multimer': 'run',
+     'setup-multimer-run': 'run', 'create-run-id': 'run'},
+    {'data-pipeline': 'run', 'jackhmmer': 'chain', 'hhblits': 'chain',
+     'bfd-search': 'chain', 'colocated-msa-search': 'chain'},
+    # The template searches take the uniref90 MSA of their chain
+    {'hhsearch': 'chain', 'hmmsearch': 'chain'},
+    {'aggregate-features': 'run', 'aggregate-features-multimer': 'chain'},
+    {'batch-hmmsearch': 'run'},
+    {'aggregate-features-across-chains': 'run'},
+    {'plan-memory': 'run'},
+    {'predict': 'prediction', 'predict-via-worker': 'prediction',
+     'predict-relax': 'run'},
+    {'select-relax-targets': 'run', 'select-sampled-relax-targets': 'run'},
+    {'relax': 'relax', 'relax-batch': 'run'},
+]
+STAGE_SCOPES = {
+    stage: scope for phase in PHASES for stage, scope in phase.items()}
+
+NUM_MODELS = 5
+DEFAULT_PARALLELISM = 20
+
+_TASK_SUFFIX = re.compile(r'-\d+$')
+
+
+def _base_stage(task_name: str) -> str:
+    return _TASK_SUFFIX.sub('', task_name)
+
+
+def stage_name(task_name: str) -> Optional[str]:
+    """Returns the stage of a task, None for tasks that are not estimated.
+
+    Tasks of the same component in a chain or a run, like the uniref90 and
+    mgnify jackhmmer searches, are stages of their own. The tasks of the
+    prediction and relax loops of the conditional branches of a pipeline are
+    a single stage.
+    """
+    base = _base_stage(task_name)
+    scope = STAGE_SCOPES.get(base)
+    if scope is None:
+        return None
+    return base if scope in ('prediction', 'relax') else task_name
+
+
+def _artifact_metadata(artifact_lists) -> List[Mapping[str, Any]]:
+    return [artifact.metadata
+            for artifact_list in artifact_lists.values()
+            for artifact in artifact_list.artifacts]
+
+
+def _msa_depth(metadata: Sequence[Mapping[str, Any]]) -> Optional[int]:
+    for key in ('final_dedup_msa_size', 'num_sequences'):
+        depths = [m[key] for m in metadata if key in m]
+        if depths:
+            return int(max(depths))
+    return None
+
+
+def pipeline_job_timings(pipeline_job) -> List[Dict[str, Any]]:
+    """Returns the timings of the succeeded tasks of a pipeline job.
+
+    pipeline_job is the PipelineJob returned by the Vertex AI pipeline
+    service. The residues of a run are those recorded in the metadata of its
+    sequence artifact. Stages of chain scope are given the mean number of
+    residues of the chains of the run.
+    """
+    pipeline = pipeline_job.pipeline_spec['pipelineInfo']['name']
+    tasks = pipeline_job.job_detail.task_details
+
+    num_residues = None
+    for task in tasks:
+        for metadata in _artifact_metadata(task.outputs):
+            if 'num_residues' in metadata:
+                num_residues = [int(n) for n in metadata['num_residues']]
+    if not num_residues:
+        return []
+
+    timings = []
+    for task in tasks:
+        stage = stage_name(task.task_name)
+        if (stage is None or task.state.name != 'SUCCEEDED'
+                or not task.start_time or not task.end_time):
+            continue
+        chain_scope = STAGE_SCOPES[_base_stage(stage)] == 'chain'
+        timings.append({
+            'pipeline_job': pipeline_job.name,
+            'pipeline': pipeline,
+            'stage': stage,
+            'wall_time': round(
+                (task.end_time - task.start_time).total_seconds(), 3),
+            'num_residues': (
+                round(sum(num_residues) / len(num_residues)) if chain_scope
+                else sum(num_residues)),
+            'num_chains': len(num_residues),
+            'msa_depth': _msa_depth(
+                _artifact_metadata(task.inputs)
+                + _artifact_metadata(task.outputs)),
+        })
+    return timings
+
+
+def collect_timings(
+    project_id: str,
+    region: str,
+    skip_pipeline_jobs: Iterable[str] = (),
+    max_pipeline_jobs: int = 100,
+) -> List[Dict[str, Any]]:
+    """Returns the timings of the last succeeded pipeline jobs of a project.
+
+    Pipeline jobs in skip_pipeline_jobs, like those already in a log, are
+    not fetched.
+    """
+    from google.cloud import aiplatform_v1 as vertex_ai2
+
+    client = vertex_ai2.PipelineServiceClient(client_options={
+        'api_endpoint': f'{region}-aiplatform.googleapis.com'})
+    request = vertex_ai2.ListPipelineJobsRequest(
+        parent=f'projects/{project_id}/locations/{region}',
+        filter='state="PIPELINE_STATE_SUCCEEDED"',
+        order_by='end_time desc')
+    skip_pipeline_jobs = set(skip_pipeline_jobs)
+
+    timings = []
+    for i, listed_job in enumerate(client.list_pipeline_jobs(request)):
+        if i >= max_pipeline_jobs:
+            break
+        if listed_job.name in skip_pipeline_jobs:
+            continue
+        pipeline_job = client.get_pipeline_job(name=listed_job.name)
+        timings.extend(pipeline_job_timings(pipeline_job))
+    return timings
+
+
+def read_timings(timings_path: str) -> List[Dict[str, Any]]:
+    """Reads a JSONL log of task timings."""
+    with open(timings_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_timings(timings_path: str, timings: Iterable[Mapping[str, Any]]):
+    """Appends task timings to a JSONL log."""
+    with open(timings_path, 'a') as f:
+        for timing in timings:
+            f.write(json.dumps(timing) + '\n')
+
+
+class StageModel:
+    """A log-linear model of the wall time of a stage.
+
+    log(wall_time) is fitted by least squares to log(num_residues) and, when
+    it varies among the timings, log(msa_depth). With fewer timings than
+    coefficients the model predicts their median wall time.
+    """
+
+    def __init__(self, timings: Sequence[Mapping[str, Any]]):
+        wall_times = np.array([t['wall_time'] for t in timings], dtype=float)
+        self.num_timings = len(timings)
+        self.median_wall_time = float(np.median(wall_times))
+        depths = [t['msa_depth'] for t in timings if t.get('msa_depth')]
+        self.median_msa_depth = float(np.median(depths)) if depths else None
+        self.use_msa_depth = (
+            len(depths) == len(timings) and len(set(depths)) > 1)
+
+        self.coefficients = None
+        features = [self._features(t['num_residues'], t.get('msa_depth'))
+                    for t in timings]
+        if len({tuple(f) for f in features}) > len(features[0]):
+            self.coefficients, *_ = np.linalg.lstsq(
+                np.array(features), np.log(np.maximum(wall_times, 1e-3)),
+                rcond=None)
+
+    def _features(self, num_residues: int, msa_depth: Optional[float]):
+        features = [1., math.log(max(num_residues, 1))]
+        if self.use_msa_depth:
+            features.append(math.log(max(msa_depth, 1)))
+        return features
+
+    def predict(self, num_residues: int, msa_depth: Optional[float] = None):
+        """Returns the estimated wall time in seconds."""
+        if self.coefficients is None:
+            return self.median_wall_time
+        features = self._features(
+            num_residues, msa_depth or self.median_msa_depth)
+        return float(math.exp(np.dot(self.coefficients, features)))
+
+
+def _enabled(
+    stage: str,
+    params: Mapping[str, Any],
+    chain_residues: Optional[int] = None,
+) -> bool:
+    """Returns whether the conditions of a pipeline run a stage."""
+    base = _base_stage(stage)
+    run_relax = (params.get('is_run_relax', 'relax') == 'relax'
+                 and params.get('relax_policy', 'all') != 'none')
+    relax_policy = params.get('relax_policy', 'all')
+    batch_relax = (str(params.get('batch_relax', 'false')).lower() == 'true'
+                   and relax_policy != 'all')
+    batch_templates = str(
+        params.get('batch_template_search', 'false')).lower() == 'true'
+    colocated = chain_residues is not None and chain_residues <= int(
+        params.get('colocated_search_max_residues', 0))
+
+    if base == 'relax':
+        return run_relax and not batch_relax
+    if base == 'relax-batch':
+        return run_relax and batch_relax
+    if base in ('select-relax-targets', 'select-sampled-relax-targets'):
+        return run_relax and relax_policy != 'all'
+    if base in ('hhsearch', 'hmmsearch'):
+        return not batch_templates
+    if base == 'batch-hmmsearch':
+        return batch_templates
+    if base == 'colocated-msa-search':
+        return colocated
+    if base in ('jackhmmer', 'hhblits', 'bfd-search'):
+        return chain_residues is None or not colocated
+    return True
+
+
+def _num_relaxed(params: Mapping[str, Any], num_predictions: int) -> int:
+    if params.get('is_run_relax', 'relax') != 'relax':
+        return 0
+    relax_policy = params.get('relax_policy', 'all')
+    if relax_policy == 'all':
+        return num_predictions
+    if relax_policy == 'best':
+        return 1
+    if relax_policy == 'top_k':
+        return min(int(params.get('relax_top_k', 1)), num_predictions)
+    return 0
+
+
+class RuntimeEstimator:
+    """Estimates the runtime of the runs of a pipeline from past timings."""
+
+    def __init__(
+        self,
+        timings: Iterable[Mapping[str, Any]],
+        pipeline: str,
+        parallelism: int = DEFAULT_PARALLELISM,
+    ):
+        self.pipeline = pipeline
+        self.parallelism = parallelism
+        stage_timings = {}
+        for timing in timings:
+            if (timing['pipeline'] == pipeline
+                    and stage_name(timing['stage']) == timing['stage']):
+                stage_timings.setdefault(timing['stage'], []).append(timing)
+        self.models = {
+            stage: StageModel(stage_timings[stage])
+            for stage in sorted(stage_timings)}
+
+    def _phase_stages(self, phase: Mapping[str, str]) -> List[str]:
+        return [stage for stage in self.models if _base_stage(stage) in phase]
+
+    def estimate(
+        self,
+        fasta: str,
+        params: Mapping[str, Any],
+    ) -> Dict[str, Any]:
+        """Estimates the runtime and node-hours of a run.
+
+        fasta is the path to the FASTA file of the run and params are its
+        pipeline parameters. A `msa_depth` param overrides the median MSA
+        depth of past runs. Returns the estimated wall time and number of
+        tasks of every stage, the stages on the critical path of the run
+        with its duration in seconds, and the node-hours of the stages and
+        of the run. Stages without past timings are not estimated.
+        """
+        sequences = [str(record.seq)
+                     for record in SeqIO.parse(fasta, 'fasta')]
+        if not sequences or not all(sequences):
+            raise ValueError(f'No valid sequences in {fasta}')
+        num_residues = sum(len(sequence) for sequence in sequences)
+        chain_residues = [len(sequence) for sequence in dict.fromkeys(
+            sequences)]
+        msa_depth = params.get('msa_depth')
+        num_predictions = NUM_MODELS * (
+            int(params.get('num_multimer_predictions_per_model', 5))
+            if params.get('model_preset', 'monomer') == 'multimer' else 1)
+        num_tasks = {'run': 1,
+                     'prediction': num_predictions,
+                     'relax': _num_relaxed(params, num_predictions)}
+
+        stages = {}
+        clock, path = 0., []
+        chain_clocks = [(0., [])] * len(chain_residues)
+        for phase in PHASES:
+            phase_stages = self._phase_stages(phase)
+            if not phase_stages:
+                continue
+            if all(
+                    phase[_base_stage(stage)] == 'chain'
+                    for stage in phase_stages):
+                for i, residues in enumerate(chain_residues):
+                    chain_clock, chain_path = max(
+                        chain_clocks[i], (clock, path), key=lambda c: c[0])
+                    longest = (0., None)
+                    for stage in phase_stages:
+                        if not _enabled(stage, params, residues):
+                            continue
+                        wall_time = self.models[stage].predict(
+                            residues, msa_depth)
+                        stage_estimate = stages.setdefault(
+                            stage, {'wall_time': 0., 'num_tasks': 0,
+                                    'node_hours': 0.})
+                        stage_estimate['wall_time'] = max(
+                            stage_estimate['wall_time'], wall_time)
+                        stage_estimate['num_tasks'] += 1
+                        stage_estimate['node_hours'] += wall_time / 3600
+                        longest = max(longest, (wall_time, stage),
+                                      key=lambda s: s[0])
+                    if longest[1] is not None:
+                        chain_clock += longest[0]
+                        chain_path = chain_path + [longest[1]]
+                    chain_clocks[i] = (chain_clock, chain_path)
+                continue
+
+            clock, path = max(
+                [(clock, path)] + chain_clocks, key=lambda c: c[0])
+            longest = (0., None)
+            for stage in phase_stages:
+                if not _enabled(stage, params):
+                    continue
+                scope = phase[_base_stage(stage)]
+                if scope == 'chain':
+                    # Chain stages of a monomer pipeline search the sequence
+                    scope = 'run'
+                tasks = num_tasks[scope]
+                if not tasks:
+                    continue
+                wall_time = self.models[stage].predict(
+                    num_residues, msa_depth)
+                waves = math.ceil(tasks / self.parallelism)
+                stages[stage] = {
+                    'wall_time': wall_time,
+                    'num_tasks': tasks,
+                    'node_hours': tasks * wall_time / 3600,
+                }
+                longest = max(longest, (waves * wall_time, stage),
+                              key=lambda s: s[0])
+            if longest[1] is not None:
+                clock += longest[0]
+                path = path + [longest[1]]
+        clock, path = max(
+            [(clock, path)] + chain_clocks, key=lambda c: c[0])
+
+        for stage_estimate in stages.values():
+            stage_estimate['wall_time'] = round(stage_estimate['wall_time'], 1)
+            stage_estimate['node_hours'] = round(
+                stage_estimate['node_hours'], 3)
+        return {
+            'pipeline': self.pipeline,
+            'num_residues': num_residues,
+            'num_chains': len(sequences),
+            'stages': stages,
+            'critical_path': path,
+            'duration': round(clock, 1),
+            'node_hours': round(
+                sum(s['node_hours'] for s in stages.values()), 3),
+        }
+
+
+def load_estimator(
+    timings_path: str,
+    pipeline: str,
+    parallelism: int = DEFAULT_PARALLELISM,
+) -> RuntimeEstimator:
+    """Returns an estimator fitted to the timings of a JSONL log."""
+    return RuntimeEstimator(read_timings(timings_path), pipeline, parallelism)
+
+
+if __name__ == '__main__':
+    from absl import app
+    from absl import flags
+    from absl import logging
+
+    # Flags are defined here so run_utils and the backend, which have their
+    # own, can import the estimator
+    flags.DEFINE_string('timings_path', None, 'Path to the JSONL timings log')
+    flags.DEFINE_string('project_id', None, 'GCP project to collect from')
+    flags.DEFINE_string('region', None, 'Vertex Pipelines region')
+    flags.DEFINE_integer('max_pipeline_jobs', 100,
+                         'Number of recent pipeline jobs to collect from')
+    flags.DEFINE_string('pipeline', None, 'Name of the pipeline to estimate')
+    flags.DEFINE_string('sequence_path', None, 'Path to the FASTA file')
+    flags.DEFINE_list('params', [], 'Runtime parameters')
+    flags.DEFINE_integer('parallelism', DEFAULT_PARALLELISM,
+                         'Parallelism of the prediction and relax loops')
+    flags.mark_flag_as_required('timings_path')
+    FLAGS = flags.FLAGS
+
+    def _main(argv):
+        command = argv[1] if len(argv) > 1 else ''
+        if command == 'collect' and FLAGS.project_id and FLAGS.region:
+            try:
+                logged_jobs = {t['pipeline_job']
+                               for t in read_timings(FLAGS.timings_path)}
+            except FileNotFoundError:
+                logged_jobs = set()
+            timings = collect_timings(
+                FLAGS.project_id, FLAGS.region, logged_jobs,
+                FLAGS.max_pipeline_jobs)
+            write_timings(FLAGS.timings_path, timings)
+            logging.info(f'Added {len(timings)} task timings to '
+                         f'{FLAGS.timings_path}')
+        elif command == 'estimate' and FLAGS.pipeline and FLAGS.sequence_path:
+            estimator = load_estimator(
+                FLAGS.timings_path, FLAGS.pipeline, FLAGS.parallelism)
+            params = dict(param.split('=', 1) for param in FLAGS.params)
+            print(json.dumps(
+                estimator.estimate(FLAGS.sequence_path, params), indent=2))
+        else:
+            raise app.UsageError(
+                'Usage: estimate_utils.py collect|estimate; collect needs '
+                '--project_id and --region, estimate needs --pipeline and '
+                '--sequence_path')
+
+    app.run(_main)
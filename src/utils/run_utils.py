@@ -16,6 +16,7 @@
 
 import gcsfs
 import fsspec
+import json
 import os
 
 from absl import flags
@@ -26,6 +27,8 @@ from importlib import import_module
 
 from google.cloud import aiplatform as vertex_ai
 
+from utils import estimate_utils
+
 
 flags.DEFINE_string('project_id', None, 'GCP Project')
 flags.DEFINE_string('region', None, 'Vertex Pipelines region')
@@ -36,6 +39,9 @@ flags.DEFINE_string('pipeline_template_path', None,
 flags.DEFINE_list('params', None, 'Runtime parameters')
 flags.DEFINE_string('experiment_id', None, 'Experiment ID')
 flags.DEFINE_bool('enable_caching', True, 'Enable pipeline level caching')
+flags.DEFINE_string('timings_path', None,
+                    'JSONL log of task timings to estimate the run from, '
+                    'see utils.estimate_utils')
 flags.mark_flag_as_required('project_id')
 flags.mark_flag_as_required('region')
 flags.mark_flag_as_required('staging_bucket')
@@ -76,6 +82,16 @@ def _main(argv):
     if not os.path.exists(FLAGS.pipeline_template_path):
         raise FileNotFoundError('Invalid path to pipeline JSON')
 
+    if FLAGS.timings_path:
+        with open(FLAGS.pipeline_template_path) as f:
+            pipeline_spec = json.load(f)
+        estimator = estimate_utils.load_estimator(
+            FLAGS.timings_path, pipeline_spec['pipelineInfo']['name'])
+        estimate = estimator.estimate(params['sequence_path'], params)
+        logging.info(f'Estimated duration: {estimate["duration"]} s, '
+                     f'node-hours: {estimate["node_hours"]}')
+        logging.info(f'Run estimate: {json.dumps(estimate, indent=2)}')
+
     sequence_file_name = os.path.basename(params['sequence_path'])
     gcs_sequence_path = f'{FLAGS.staging_bucket}/fasta/{sequence_file_name}'
 
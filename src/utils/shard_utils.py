@@ -0,0 +1,403 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A utility to index FASTA databases and split them into balanced shards.
+
+The database is scanned once into an offset index of its sequences, from
+which num_shards shards of near-equal residue counts are cut. The index, the
+shards and a manifest are written to `<database>_shards/`, next to the
+database on the Filestore share, where the sharded jackhmmer search of the
+pipelines looks for them (see alphafold_utils.database_shard_paths).
+
+When the database file changes, only the bytes appended to an unchanged
+prefix are indexed again. The prefix is taken as unchanged when the bytes
+just before its last sequence are, so updates never hash the whole
+database. The shards within the prefix keep their byte ranges, and the
+appended sequences are split into new shards of about the same residue
+count. The manifest records the resulting number of shards, which the
+pipelines read back.
+"""
+
+import hashlib
+import json
+import os
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from absl import flags
+from absl import app
+from absl import logging
+
+
+flags.DEFINE_string('database_path', None,
+                    'Path to the FASTA database on the Filestore share')
+flags.DEFINE_integer('num_shards', None, 'Number of shards to build')
+flags.DEFINE_bool('verify', False,
+                  'Verify the checksums of the shards that are kept')
+flags.mark_flag_as_required('database_path')
+flags.mark_flag_as_required('num_shards')
+FLAGS = flags.FLAGS
+
+INDEX_FILE = 'index.tsv'
+MANIFEST_FILE = 'manifest.json'
+
+_READ_SIZE = 16 << 20
+
+# Bytes before the last indexed sequence whose checksum tells appended
+# databases from changed ones.
+_TAIL_SIZE = 1 << 20
+
+
+def shard_dir(database_path: str) -> str:
+    """Returns the directory of the index and shards of a database."""
+    return f'{database_path}_shards'
+
+
+def shard_name(index: int, num_shards: int) -> str:
+    """Returns the file name of a shard."""
+    return f'{index:05d}-of-{num_shards:05d}.fasta'
+
+
+def _tail_sha256(database_path: str, end: int) -> str:
+    """Returns the SHA-256 digest of the _TAIL_SIZE bytes before end."""
+    return _sha256(database_path, max(0, end - _TAIL_SIZE), end)
+
+
+def _fingerprint(database_path: str) -> Dict[str, int]:
+    stat = os.stat(database_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _sha256(path: str, start: int = 0, end: Optional[int] = None) -> str:
+    """Returns the SHA-256 digest of the bytes [start, end) of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = (end if end is not None else os.path.getsize(path)) - start
+        while remaining > 0:
+            chunk = f.read(min(_READ_SIZE, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def scan_fasta(
+    database_path: str,
+    start: int = 0
+) -> Iterator[Tuple[str, int, int, int]]:
+    """Streams (id, offset, length, num_residues) of the records of a FASTA.
+
+    Scanning starts at byte offset start, which must be the start of a record.
+    """
+    with open(database_path, 'rb') as f:
+        f.seek(start)
+        offset = start
+        record = None
+        for line in f:
+            if line.startswith(b'>'):
+                if record is not None:
+                    yield record[0], record[1], offset - record[1], record[2]
+                record_id = (line[1:].split(maxsplit=1) or [b''])[0].decode()
+                record = [record_id, offset, 0]
+            elif record is not None:
+                record[2] += len(line.strip())
+            offset += len(line)
+        if record is not None:
+            yield record[0], record[1], offset - record[1], record[2]
+
+
+def read_index(index_path: str) -> Iterator[Tuple[str, int, int, int]]:
+    """Streams (id, offset, length, num_residues) of an offset index."""
+    with open(index_path) as f:
+        for line in f:
+            record_id, offset, length, num_residues = line.rstrip(
+                '\n').split('\t')
+            yield record_id, int(offset), int(length), int(num_residues)
+
+
+def _load_manifest(database_path: str) -> Dict[str, Any]:
+    manifest_path = os.path.join(shard_dir(database_path), MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def build_index(
+    database_path: str,
+    previous: Dict[str, Any]
+) -> Tuple[Dict[str, Any], int]:
+    """Writes the offset index of a database, one TSV line per sequence.
+
+    The index of the bytes of the previous index that are unchanged is kept.
+    Returns the index entry of the manifest and the number of unchanged bytes
+    at the start of the database.
+    """
+    index_path = os.path.join(shard_dir(database_path), INDEX_FILE)
+    fingerprint = _fingerprint(database_path)
+
+    if previous and os.path.exists(index_path):
+        if previous['fingerprint'] == fingerprint:
+            logging.info(f'Index of {database_path} is up to date')
+            return previous, fingerprint['size']
+        # Databases are usually updated by appending sequences. The index is
+        # kept up to the last sequence, which may have been extended, if the
+        # bytes before it are unchanged.
+        last_record = previous['last_record']
+        if ('tail_sha256' in previous and
+                fingerprint['size'] >= last_record['offset'] and
+                _tail_sha256(database_path, last_record['offset']) ==
+                previous['tail_sha256']):
+            logging.info(f'Indexing {database_path} from byte '
+                         f'{last_record["offset"]}')
+            with open(index_path, 'r+') as f:
+                f.truncate(previous['index_size'])
+            return _append_index(
+                database_path, index_path, last_record['offset'],
+                previous['num_sequences'] - 1,
+                previous['num_residues'] - last_record['num_residues'],
+                fingerprint), last_record['offset']
+
+    logging.info(f'Indexing {database_path}')
+    open(index_path, 'w').close()
+    return _append_index(database_path, index_path, 0, 0, 0, fingerprint), 0
+
+
+def _append_index(
+    database_path: str,
+    index_path: str,
+    start: int,
+    num_sequences: int,
+    num_residues: int,
+    fingerprint: Dict[str, int]
+) -> Dict[str, Any]:
+    last_record = None
+    index_size = os.path.getsize(index_path)
+    with open(index_path, 'a') as f:
+        for record_id, offset, length, record_residues in scan_fasta(
+                database_path, start):
+            if last_record is not None:
+                index_size += len(line.encode())
+            line = f'{record_id}\t{offset}\t{length}\t{record_residues}\n'
+            f.write(line)
+            last_record = {
+                'offset': offset,
+                'length': length,
+                'num_residues': record_residues,
+            }
+            num_sequences += 1
+            num_residues += record_residues
+
+    if last_record is None:
+        raise ValueError(f'No sequences found in {database_path}')
+
+    return {
+        'fingerprint': fingerprint,
+        'num_sequences': num_sequences,
+        'num_residues': num_residues,
+        'last_record': last_record,
+        # Size of the index without the line of the last sequence
+        'index_size': index_size,
+        'tail_sha256': _tail_sha256(database_path, last_record['offset']),
+    }
+
+
+def plan_shards(
+    records: Iterable[Tuple[str, int, int, int]],
+    num_sequences: int,
+    num_residues: int,
+    num_shards: int
+) -> List[Dict[str, int]]:
+    """Splits the records into num_shards runs of near-equal residue counts.
+
+    Every shard is a contiguous byte range of the database, so it is copied
+    and checked without parsing. The residue counts of the shards differ by
+    at most about the length of the longest sequence.
+    """
+    num_shards = min(num_shards, num_sequences)
+    shards = []
+    shard = None
+    residues = 0
+    for i, (_, offset, length, record_residues) in enumerate(records):
+        if shard is None:
+            shard = {
+                'start': offset,
+                'end': offset,
+                'num_sequences': 0,
+                'num_residues': 0,
+            }
+        shard['end'] = offset + length
+        shard['num_sequences'] += 1
+        shard['num_residues'] += record_residues
+        residues += record_residues
+
+        remaining_shards = num_shards - len(shards) - 1
+        remaining_sequences = num_sequences - i - 1
+        target = num_residues * (len(shards) + 1) / num_shards
+        if remaining_shards and (
+                residues >= target or remaining_sequences == remaining_shards):
+            shards.append(shard)
+            shard = None
+    if shard is not None:
+        shards.append(shard)
+    return shards
+
+
+def _copy_range(src_path: str, dst_path: str, start: int, end: int):
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        src.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = src.read(min(_READ_SIZE, remaining))
+            if not chunk:
+                break
+            dst.write(chunk)
+            remaining -= len(chunk)
+
+
+def _kept_shards(
+    manifest: Dict[str, Any],
+    num_shards: int,
+    unchanged_size: int
+) -> List[Dict[str, Any]]:
+    """Returns the leading shards of a manifest within the unchanged bytes.
+
+    Shards are only kept when the database was split for the same number of
+    shards.
+    """
+    if manifest.get('planned_num_shards') != num_shards:
+        return []
+    kept = []
+    for shard in manifest['shards']:
+        if shard['end'] > unchanged_size:
+            break
+        kept.append(dict(shard))
+    return kept
+
+
+def build_shards(
+    database_path: str,
+    num_shards: int,
+    verify: bool = False
+) -> Dict[str, Any]:
+    """Indexes a database and writes its shards and manifest.
+
+    The shards within the unchanged bytes of the database are kept, after
+    checking their checksums if verify is set, and the sequences after them
+    are split into shards of the residue count of the first split. Shards
+    are named after their number, so kept shards are linked under their new
+    name when shards are added. Returns the manifest.
+    """
+    output_dir = shard_dir(database_path)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = _load_manifest(database_path)
+    index, unchanged_size = build_index(database_path, manifest.get('index'))
+
+    shards = _kept_shards(manifest, num_shards, unchanged_size)
+    for i, shard in enumerate(shards):
+        shard_path = os.path.join(output_dir, shard['name'])
+        if (not os.path.exists(shard_path) or
+                os.path.getsize(shard_path) != shard['end'] - shard['start'] or
+                (verify and _sha256(shard_path) != shard['sha256'])):
+            logging.warning(f'Shard {shard["name"]} changed, splitting the '
+                            f'database again from it')
+            shards = shards[:i]
+            break
+    records = read_index(os.path.join(output_dir, INDEX_FILE))
+    if shards:
+        kept_end = shards[-1]['end']
+        kept_sequences = sum(shard['num_sequences'] for shard in shards)
+        kept_residues = sum(shard['num_residues'] for shard in shards)
+        shard_residues = manifest['shard_residues']
+        new_residues = index['num_residues'] - kept_residues
+        new_sequences = index['num_sequences'] - kept_sequences
+        new_shards = plan_shards(
+            (record for record in records if record[1] >= kept_end),
+            new_sequences, new_residues,
+            max(1, round(new_residues / shard_residues))
+        ) if new_sequences else []
+    else:
+        shard_residues = index['num_residues'] / num_shards
+        new_shards = plan_shards(
+            records, index['num_sequences'], index['num_residues'],
+            num_shards)
+
+    previous_names = {shard['name'] for shard in manifest.get('shards', [])}
+    for i, shard in enumerate(shards):
+        name = shard_name(i, len(shards) + len(new_shards))
+        if name != shard['name']:
+            shard_path = os.path.join(output_dir, name)
+            if os.path.exists(shard_path):
+                os.remove(shard_path)
+            os.link(os.path.join(output_dir, shard['name']), shard_path)
+            shard['name'] = name
+        logging.info(f'Keeping shard {shard["name"]}')
+
+    for i, shard in enumerate(new_shards, len(shards)):
+        shard['name'] = shard_name(i, len(shards) + len(new_shards))
+        shard_path = os.path.join(output_dir, shard['name'])
+        logging.info(f'Writing shard {shard["name"]} '
+                     f'({shard["num_sequences"]} sequences, '
+                     f'{shard["num_residues"]} residues)')
+        tmp_path = f'{shard_path}.tmp'
+        _copy_range(database_path, tmp_path, shard['start'], shard['end'])
+        shard['sha256'] = _sha256(
+            database_path, shard['start'], shard['end'])
+        if _sha256(tmp_path) != shard['sha256']:
+            os.remove(tmp_path)
+            raise IOError(f'Checksum mismatch writing shard {shard_path}')
+        os.replace(tmp_path, shard_path)
+    shards += new_shards
+
+    manifest = {
+        'database_path': database_path,
+        'index': index,
+        'num_sequences': index['num_sequences'],
+        'num_residues': index['num_residues'],
+        'planned_num_shards': num_shards,
+        'shard_residues': shard_residues,
+        'num_shards': len(shards),
+        'shards': shards,
+    }
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    with open(f'{manifest_path}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+
+    # Remove the shards of the previous split once the manifest no longer
+    # lists them
+    shard_names = {shard['name'] for shard in shards}
+    for name in previous_names - shard_names:
+        shard_path = os.path.join(output_dir, name)
+        if os.path.exists(shard_path):
+            os.remove(shard_path)
+
+    return manifest
+
+
+def _main(argv):
+    """Builds the shards of a database"""
+    if not os.path.exists(FLAGS.database_path):
+        raise FileNotFoundError(f'Database not found at {FLAGS.database_path}')
+
+    manifest = build_shards(
+        FLAGS.database_path, FLAGS.num_shards, verify=FLAGS.verify)
+    logging.info(f'Built {manifest["num_shards"]} shards of '
+                 f'{manifest["num_sequences"]} sequences and '
+                 f'{manifest["num_residues"]} residues')
+
+
+if __name__ == "__main__":
+    app.run(_main)
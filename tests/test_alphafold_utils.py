@@ -0,0 +1,184 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of alphafold_utils, run where AlphaFold is installed."""
+
+import json
+import shutil
+
+import jax
+import jax.numpy as jnp
+import ml_collections
+import numpy as np
+import pytest
+
+pytest.importorskip('alphafold')
+
+import alphafold_utils
+
+
+def _prediction_result():
+    return {
+        'plddt': np.linspace(50., 90., 8),
+        'ranking_confidence': np.float64(0.75),
+        'iptm': np.float64(0.7),
+        'ptm': np.float64(0.8),
+        'num_recycles': np.int64(3),
+        'structure_module': {
+            'final_atom_positions': np.zeros((8, 37, 3), np.float32),
+            'final_atom_mask': np.ones((8, 37), np.float32),
+        },
+    }
+
+
+def test_slim_prediction_cache_hit(tmp_path, monkeypatch):
+    cached_prediction_path = tmp_path / 'cached.npz'
+    alphafold_utils.save_prediction_result(
+        _prediction_result(), str(cached_prediction_path), 'slim')
+    features_path = tmp_path / 'features.pkl'
+    features_path.write_bytes(b'features')
+
+    def fetch(self, key, raw_prediction_path, unrelaxed_protein_path):
+        shutil.copyfile(cached_prediction_path, raw_prediction_path)
+        return True
+
+    monkeypatch.setattr(alphafold_utils.PredictionCache, 'fetch', fetch)
+    prediction_result, prediction_metadata = alphafold_utils.predict(
+        model_features_path=str(features_path),
+        model_params_path=str(tmp_path),
+        model_name='model_1_multimer_v3',
+        num_ensemble=1,
+        run_multimer_system=True,
+        random_seed=0,
+        raw_prediction_path=str(tmp_path / 'raw_prediction.npz'),
+        unrelaxed_protein_path=str(tmp_path / 'unrelaxed_protein.pdb'),
+        prediction_cache_dir=str(tmp_path / 'cache'),
+        output_policy='slim')
+
+    assert prediction_metadata['cache_hit']
+    assert isinstance(prediction_result['ranking_confidence'], float)
+    assert prediction_metadata['num_recycles'] == 3
+    json.dumps({'model_1_multimer_v3_pred_0': prediction_result[
+        'ranking_confidence']})
+    json.dumps(prediction_metadata)
+    np.testing.assert_allclose(
+        prediction_result['plddt'], _prediction_result()['plddt'])
+    assert prediction_result['structure_module'][
+        'final_atom_positions'].shape == (8, 37, 3)
+
+
+class _MultimerRunner:
+    """Stands in for a multimer RunModel, with outputs shaped as its own."""
+
+    multimer_mode = True
+
+    def __init__(self):
+        self.config = ml_collections.ConfigDict({'model': {'heads': {
+            'predicted_aligned_error': {'max_error_bin': 31., 'num_bins': 64},
+        }}})
+        self.params = None
+        self.apply = jax.jit(self._forward)
+
+    @staticmethod
+    def _forward(params, key, feat):
+        num_res, num_msa = feat['msa'].shape[1], feat['msa'].shape[0]
+        per_residue = jnp.ones(num_res) * params
+        pair = per_residue[:, None] * per_residue[None, :]
+        pae_probs = jnp.ones((num_res, num_res, 64)) / 64.
+        stacked = lambda *shape: jnp.zeros((8, num_res) + shape)
+        return {
+            'distogram': {'logits': pair[..., None] * jnp.ones(64),
+                          'bin_edges': jnp.zeros(63)},
+            'experimentally_resolved': {'logits': jnp.zeros((num_res, 37))},
+            'masked_msa': {'logits': jnp.zeros((num_msa, num_res, 22))},
+            'predicted_lddt': {'logits': jnp.zeros((num_res, 50))},
+            'structure_module': {
+                'final_atom_mask': jnp.ones((num_res, 37)),
+                'final_atom_positions': jnp.zeros((num_res, 37, 3)),
+                'sidechains': {
+                    'angles_sin_cos': stacked(7, 2),
+                    'unnormalized_angles_sin_cos': stacked(7, 2),
+                    'atom_pos': stacked(14, 3),
+                    'frames': stacked(8, 4, 4),
+                },
+                'traj': stacked(12),
+            },
+            'representations': {
+                'msa': jnp.zeros((num_msa, num_res, 8)),
+                'msa_first_row': jnp.zeros((num_res, 8)),
+                'pair': pair[..., None] * jnp.ones(4),
+                'single': jnp.zeros((num_res, 8)),
+                'structure_module': jnp.zeros((num_res, 8)),
+            },
+            'plddt': per_residue * 70.,
+            'aligned_confidence_probs': pae_probs,
+            'predicted_aligned_error': pair,
+            'max_predicted_aligned_error': jnp.float32(31.),
+            'ptm': jnp.float32(0.5),
+            'iptm': jnp.float32(0.5),
+            'ranking_confidence': jnp.float32(0.5),
+            'num_recycles': jnp.int32(3),
+        }
+
+    def init_params(self, feat):
+        self.params = jnp.float32(1.)
+
+    def predict(self, feat, random_seed=0):
+        return jax.device_get(
+            self.apply(self.params, jax.random.PRNGKey(random_seed), feat))
+
+
+def _multimer_features(num_res=10, num_msa=20, num_templates=2):
+    return {
+        'aatype': np.zeros(num_res, np.int32),
+        'asym_id': np.repeat([1, 2], num_res // 2).astype(np.int32),
+        'residue_index': np.arange(num_res, dtype=np.int32),
+        'seq_mask': np.ones(num_res, np.float32),
+        'msa': np.zeros((num_msa, num_res), np.int32),
+        'msa_mask': np.ones((num_msa, num_res), np.float32),
+        'deletion_matrix': np.zeros((num_msa, num_res), np.float32),
+        'template_aatype': np.zeros((num_templates, num_res), np.int32),
+        'template_all_atom_mask': np.ones(
+            (num_templates, num_res, 37), np.float32),
+        'template_all_atom_positions': np.zeros(
+            (num_templates, num_res, 37, 3), np.float32),
+    }
+
+
+def test_pad_to_buckets_keeps_templates():
+    padded_features, num_res = alphafold_utils._pad_to_buckets(
+        _multimer_features(), _MultimerRunner(),
+        residue_buckets=[16], msa_buckets=[32])
+
+    assert num_res == 10
+    assert padded_features['msa'].shape == (32, 16)
+    assert padded_features['template_aatype'].shape == (2, 16)
+    assert padded_features['template_all_atom_positions'].shape == (
+        2, 16, 37, 3)
+
+
+def test_padded_prediction_has_unpadded_shapes():
+    features = _multimer_features()
+    unpadded_result, _ = alphafold_utils._run_model(
+        _MultimerRunner(), features, random_seed=0)
+    padded_result, _ = alphafold_utils._run_model(
+        _MultimerRunner(), features, random_seed=0,
+        residue_buckets=[16], msa_buckets=[32])
+
+    shapes = lambda result: jax.tree_util.tree_map(np.shape, result)
+    unpadded_shapes = shapes(unpadded_result)
+    # Padded MSA rows are not trimmed
+    unpadded_shapes['masked_msa']['logits'] = (32, 10, 22)
+    unpadded_shapes['representations']['msa'] = (32, 10, 8)
+    assert shapes(padded_result) == unpadded_shapes
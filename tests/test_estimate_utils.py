@@ -0,0 +1,58 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the runtime estimator."""
+
+from utils import estimate_utils
+
+
+def _timings(pipeline, wall_times):
+    return [{
+        'pipeline': pipeline,
+        'stage': stage,
+        'wall_time': wall_time,
+        'num_residues': 100,
+        'num_chains': 2,
+        'msa_depth': None,
+    } for stage, wall_time in wall_times.items() for _ in range(2)]
+
+
+def test_template_search_follows_msa_search(tmp_path):
+    fasta_path = tmp_path / 'complex.fasta'
+    fasta_path.write_text('>A\nMKTAYIAKQR\n>B\nGSHMLEDPVK\n')
+    estimator = estimate_utils.RuntimeEstimator(_timings(
+        'alphafold-multimer-optimized', {
+            'setup-multimer-run': 10.,
+            'jackhmmer': 100.,
+            'jackhmmer-2': 50.,
+            'bfd-search': 80.,
+            'hmmsearch': 30.,
+            'aggregate-features-multimer': 5.,
+            'aggregate-features-across-chains': 5.,
+            'predict': 200.,
+        }), 'alphafold-multimer-optimized')
+
+    estimate = estimator.estimate(str(fasta_path), {
+        'model_preset': 'multimer',
+        'num_multimer_predictions_per_model': 1,
+        'is_run_relax': '',
+    })
+
+    # The template search of each chain waits for its uniref90 search
+    assert estimate['critical_path'] == [
+        'setup-multimer-run', 'jackhmmer', 'hmmsearch',
+        'aggregate-features-multimer', 'aggregate-features-across-chains',
+        'predict']
+    assert estimate['duration'] == 10. + 100. + 30. + 5. + 5. + 200.
+    assert estimate['stages']['hmmsearch']['num_tasks'] == 2